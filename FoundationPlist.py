@@ -39,12 +39,29 @@ dictionary).
 
 To work with plist data in strings, you can use readPlistFromString()
 and writePlistToString().
+
+When PyObjC's Foundation module can't be imported, the same functions
+are provided by the pure-Python PurePlist module instead. Set the
+FOUNDATIONPLIST_BACKEND environment variable to "pure" to use PurePlist
+even when Foundation is available, or call setBackend().
 """
 
-from Foundation import NSData, \
-                       NSPropertyListSerialization, \
-                       NSPropertyListMutableContainers, \
-                       NSPropertyListXMLFormat_v1_0
+import os
+
+import PurePlist
+
+try:
+    from Foundation import NSData, \
+                           NSPropertyListSerialization, \
+                           NSPropertyListMutableContainers, \
+                           NSPropertyListXMLFormat_v1_0, \
+                           NSPropertyListBinaryFormat_v1_0
+    BACKEND = 'foundation'
+except ImportError:
+    BACKEND = 'pure'
+
+if os.environ.get('FOUNDATIONPLIST_BACKEND') == 'pure':
+    BACKEND = 'pure'
 
 class FoundationPlistException(Exception):
     pass
@@ -55,11 +72,39 @@ class NSPropertyListSerializationException(FoundationPlistException):
 class NSPropertyListWriteException(FoundationPlistException):
     pass
 
+def setBackend(backend):
+    """
+    Choose the plist implementation: 'foundation' (NSPropertyListSerialization)
+    or 'pure' (PurePlist).
+    """
+    global BACKEND
+    if backend == 'foundation':
+        try:
+            import Foundation
+        except ImportError:
+            raise FoundationPlistException('Foundation is not available')
+    elif backend != 'pure':
+        raise FoundationPlistException('Unknown plist backend: %s' % backend)
+    BACKEND = backend
+
+def _format(binary):
+    """Returns the NSPropertyListFormat to write"""
+    if binary:
+        return NSPropertyListBinaryFormat_v1_0
+    return NSPropertyListXMLFormat_v1_0
+
+
 def readPlist(filepath):
     """
     Read a .plist file from filepath.  Return the unpacked root object
     (which is usually a dictionary).
     """
+    if BACKEND == 'pure':
+        try:
+            return PurePlist.readPlist(filepath)
+        except PurePlist.PlistError, error:
+            raise NSPropertyListSerializationException(
+                                "%s in file %s" % (error, filepath))
     plistData = NSData.dataWithContentsOfFile_(filepath)
     dataObject, plistFormat, error = \
         NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
@@ -72,8 +117,26 @@ def readPlist(filepath):
         return dataObject
 
 
+def readPlistLazily(filepath, key):
+    '''
+    Read a .plist file from filepath, leaving the items of the array under
+    key in the root dictionary unparsed until they are used. Always uses
+    PurePlist; see PurePlist.readPlistLazily.
+    '''
+    try:
+        return PurePlist.readPlistLazily(filepath, key)
+    except PurePlist.PlistError, error:
+        raise NSPropertyListSerializationException(
+                            "%s in file %s" % (error, filepath))
+
+
 def readPlistFromString(data):
     '''Read a plist data from a string. Return the root object.'''
+    if BACKEND == 'pure':
+        try:
+            return PurePlist.readPlistFromString(data)
+        except PurePlist.PlistError, error:
+            raise NSPropertyListSerializationException(str(error))
     plistData = buffer(data)
     dataObject, plistFormat, error = \
      NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
@@ -85,13 +148,22 @@ def readPlistFromString(data):
         return dataObject
 
 
-def writePlist(dataObject, filepath):
+def writePlist(dataObject, filepath, binary=False):
     '''
-    Write 'rootObject' as a plist to filepath.
+    Write 'rootObject' as a plist to filepath. If binary is True, the plist
+    is written in binary format instead of XML.
     '''
+    if BACKEND == 'pure':
+        try:
+            return PurePlist.writePlist(dataObject, filepath, binary)
+        except PurePlist.PlistError, error:
+            raise NSPropertyListSerializationException(str(error))
+        except (OSError, IOError), error:
+            raise NSPropertyListWriteException(
+                                "Failed to write plist data to %s: %s" % (filepath, error))
     plistData, error = \
      NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-                            dataObject, NSPropertyListXMLFormat_v1_0, None)
+                            dataObject, _format(binary), None)
     if error:
         error = error.encode('ascii', 'ignore')
         raise NSPropertyListSerializationException(error)
@@ -103,11 +175,31 @@ def writePlist(dataObject, filepath):
                                 "Failed to write plist data to %s" % filepath)
 
 
-def writePlistToString(rootObject):
-    '''Return 'rootObject' as a plist-formatted string.'''
+def writePlistStreaming(dataObject, filepath, binary=False):
+    '''
+    Write 'dataObject' as a plist to filepath without building the whole
+    document in memory first. Always uses PurePlist's serializer, which
+    also accepts Foundation objects.
+    '''
+    try:
+        PurePlist.writePlist(dataObject, filepath, binary)
+    except PurePlist.PlistError, error:
+        raise NSPropertyListSerializationException(str(error))
+    except (OSError, IOError), error:
+        raise NSPropertyListWriteException(
+                            "Failed to write plist data to %s: %s" % (filepath, error))
+
+
+def writePlistToString(rootObject, binary=False):
+    '''Return 'rootObject' as a plist-formatted string, binary if binary is True.'''
+    if BACKEND == 'pure':
+        try:
+            return PurePlist.writePlistToString(rootObject, binary)
+        except PurePlist.PlistError, error:
+            raise NSPropertyListSerializationException(str(error))
     plistData, error = \
      NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-                            rootObject, NSPropertyListXMLFormat_v1_0, None)
+                            rootObject, _format(binary), None)
     if error:
         error = error.encode('ascii', 'ignore')
         raise NSPropertyListSerializationException(error)
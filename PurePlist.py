@@ -0,0 +1,608 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""PurePlist.py -- a pure-Python reader and writer for .plist files.
+
+This is the fallback used by FoundationPlist when PyObjC's Foundation
+module isn't available (on Linux, for example). It has the same four
+functions as FoundationPlist:
+    readPlist(filepath), readPlistFromString(data),
+    writePlist(rootObject, filepath), writePlistToString(rootObject)
+
+readPlistLazily() defers parsing the items of one array (such as Imagr's
+workflows) until they are used, and copies untouched items through
+verbatim when the plist is written again.
+
+XML plists are written the same way NSPropertyListSerialization writes
+NSPropertyListXMLFormat_v1_0: tab indentation, sorted dictionary keys,
+<array/> and <dict/> for empty containers, and only <, > and & escaped.
+Both XML and binary (bplist00) plists can be read and written; XML is
+the default for writing.
+
+<data> values are returned as plistlib.Data objects and <date> values
+as naive UTC datetime objects, as with plistlib.
+"""
+
+import os
+import struct
+import tempfile
+import datetime
+import binascii
+from xml.parsers import expat
+from plistlib import Data
+
+
+class PlistError(Exception):
+    pass
+
+
+XML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+              '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+              '<plist version="1.0">\n')
+XML_FOOTER = '</plist>\n'
+
+BINARY_MAGIC = 'bplist00'
+
+# writePlist hands the file this much serialized plist at a time
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# struct formats for the integer sizes it can unpack directly
+_INT_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+
+# binary plist dates are seconds since this moment
+APPLE_EPOCH = datetime.datetime(2001, 1, 1)
+
+
+# Reading
+
+class _XMLPlistParser(object):
+    """Builds plist objects from expat events"""
+    def __init__(self):
+        self.stack = list()
+        self.keys = list()
+        self.root = None
+        self.text = list()
+
+    def parse(self, data):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.text.append
+        try:
+            parser.Parse(data, True)
+        except expat.ExpatError, errmsg:
+            raise PlistError(str(errmsg))
+        return self.root
+
+    def getText(self):
+        text = ''.join(self.text)
+        del self.text[:]
+        # plain str for ASCII text, like plistlib
+        try:
+            return text.encode('ascii')
+        except UnicodeError:
+            return text
+
+    def addObject(self, value):
+        if not self.stack:
+            self.root = value
+        elif isinstance(self.stack[-1], dict):
+            self.stack[-1][self.keys.pop()] = value
+        else:
+            self.stack[-1].append(value)
+
+    def startElement(self, element, attributes):
+        del self.text[:]
+        if element == 'dict':
+            value = dict()
+        elif element == 'array':
+            value = list()
+        else:
+            return
+        self.addObject(value)
+        self.stack.append(value)
+
+    def endElement(self, element):
+        if element in ('dict', 'array'):
+            self.stack.pop()
+        elif element == 'key':
+            self.keys.append(self.getText())
+        elif element == 'string':
+            self.addObject(self.getText())
+        elif element == 'integer':
+            self.addObject(int(self.getText()))
+        elif element == 'real':
+            self.addObject(float(self.getText()))
+        elif element == 'true':
+            self.addObject(True)
+        elif element == 'false':
+            self.addObject(False)
+        elif element == 'date':
+            self.addObject(datetime.datetime.strptime(self.getText(), '%Y-%m-%dT%H:%M:%SZ'))
+        elif element == 'data':
+            self.addObject(Data(binascii.a2b_base64(self.getText())))
+        elif element != 'plist':
+            raise PlistError('Unknown plist element <%s>' % element)
+
+
+class _BinaryPlistParser(object):
+    """Decodes a bplist00 string"""
+    def parse(self, data):
+        self.data = data
+        try:
+            (offsetSize, self.refSize, numObjects, topObject,
+                offsetTableOffset) = struct.unpack('>6xBBQQQ', data[-32:])
+            self.offsets = self.unpackInts(offsetTableOffset, offsetSize, numObjects)
+            return self.readObject(topObject)
+        except (struct.error, IndexError, ValueError), errmsg:
+            raise PlistError('Invalid binary plist: %s' % errmsg)
+
+    def unpackInts(self, offset, size, count):
+        """Returns count unsigned size-byte integers starting at offset"""
+        if size in _INT_FORMATS:
+            return list(struct.unpack('>%d%s' % (count, _INT_FORMATS[size]),
+                                      self.data[offset:offset + size * count]))
+        return [self.unpackInt(self.data[offset + i * size:offset + (i + 1) * size])
+                for i in xrange(count)]
+
+    def unpackInt(self, data):
+        if len(data) in _INT_FORMATS:
+            return struct.unpack('>' + _INT_FORMATS[len(data)], data)[0]
+        value = 0
+        for byte in data:
+            value = (value << 8) | ord(byte)
+        return value
+
+    def readCount(self, info, offset):
+        """Returns (count, offset of the first byte after the count)"""
+        if info != 0xF:
+            return info, offset + 1
+        # the count is an integer object that follows the marker
+        size = 1 << (ord(self.data[offset + 1]) & 0xF)
+        return self.unpackInt(self.data[offset + 2:offset + 2 + size]), offset + 2 + size
+
+    def readObject(self, ref):
+        offset = self.offsets[ref]
+        marker = ord(self.data[offset])
+        kind, info = marker >> 4, marker & 0xF
+        if marker == 0x00:
+            return None
+        elif marker == 0x08:
+            return False
+        elif marker == 0x09:
+            return True
+        elif kind == 0x1:
+            size = 1 << info
+            value = self.unpackInt(self.data[offset + 1:offset + 1 + size])
+            if size == 8 and value >= 1 << 63:
+                # 8 byte integers are signed
+                value -= 1 << 64
+            return int(value)
+        elif kind == 0x2:
+            if info == 2:
+                return struct.unpack('>f', self.data[offset + 1:offset + 5])[0]
+            return struct.unpack('>d', self.data[offset + 1:offset + 9])[0]
+        elif marker == 0x33:
+            seconds = struct.unpack('>d', self.data[offset + 1:offset + 9])[0]
+            return APPLE_EPOCH + datetime.timedelta(seconds=seconds)
+        count, start = self.readCount(info, offset)
+        if kind == 0x4:
+            return Data(self.data[start:start + count])
+        elif kind == 0x5:
+            return self.data[start:start + count]
+        elif kind == 0x6:
+            text = self.data[start:start + count * 2].decode('utf-16-be')
+            try:
+                return text.encode('ascii')
+            except UnicodeError:
+                return text
+        elif kind == 0xA:
+            return [self.readObject(item) for item in self.unpackInts(start, self.refSize, count)]
+        elif kind == 0xD:
+            keys = self.unpackInts(start, self.refSize, count)
+            values = self.unpackInts(start + count * self.refSize, self.refSize, count)
+            return dict((self.readObject(key), self.readObject(value))
+                        for key, value in zip(keys, values))
+        raise PlistError('Unknown binary plist object marker 0x%02x' % marker)
+
+
+def readPlistFromString(data):
+    '''Read a plist data from a string. Return the root object.'''
+    if data.startswith(BINARY_MAGIC):
+        return _BinaryPlistParser().parse(data)
+    return _XMLPlistParser().parse(data)
+
+
+def readPlist(filepath):
+    """
+    Read a .plist file from filepath.  Return the unpacked root object
+    (which is usually a dictionary).
+    """
+    with open(filepath, 'rb') as fileobject:
+        return readPlistFromString(fileobject.read())
+
+
+# Lazy reading
+
+def _unescape(text):
+    text = text.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+    try:
+        return text.decode('ascii')
+    except UnicodeError:
+        return text.decode('utf-8')
+
+
+class RawPlistValue(object):
+    """
+    A plist value that hasn't been parsed yet, kept as the XML it was read
+    from: whole lines, starting with depth tabs and ending with a newline.
+    """
+    def __init__(self, xml, depth):
+        self.xml = xml
+        self.depth = depth
+
+    def parse(self):
+        return readPlistFromString(XML_HEADER + self.xml + XML_FOOTER)
+
+    def peek(self, key):
+        """
+        Returns the string value for key in this dict without parsing the
+        rest of it, or None if it isn't there.
+        """
+        indent = '\t' * (self.depth + 1)
+        start = self.xml.find('\n%s<key>%s</key>\n%s<string>' % (indent, _escape(key), indent))
+        if start == -1:
+            return self.parse().get(key)
+        start = self.xml.index('<string>', start) + len('<string>')
+        text = self.xml[start:self.xml.index('</string>', start)]
+        if '&' in text.replace('&lt;', '').replace('&gt;', '').replace('&amp;', ''):
+            # some other entity; let expat deal with it
+            return self.parse().get(key)
+        text = _unescape(text)
+        try:
+            return text.encode('ascii')
+        except UnicodeError:
+            return text
+
+
+class LazyPlistArray(list):
+    """
+    A list whose items may still be RawPlistValues. An item is parsed the
+    first time it is accessed and replaced by the result. The writer copies
+    items that were never accessed through verbatim.
+    """
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        item = list.__getitem__(self, index)
+        if isinstance(item, RawPlistValue):
+            item = item.parse()
+            list.__setitem__(self, index, item)
+        return item
+
+    def __getslice__(self, start, end):
+        return self[max(0, start):max(0, end):]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def peek(self, index, key):
+        """Returns item[key] for a dict item without parsing it"""
+        item = list.__getitem__(self, index)
+        if isinstance(item, RawPlistValue):
+            return item.peek(key)
+        return item.get(key)
+
+    def isParsed(self, index):
+        return not isinstance(list.__getitem__(self, index), RawPlistValue)
+
+
+def readPlistLazily(filepath, key):
+    """
+    Read a .plist file from filepath like readPlist, except that the items
+    of the array under key in the root dictionary aren't parsed until they
+    are used. Only XML written with Apple's indentation can be read lazily;
+    anything else is parsed up front as usual.
+    """
+    with open(filepath, 'rb') as fileobject:
+        data = fileobject.read()
+    if data.startswith(BINARY_MAGIC):
+        return readPlistFromString(data)
+    # a key or tag at a given depth always starts on a new line after
+    # exactly that many tabs, and < can't appear inside a string value,
+    # so the array and its items can be found with plain string searches
+    arrayHead = '\n\t<key>%s</key>\n\t<array>\n' % _escape(key)
+    arrayTail = '\t</array>\n'
+    itemHead, itemTail, emptyItem = '\t\t<dict>\n', '\n\t\t</dict>\n', '\t\t<dict/>\n'
+    arrayStart = data.find(arrayHead)
+    if arrayStart == -1:
+        return readPlistFromString(data)
+    position = arrayStart + len(arrayHead)
+    items = LazyPlistArray()
+    while not data.startswith(arrayTail, position):
+        if data.startswith(itemHead, position):
+            end = data.find(itemTail, position)
+            if end == -1:
+                return readPlistFromString(data)
+            end += len(itemTail)
+        elif data.startswith(emptyItem, position):
+            end = position + len(emptyItem)
+        else:
+            # not laid out the way we expect
+            return readPlistFromString(data)
+        list.append(items, RawPlistValue(data[position:end], 2))
+        position = end
+    # parse everything else with an empty array in place of the items
+    rootObject = readPlistFromString(data[:arrayStart] +
+                                     '\n\t<key>%s</key>\n\t<array/>\n' % _escape(key) +
+                                     data[position + len(arrayTail):])
+    rootObject[key] = items
+    return rootObject
+
+
+# Writing
+
+def _escape(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _fromFoundation(value):
+    """Returns the Python equivalent of a Foundation container, NSData or NSDate"""
+    if hasattr(value, 'keys'):
+        # NSDictionary and other mappings
+        return dict((key, value[key]) for key in value.keys())
+    elif hasattr(value, 'timeIntervalSince1970'):
+        # NSDate
+        return datetime.datetime.utcfromtimestamp(value.timeIntervalSince1970())
+    elif hasattr(value, 'bytes') and hasattr(value, 'length'):
+        # NSData
+        return Data(str(buffer(value.bytes(), 0, value.length())))
+    elif hasattr(value, '__iter__'):
+        # NSArray and other sequences
+        return list(value)
+    raise PlistError('Unsupported plist type: %s' % type(value))
+
+
+def _writeXMLValue(value, write, depth):
+    """Writes value as XML through write(), indented depth tabs"""
+    indent = '\t' * depth
+    if isinstance(value, RawPlistValue):
+        if value.depth == depth:
+            write(value.xml)
+        else:
+            _writeXMLValue(value.parse(), write, depth)
+    elif isinstance(value, LazyPlistArray):
+        if not value:
+            write('%s<array/>\n' % indent)
+            return
+        write('%s<array>\n' % indent)
+        # list.__iter__ hands back unparsed items as they are
+        for item in list.__iter__(value):
+            _writeXMLValue(item, write, depth + 1)
+        write('%s</array>\n' % indent)
+    elif isinstance(value, basestring):
+        write('%s<string>%s</string>\n' % (indent, _escape(value)))
+    elif isinstance(value, bool):
+        if value:
+            write('%s<true/>\n' % indent)
+        else:
+            write('%s<false/>\n' % indent)
+    elif isinstance(value, (int, long)):
+        write('%s<integer>%d</integer>\n' % (indent, value))
+    elif isinstance(value, float):
+        write('%s<real>%.17g</real>\n' % (indent, value))
+    elif isinstance(value, dict):
+        if not value:
+            write('%s<dict/>\n' % indent)
+            return
+        write('%s<dict>\n' % indent)
+        for key in sorted(value.keys()):
+            if not isinstance(key, basestring):
+                raise PlistError('Dictionary keys must be strings: %r' % (key,))
+            write('%s\t<key>%s</key>\n' % (indent, _escape(key)))
+            _writeXMLValue(value[key], write, depth + 1)
+        write('%s</dict>\n' % indent)
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            write('%s<array/>\n' % indent)
+            return
+        write('%s<array>\n' % indent)
+        for item in value:
+            _writeXMLValue(item, write, depth + 1)
+        write('%s</array>\n' % indent)
+    elif isinstance(value, datetime.datetime):
+        write('%s<date>%s</date>\n' % (indent, value.strftime('%Y-%m-%dT%H:%M:%SZ')))
+    elif isinstance(value, Data):
+        write('%s<data>\n' % indent)
+        # same line length rule as plistlib, which follows Apple's
+        lineLength = max(16, 76 - depth * 8)
+        chunkSize = lineLength * 3 // 4
+        for start in xrange(0, len(value.data), chunkSize):
+            write('%s%s' % (indent, binascii.b2a_base64(value.data[start:start + chunkSize])))
+        write('%s</data>\n' % indent)
+    else:
+        _writeXMLValue(_fromFoundation(value), write, depth)
+
+
+def _writeXML(rootObject, write):
+    write(XML_HEADER)
+    _writeXMLValue(rootObject, write, 0)
+    write(XML_FOOTER)
+
+
+class _BinaryPlistWriter(object):
+    """
+    Writes a bplist00 plist. Equal strings, numbers, dates and data are
+    written once and shared by every container that holds them.
+    """
+    def __init__(self):
+        # scalars, or (marker, child refs) for arrays and dicts
+        self.objects = list()
+        self.uniques = dict()
+
+    def uniqueKey(self, value):
+        """Returns the key equal scalars share, or None for containers"""
+        if isinstance(value, bool):
+            return ('bool', value)
+        elif isinstance(value, (int, long)):
+            return ('integer', value)
+        elif isinstance(value, float):
+            return ('real', value)
+        elif isinstance(value, basestring):
+            if isinstance(value, str):
+                try:
+                    value = value.decode('ascii')
+                except UnicodeError:
+                    value = value.decode('utf-8')
+            return ('string', value)
+        elif isinstance(value, datetime.datetime):
+            return ('date', value)
+        elif isinstance(value, Data):
+            return ('data', value.data)
+        return None
+
+    def flatten(self, value):
+        """Adds value and everything in it to the object table, returns its ref"""
+        if isinstance(value, RawPlistValue):
+            value = value.parse()
+        key = self.uniqueKey(value)
+        if key is not None:
+            ref = self.uniques.get(key)
+            if ref is None:
+                ref = self.uniques[key] = len(self.objects)
+                self.objects.append(key)
+            return ref
+        ref = len(self.objects)
+        if isinstance(value, dict):
+            self.objects.append(None)
+            keys = sorted(value.keys())
+            refs = [self.flatten(item) for item in keys]
+            refs += [self.flatten(value[item]) for item in keys]
+            self.objects[ref] = (0xD0, refs)
+        elif isinstance(value, (list, tuple)):
+            self.objects.append(None)
+            if isinstance(value, LazyPlistArray):
+                # parse unused items here without keeping them parsed
+                value = list.__iter__(value)
+            refs = [self.flatten(item) for item in value]
+            self.objects[ref] = (0xA0, refs)
+        else:
+            return self.flatten(_fromFoundation(value))
+        return ref
+
+    def encodeCount(self, marker, count):
+        if count < 15:
+            return chr(marker | count)
+        return chr(marker | 0xF) + self.encodeInteger(count)
+
+    def encodeInteger(self, value):
+        if 0 <= value < 1 << 8:
+            return '\x10' + struct.pack('>B', value)
+        elif 0 <= value < 1 << 16:
+            return '\x11' + struct.pack('>H', value)
+        elif 0 <= value < 1 << 32:
+            return '\x12' + struct.pack('>L', value)
+        elif -(1 << 63) <= value < 1 << 63:
+            return '\x13' + struct.pack('>q', value)
+        return '\x14' + struct.pack('>QQ', value >> 64, value & ((1 << 64) - 1))
+
+    def encode(self, item, refFormat):
+        if isinstance(item, tuple) and isinstance(item[1], list):
+            marker, refs = item
+            count = len(refs) // 2 if marker == 0xD0 else len(refs)
+            return self.encodeCount(marker, count) + struct.pack(refFormat % len(refs), *refs)
+        kind, value = item
+        if kind == 'bool':
+            return value and '\x09' or '\x08'
+        elif kind == 'integer':
+            return self.encodeInteger(value)
+        elif kind == 'real':
+            return '\x23' + struct.pack('>d', value)
+        elif kind == 'date':
+            delta = value - APPLE_EPOCH
+            seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+            return '\x33' + struct.pack('>d', seconds)
+        elif kind == 'data':
+            return self.encodeCount(0x40, len(value)) + value
+        try:
+            return self.encodeCount(0x50, len(value)) + value.encode('ascii')
+        except UnicodeError:
+            encoded = value.encode('utf-16-be')
+            return self.encodeCount(0x60, len(encoded) // 2) + encoded
+
+    def write(self, rootObject, write):
+        self.flatten(rootObject)
+        refSize = self.intSize(len(self.objects))
+        refFormat = '>%d' + _INT_FORMATS[refSize]
+        write(BINARY_MAGIC)
+        offsets = list()
+        position = len(BINARY_MAGIC)
+        for item in self.objects:
+            offsets.append(position)
+            data = self.encode(item, refFormat)
+            write(data)
+            position += len(data)
+        offsetSize = self.intSize(position)
+        write(struct.pack('>%d%s' % (len(offsets), _INT_FORMATS[offsetSize]), *offsets))
+        write(struct.pack('>6xBBQQQ', offsetSize, refSize, len(self.objects), 0, position))
+
+    def intSize(self, value):
+        """Returns the smallest of 1, 2, 4 or 8 bytes that can hold refs below value"""
+        for size in (1, 2, 4):
+            if value < 1 << (8 * size):
+                return size
+        return 8
+
+
+def _writeBinary(rootObject, write):
+    _BinaryPlistWriter().write(rootObject, write)
+
+
+def writePlistToString(rootObject, binary=False):
+    '''Return 'rootObject' as a plist-formatted string, in bplist00 format if binary.'''
+    chunks = list()
+    if binary:
+        _writeBinary(rootObject, chunks.append)
+    else:
+        _writeXML(rootObject, chunks.append)
+    return ''.join(chunks)
+
+
+def _fileMode(filepath):
+    """Returns the permissions to give a rewritten filepath"""
+    try:
+        return os.stat(filepath).st_mode & 07777
+    except OSError:
+        # a new file gets the usual permissions for the current umask
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
+
+
+def writePlist(rootObject, filepath, binary=False):
+    '''
+    Write 'rootObject' as a plist to filepath, in bplist00 format if binary.
+
+    The plist is streamed to a temporary file next to filepath as it is
+    serialized, then renamed over filepath (like NSData's
+    writeToFile:atomically:), so the whole document is never held in memory.
+    '''
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, temppath = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(filepath))
+    try:
+        with os.fdopen(fd, 'wb', WRITE_BUFFER_SIZE) as fileobject:
+            if binary:
+                _writeBinary(rootObject, fileobject.write)
+            else:
+                _writeXML(rootObject, fileobject.write)
+            fileobject.flush()
+            os.fsync(fileobject.fileno())
+        os.chmod(temppath, _fileMode(filepath))
+        os.rename(temppath, filepath)
+    except:
+        os.remove(temppath)
+        raise
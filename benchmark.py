@@ -0,0 +1,246 @@
+#!/usr/bin/python
+"""benchmark.py -- measures how ImagrConfigPlist scales with config size.
+
+Generates synthetic Imagr configs with the given numbers of workflows and
+times loading them, each subcommand, a batch of edits and synchronize().
+Each size runs in its own process so peak memory can be read from the
+process' maximum resident set size.
+
+Results are written as JSON. If a baseline results file is given, any
+timing more than --tolerance slower than the baseline is reported and the
+script exits with status 1.
+
+    ./benchmark.py --sizes 10 1000 10000 --output results.json
+    ./benchmark.py --baseline results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import config_creator
+import FoundationPlist as plistlib
+
+
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+
+# timings below this many seconds are too noisy to call regressions
+NOISE_FLOOR = 0.001
+
+SCRIPT_CONTENT = '#!/bin/bash\n' + 'echo "{{target_volume}}"\n' * 40
+
+
+# Synthetic configs
+
+def makeWorkflow(index, rng):
+    """Returns a workflow with a realistic mix of components"""
+    components = list()
+    if rng.random() < 0.3:
+        components.append({'type': 'partition', 'map': 'GPTFormat',
+                           'partitions': [{'format_type': 'Journaled HFS+', 'name': 'Macintosh HD',
+                                           'size': '100%', 'target': True}]})
+    elif rng.random() < 0.5:
+        components.append({'type': 'eraseVolume', 'name': 'Macintosh HD', 'format': 'Journaled HFS+'})
+    if rng.random() < 0.7:
+        components.append({'type': 'image', 'url': 'http://repo/images/image-%d.dmg' % rng.randint(0, 20)})
+    for i in range(rng.randint(1, 5)):
+        components.append({'type': 'package', 'first_boot': rng.random() < 0.5,
+                           'url': 'http://repo/packages/package-%d.pkg' % rng.randint(0, 500)})
+    for i in range(rng.randint(0, 2)):
+        components.append({'type': 'script', 'first_boot': True, 'content': SCRIPT_CONTENT})
+    if rng.random() < 0.2:
+        components.append({'type': 'computer_name', 'use_serial': True, 'auto': False})
+    return {'name': 'Workflow %d' % index,
+            'description': 'Synthetic workflow %d' % index,
+            'restart_action': rng.choice(['restart', 'shutdown', 'none']),
+            'bless_target': rng.random() < 0.5,
+            'components': components}
+
+
+def makeConfig(size, path):
+    """Writes a synthetic config with size workflows to path"""
+    rng = random.Random(size)
+    config = {'password': '', 'workflows': [makeWorkflow(i, rng) for i in range(size)]}
+    plistlib.writePlistStreaming(config, path)
+
+
+# Measurements
+
+def peakMemory():
+    """Returns the peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    # Linux reports kilobytes
+    return peak * 1024
+
+
+class Timer(object):
+    """Times a block, with stdout sent to /dev/null"""
+    def __init__(self, results, name, calls=1):
+        self.results = results
+        self.name = name
+        self.calls = calls
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.results['seconds'][self.name] = elapsed / self.calls
+        self.results['peak_memory'][self.name] = peakMemory()
+
+
+def subcommandCases(size, scriptPath):
+    """Returns (subcommand, list of argument lists) pairs to time"""
+    targets = [str(i) for i in sorted(set([0, size // 2, size - 1]))]
+    names = ['Workflow %s' % target for target in targets]
+    return [
+        ('show-workflow', [[name] for name in names]),
+        ('display-components', [[name] for name in names]),
+        ('set-description', [['--workflow', name, '--desc', 'changed'] for name in names]),
+        ('set-restart-action', [['--workflow', name, '--restart', 'restart'] for name in names]),
+        ('set-bless-target', [['--workflow', name, '--no-bless'] for name in names]),
+        ('add-package-component', [['--workflow', name, '--url', 'http://repo/new.pkg'] for name in names]),
+        ('add-computername-component', [['--workflow', name, '--use-serial'] for name in names]),
+        ('add-script-component', [['--workflow', name, '--content', scriptPath] for name in names]),
+        ('add-erase-component', [['--workflow', name] for name in names]),
+        ('add-partition-component', [['--workflow', name, '--names', 'HD', '--formats', 'Journaled HFS+',
+                                      '--sizes', '100%', '--target', 'HD'] for name in names]),
+        ('remove-component', [['--workflow', name, '--component', '0'] for name in names]),
+        ('add-workflow', [['Benchmark %s' % target, '--index', target] for target in targets]),
+        ('add-image-component', [['--workflow', 'Benchmark %s' % target, '--url', 'http://repo/new.dmg']
+                                 for target in targets]),
+        ('remove-workflow', [['Benchmark %s' % target] for target in targets]),
+        ('new-password', [['secret']]),
+        ('show-password', [[]]),
+        ('display-workflows', [[]]),
+    ]
+
+
+def runSize(size, workdir):
+    """Runs every measurement against a config of size workflows"""
+    results = {'workflows': size, 'seconds': dict(), 'peak_memory': dict()}
+    path = os.path.join(workdir, 'config_%d.plist' % size)
+    scriptPath = os.path.join(workdir, 'script.sh')
+    with open(scriptPath, 'w') as scriptFile:
+        scriptFile.write(SCRIPT_CONTENT)
+    makeConfig(size, path)
+    results['file_size'] = os.path.getsize(path)
+    results['peak_memory']['baseline'] = peakMemory()
+
+    with Timer(results, 'load'):
+        configPlist = config_creator.ImagrConfigPlist(path)
+    with Timer(results, 'load_all_workflows'):
+        for workflow in configPlist.internalPlist['workflows']:
+            pass
+
+    for subcommand, argLists in subcommandCases(size, scriptPath):
+        with Timer(results, subcommand, len(argLists)):
+            for args in argLists:
+                config_creator.handleSubcommand([subcommand] + args, configPlist)
+
+    lines = ["set-description --workflow 'Workflow %d' --desc 'batch %d'\n" % (i % size, i)
+             for i in range(1000)]
+    # in the output mode --batch runs in by default
+    configPlist.outputMode = config_creator.BATCH_OUTPUT_MODE
+    with Timer(results, 'batch_1000_edits'):
+        config_creator.runBatch(lines, configPlist)
+    configPlist.outputMode = 'full'
+
+    with Timer(results, 'api_1000_edits'):
+        for i in range(1000):
+            configPlist.setDescription(i % size, 'api %d' % i)
+        configPlist.endChange('api edits')
+
+    with Timer(results, 'synchronize'):
+        configPlist.synchronize()
+    configPlist.binary = True
+    with Timer(results, 'synchronize_binary'):
+        configPlist.synchronize()
+    results['peak_memory']['total'] = peakMemory()
+    return results
+
+
+# Comparing
+
+def compare(results, baseline, tolerance):
+    """Returns a list of descriptions of timings that got slower than the baseline"""
+    regressions = list()
+    for size, current in sorted(results.items(), key=lambda item: int(item[0])):
+        previous = baseline.get(size)
+        if previous is None:
+            continue
+        for name, seconds in sorted(current['seconds'].items()):
+            before = previous['seconds'].get(name)
+            if before is None:
+                continue
+            if seconds > before * (1 + tolerance) and seconds - before > NOISE_FLOOR:
+                regressions.append('%s workflows, %s: %.4fs -> %.4fs (%+.0f%%)' %
+                                   (size, name, before, seconds, (seconds / before - 1) * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ImagrConfigPlist on synthetic configs.')
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of workflows to generate configs with')
+    parser.add_argument('--output', metavar='PATH', default='benchmark_results.json',
+                        help='where to write the results')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='results file to compare against')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float, default=0.25,
+                        help='how much slower than the baseline a timing may be - defaults to 0.25')
+    parser.add_argument('--worker', metavar='N', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.worker is not None:
+        json.dump(runSize(arguments.worker, arguments.workdir), sys.stdout)
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix='imagr_benchmark.')
+    results = dict()
+    try:
+        for size in arguments.sizes:
+            print >> sys.stderr, 'Benchmarking %d workflows...' % size
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              '--worker', str(size), '--workdir', workdir])
+            results[str(size)] = json.loads(output)
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(arguments.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2, sort_keys=True)
+    for size in arguments.sizes:
+        current = results[str(size)]
+        print '%d workflows (%d bytes, peak memory %d bytes):' % (
+            size, current['file_size'], current['peak_memory']['total'])
+        for name, seconds in sorted(current['seconds'].items()):
+            print '\t%-28s %.6fs' % (name, seconds)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baselineFile:
+            regressions = compare(results, json.load(baselineFile), arguments.tolerance)
+        if regressions:
+            print >> sys.stderr, 'Slower than %s:' % arguments.baseline
+            for regression in regressions:
+                print >> sys.stderr, '\t%s' % regression
+            return 1
+        print 'No regressions against %s.' % arguments.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,18 +8,580 @@ import pprint
 import argparse
 import readline
 import shlex
+import pipes
 import fnmatch
+import mmap
+import sqlite3
+import urllib
+import re
 import copy
+import datetime
+import binascii
+import bisect
+import difflib
+import time
+import math
+import json
+import errno
+import atexit
+import socket
+import httplib
+import urlparse
+import cProfile
+import threading
+import multiprocessing
+import csv
+from multiprocessing.pool import ThreadPool
+import SocketServer
+from StringIO import StringIO
+try:
+    import yaml
+except ImportError:
+    # YAML manifests are only read when PyYAML is installed
+    yaml = None
 
-#try:
-#    import FoundationPlist as plistlib
-#except ImportError:
-#    import plistlib
+# FoundationPlist falls back to the pure-Python PurePlist module
+# when PyObjC isn't available
 import FoundationPlist as plistlib
+# how plist data values are read, for exporting them to JSON
+from PurePlist import Data
+
+
+class ImagrConfigError(Exception):
+    """Raised by the ImagrConfigPlist API. errno is the status the
+    subcommand that made the call exits with."""
+    def __init__(self, message, errno=22):
+        Exception.__init__(self, message)
+        self.errno = errno
+
+
+# argparse choices for workflow arguments
+
+class WorkflowChoices(object):
+    """Accepts any current workflow name or index, checked against the plist's name index"""
+    def __init__(self, configPlist):
+        self.configPlist = configPlist
+
+    def __contains__(self, value):
+        if value in self.configPlist.workflowIndex:
+            return True
+        # indexes are only accepted in the same form as str(index)
+        if not value.isdigit() or str(int(value)) != value:
+            return False
+        return int(value) < len(self.configPlist.internalPlist['workflows'])
+
+    def __iter__(self):
+        # only walked when argparse reports an invalid choice
+        for name in self.configPlist.getWorkflowNames():
+            yield name
+        for index in range(len(self.configPlist.internalPlist['workflows'])):
+            yield str(index)
+
+
+# Instrumentation
+
+def subcommandName(name):
+    '''Returns a subcommand's name as it is recorded: the dispatcher takes
+    --set-description and set_description for set-description too'''
+    return name.lstrip('-').replace('_', '-')
+
+class CommandStats(object):
+    """Records call counts and latencies of subcommands, plist loads and saves"""
+    def __init__(self):
+        # name -> list of durations in seconds
+        self.samples = dict()
+        # subcommand to run under cProfile, and where to dump its profile
+        self.profileCommand = None
+        self.profilePath = 'imagr_config.prof'
+        self.profiler = None
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, list()).append(seconds)
+
+    def timing(self, name):
+        """Returns a context manager that records how long its block takes under name"""
+        return _Timing(self, name)
+
+    def call(self, name, function, *args):
+        """Calls function(*args), recording its duration, and profiling it if it's profileCommand"""
+        if name == self.profileCommand:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            with self.timing(name):
+                result = self.profiler.runcall(function, *args)
+            # dump after every call so the profile survives sys.exit
+            self.profiler.dump_stats(self.profilePath)
+            return result
+        with self.timing(name):
+            return function(*args)
+
+    def percentile(self, samples, fraction):
+        """Nearest-rank percentile of a sorted list"""
+        rank = int(math.ceil(fraction * len(samples))) - 1
+        return samples[min(max(rank, 0), len(samples) - 1)]
+
+    def report(self, names=None):
+        """Returns a list of lines describing the recorded timings, in
+        milliseconds, of all of them or only those in names"""
+        lines = ['%-28s %8s %12s %10s %10s %10s' % ('name', 'calls', 'total ms', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for name in sorted(self.samples.keys()):
+            if names is not None and name not in names:
+                continue
+            samples = sorted(self.samples[name])
+            lines.append('%-28s %8d %12.3f %10.3f %10.3f %10.3f' % (
+                name, len(samples), sum(samples) * 1000,
+                self.percentile(samples, 0.50) * 1000,
+                self.percentile(samples, 0.95) * 1000,
+                self.percentile(samples, 0.99) * 1000))
+        return lines
+
+
+class _Timing(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.name, time.time() - self.start)
+
+
+# global variable
+STATS = CommandStats()
+
+
+# Component lookup
+
+class ComponentIndex(object):
+    """Maps component values to the workflows and components that have them.
+    Indexed fields are url, type, first_boot and the format_type of each
+    partition in a partition component."""
+    fields = ('url', 'type', 'first_boot', 'format_type')
+
+    def __init__(self):
+        # (field, value) -> {(id(workflow), id(component)): [workflow, component, count]}
+        self.entries = dict()
+
+    def keys(self, component):
+        """Returns the (field, value) pairs component is indexed under"""
+        keys = list()
+        for field in ('url', 'type', 'first_boot'):
+            if field in component:
+                keys.append((field, component[field]))
+        for partition in component.get('partitions', []):
+            if 'format_type' in partition:
+                keys.append(('format_type', partition['format_type']))
+        return keys
+
+    def add(self, workflow, component):
+        identity = (id(workflow), id(component))
+        for key in self.keys(component):
+            entry = self.entries.setdefault(key, dict()).setdefault(identity, [workflow, component, 0])
+            entry[2] += 1
+
+    def remove(self, workflow, component):
+        identity = (id(workflow), id(component))
+        for key in self.keys(component):
+            matches = self.entries.get(key, {})
+            entry = matches.get(identity)
+            if entry is None:
+                continue
+            entry[2] -= 1
+            if entry[2] == 0:
+                del matches[identity]
+                if not matches:
+                    del self.entries[key]
+
+    def addWorkflow(self, workflow):
+        for component in workflow.get('components', []):
+            self.add(workflow, component)
+
+    def removeWorkflow(self, workflow):
+        for component in workflow.get('components', []):
+            self.remove(workflow, component)
+
+    def find(self, field, value):
+        """Returns the (workflow, component) pairs with component[field] == value"""
+        return [(entry[0], entry[1]) for entry in self.entries.get((field, value), {}).values()]
+
+
+# Checksums of files in local repo mirrors
+
+# bytes of a memory-mapped file handed to the hash at a time
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+def sha256File(path):
+    '''Returns the SHA-256 hex digest of the file at path, read through mmap'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fileobject:
+        size = os.fstat(fileobject.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(fileobject.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, HASH_CHUNK_SIZE):
+                    # hashlib releases the GIL for large updates, so threads hash in parallel
+                    digest.update(buffer(mapped, offset, HASH_CHUNK_SIZE))
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+def parseMirror(value):
+    '''argparse type for PREFIX=DIR mirror mappings'''
+    prefix, separator, directory = value.partition('=')
+    if not separator or not prefix or not directory:
+        raise argparse.ArgumentTypeError('mirrors are given as URL_PREFIX=DIRECTORY, not %r' % value)
+    return prefix, os.path.abspath(os.path.expanduser(directory))
+
+class ChecksumCache(object):
+    """SHA-256 digests of files, kept in a SQLite database next to the plist
+    and keyed by path, size and modification time, so a file is only hashed
+    again once it changes."""
+    def __init__(self, path):
+        self.path = path
+        # opened on first use
+        self.connection = None
+
+    def open(self):
+        if self.connection is None:
+            # in server mode, each client has its own thread; their
+            # subcommands run one at a time, under the server's lock
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checksums '
+                                    '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)')
+        return self.connection
+
+    def lookup(self, path, info):
+        '''Returns the cached digest for path if info (an os.stat result) still matches, or None'''
+        row = self.open().execute('SELECT sha256 FROM checksums WHERE path = ? AND size = ? AND mtime = ?',
+                                  (path, info.st_size, info.st_mtime)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def store(self, path, info, digest):
+        self.open().execute('INSERT OR REPLACE INTO checksums (path, size, mtime, sha256) VALUES (?, ?, ?, ?)',
+                            (path, info.st_size, info.st_mtime, digest))
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+def checksumFiles(paths, cache, jobs=None):
+    """Returns a path -> SHA-256 digest dict for paths, and the number of files
+    that had to be hashed. Files that haven't changed since they were last
+    hashed come from cache; the rest are hashed across jobs threads, one per
+    core by default. Missing files are left out, as are files that can't be
+    read, with a message."""
+    digests = dict()
+    toHash = list()
+    for path in sorted(set(paths)):
+        try:
+            info = os.stat(path)
+        except OSError, errmsg:
+            if errmsg.errno != errno.ENOENT:
+                print >> sys.stderr, 'Warning: could not checksum %s: %s' % (path, errmsg.strerror)
+            continue
+        digest = cache.lookup(path, info)
+        if digest is None:
+            toHash.append((path, info))
+        else:
+            digests[path] = digest
+    def hashFile(item):
+        path, info = item
+        try:
+            return path, info, sha256File(path)
+        except (OSError, IOError, mmap.error), errmsg:
+            return path, info, errmsg
+    if toHash:
+        pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(toHash)))
+        try:
+            for path, info, digest in pool.imap_unordered(hashFile, toHash):
+                if isinstance(digest, Exception):
+                    print >> sys.stderr, 'Warning: could not checksum %s: %s' % (path, digest)
+                    continue
+                # the cache is only used from this thread
+                cache.store(path, info, digest)
+                digests[path] = digest
+        finally:
+            pool.close()
+            pool.join()
+        cache.commit()
+    return digests, len(toHash)
+
+
+# URL reachability
+
+# redirects followed before a URL counts as broken
+MAX_REDIRECTS = 5
+
+class HTTPConnectionPool(object):
+    """Idle keep-alive connections, kept per scheme, host and port so that
+    requests to the same repo server reuse them. Safe to share between threads."""
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        '''Returns (connection, reused) for scheme://netloc'''
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, connection):
+        '''Returns a connection whose last response has been read in full'''
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), list()).append(connection)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+def _request(pool, method, url):
+    '''Makes one request through pool, returns (status, Location header)'''
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ValueError('unsupported URL scheme %r' % parts.scheme)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    headers = dict()
+    if method == 'GET':
+        headers['Range'] = 'bytes=0-0'
+    while True:
+        connection, reused = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if reused:
+                # the server closed an idle connection; try a fresh one
+                continue
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.put(parts.scheme, parts.netloc, connection)
+        return response.status, response.getheader('location')
+
+def checkURL(url, pool):
+    """Returns (HTTP status, error message) for url, the message being None
+    if it's reachable. Sends HEAD, falling back to a one-byte ranged GET for
+    servers that don't allow HEAD, and follows redirects."""
+    try:
+        for redirect in range(MAX_REDIRECTS + 1):
+            status, location = _request(pool, 'HEAD', url)
+            if status in (403, 405, 501):
+                status, location = _request(pool, 'GET', url)
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status >= 400:
+                return status, 'HTTP %s' % status
+            return status, None
+        return status, 'more than %s redirects' % MAX_REDIRECTS
+    except (httplib.HTTPException, socket.error, ValueError), errmsg:
+        return None, str(errmsg) or errmsg.__class__.__name__
+
+class URLCheckCache(object):
+    """Results of check-urls, kept in a JSON file next to the plist so that
+    URLs checked within the last ttl seconds aren't requested again."""
+    def __init__(self, plistPath, ttl):
+        self.path = plistPath + '.urlcache'
+        self.ttl = ttl
+        self.results = dict()
+        try:
+            with open(self.path) as cacheFile:
+                self.results = json.load(cacheFile)
+        except (IOError, ValueError):
+            pass
+
+    def lookup(self, url):
+        '''Returns the cached (status, error) for url if it's fresh, or None'''
+        result = self.results.get(url)
+        if result is None or time.time() - result['checked'] > self.ttl:
+            return None
+        return result['status'], result['error']
+
+    def store(self, url, status, error):
+        self.results[url] = {'status': status, 'error': error, 'checked': time.time()}
+
+    def save(self):
+        '''Writes the cache, dropping expired results'''
+        now = time.time()
+        results = dict((url, result) for url, result in self.results.items()
+                       if now - result['checked'] <= self.ttl)
+        temporaryPath = self.path + '.tmp'
+        with open(temporaryPath, 'w') as cacheFile:
+            json.dump(results, cacheFile)
+        os.rename(temporaryPath, self.path)
+
+
+# Script store
+
+class ScriptStore(object):
+    """A content-addressed store of script contents: each distinct script is
+    kept once, in a file named by its SHA-256 under directory, and held in
+    memory as a single string shared by every component that uses it.
+    Script files are only read again when their size or mtime changes."""
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # digest -> the shared content string
+        self.contents = dict()
+        # script path -> [size, mtime, digest] when it was last read
+        self.sourcesPath = os.path.join(self.directory, 'sources.json')
+        try:
+            with open(self.sourcesPath) as sourcesFile:
+                self.sources = json.load(sourcesFile)
+        except (IOError, ValueError):
+            self.sources = dict()
+
+    def normalize(self, data):
+        '''Returns script bytes as str if they're ASCII, and unicode otherwise, as plists are read'''
+        try:
+            data.decode('ascii')
+            return data
+        except UnicodeError:
+            return data.decode('utf-8', 'replace')
+
+    def put(self, content):
+        '''Stores content, returns its digest and the shared string for it'''
+        data = content.encode('utf-8') if isinstance(content, unicode) else content
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.contents:
+            path = os.path.join(self.directory, digest)
+            if not os.path.exists(path):
+                temporaryPath = '%s.%s.tmp' % (path, os.getpid())
+                with open(temporaryPath, 'wb') as storeFile:
+                    storeFile.write(data)
+                os.rename(temporaryPath, path)
+            self.contents[digest] = self.normalize(data)
+        return digest, self.contents[digest]
+
+    def get(self, digest):
+        '''Returns the shared string for digest, raises IOError if it isn't stored'''
+        if digest not in self.contents:
+            with open(os.path.join(self.directory, os.path.basename(digest)), 'rb') as storeFile:
+                self.contents[digest] = self.normalize(storeFile.read())
+        return self.contents[digest]
+
+    def readScript(self, path):
+        '''Returns the digest and shared string for the script file at path'''
+        path = os.path.abspath(os.path.expanduser(path))
+        info = os.stat(path)
+        source = self.sources.get(path)
+        if source is not None and source[:2] == [info.st_size, info.st_mtime]:
+            try:
+                return source[2], self.get(source[2])
+            except IOError:
+                # removed from the store; read the script again
+                pass
+        with open(path, 'rb') as scriptFile:
+            digest, content = self.put(scriptFile.read())
+        self.sources[path] = [info.st_size, info.st_mtime, digest]
+        temporaryPath = '%s.%s.tmp' % (self.sourcesPath, os.getpid())
+        with open(temporaryPath, 'w') as sourcesFile:
+            json.dump(self.sources, sourcesFile)
+        os.rename(temporaryPath, self.sourcesPath)
+        return digest, content
+
+
+# Workflow templates
+
+class TemplateStore(object):
+    """Named workflow templates, kept in a plist next to the config rather
+    than in it: a dictionary of template names to workflows without names"""
+    def __init__(self, path):
+        self.path = path
+        # read the first time a template is used
+        self.templates = None
+
+    def load(self):
+        if self.templates is None:
+            if os.path.exists(self.path):
+                self.templates = plistlib.readPlist(self.path)
+            else:
+                self.templates = dict()
+        return self.templates
+
+    def names(self):
+        return sorted(self.load())
+
+    def get(self, name):
+        return self.load().get(name)
+
+    def put(self, name, template):
+        self.load()[name] = template
+        self.save()
+
+    def remove(self, name):
+        del self.load()[name]
+        self.save()
+
+    def save(self):
+        plistlib.writePlistStreaming(self.load(), self.path)
+
+
+# Output
+
+# how much subcommands print after a change: the whole workflow, one line, or nothing
+OUTPUT_MODES = ('full', 'summary', 'quiet')
+# the mode of --batch runs, unless --output-mode says otherwise
+BATCH_OUTPUT_MODE = 'summary'
+
+def projectFields(item, fields):
+    """Returns item with only the keys in fields, or item itself if fields is None"""
+    if fields is None:
+        return item
+    return dict((field, item[field]) for field in fields if field in item)
+
+def parseFields(value):
+    """argparse type for a comma-separated list of keys"""
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+def writeLines(lines, pager=False):
+    """Prints lines as they're produced, through $PAGER if pager is set and
+    stdout is a terminal. Stops quietly if the reader goes away, as when
+    the pager is quit or the output is piped to head."""
+    out = sys.stdout
+    process = None
+    if pager and sys.stdout.isatty():
+        process = subprocess.Popen(os.environ.get('PAGER') or 'less', shell=True, stdin=subprocess.PIPE)
+        out = process.stdin
+    try:
+        for line in lines:
+            print >> out, line
+        out.flush()
+    except IOError, errmsg:
+        if errmsg.errno != errno.EPIPE:
+            raise
+    finally:
+        if process is not None:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+            process.wait()
 
 
 # Imagr Config Plist class
 
+# stands in for a dictionary key that wasn't set, in undo records
+_MISSING = object()
+
 class ImagrConfigPlist():
     workflowComponentTypes = {  'image' : {'url':'http'}, 
                                 'package' : { 'url' : 'http', 'first_boot' : True },
@@ -31,22 +593,461 @@ class ImagrConfigPlist():
     
     def __init__(self, path):
         if os.path.exists(path):
-            self.internalPlist = plistlib.readPlist(path)
+            # workflows are only parsed when they're first used
+            with STATS.timing('(load)'):
+                self.internalPlist = plistlib.readPlistLazily(path, 'workflows')
         else:
             self.internalPlist = { 'password':'', 'workflows':[] }
         self.plistPath = path
+        # write binary plists instead of XML
+        self.binary = False
+        # name -> index map and cached name list, kept current by insertWorkflow/deleteWorkflow
+        self.workflowIndex = dict()
+        self.workflowNames = list()
+        self.rebuildWorkflowIndex()
+        # subcommand parsers are built on first use and then reused
+        self.parsers = dict()
+        self.workflowChoices = WorkflowChoices(self)
+        # undo history: each entry is (label, list of inverse operations),
+        # where an operation is a (method name, args) tuple
+        self.undoStack = list()
+        self.redoStack = list()
+        # inverses of the changes made by the subcommand that's running
+        self.pendingChange = list()
+        # the changes made since the journal last took them, encoded for it
+        # with journalValue; None when there is no journal
+        self.appliedChanges = None
+        # ComponentIndex, built the first time components are searched
+        self.componentIndex = None
+        # (URL prefix, directory) pairs for local mirrors of the repo
+        self.mirrors = list()
+        self.checksumCache = ChecksumCache(path + '.checksums')
+        # named workflow templates for clone-workflow
+        self.templates = TemplateStore(path + '.templates')
+        # objects told about changes, such as the tab completer; see notifyListeners
+        self.listeners = list()
+        # ScriptStore for script contents, and whether to save references to them
+        self.scriptStore = None
+        self.scriptRefs = False
+        # one of OUTPUT_MODES
+        self.outputMode = 'full'
     
     def synchronize(self):
         """Writes the current plist to disk"""
-        plistlib.writePlist(self.internalPlist, self.plistPath)
+        with STATS.timing('(synchronize)'):
+            if self.scriptRefs and self.scriptStore is not None:
+                plist = self.scriptRefsPlist()
+            else:
+                plist = self.internalPlist
+            plistlib.writePlistStreaming(plist, self.plistPath, self.binary)
     
+    def getParser(self, subcommand):
+        """Returns the argparse parser for a subcommand, building it the first time"""
+        parser = self.parsers.get(subcommand)
+        if parser is None:
+            parser = getattr(self, '_%s_parser' % subcommand)()
+            self.parsers[subcommand] = parser
+        return parser
+
+    def rebuildWorkflowIndex(self):
+        """Rebuilds the workflow name lookup from the workflow list"""
+        self.workflowIndex.clear()
+        # update in place so anyone holding the name list sees the change
+        workflows = self.internalPlist['workflows']
+        if hasattr(workflows, 'peek'):
+            # read the names without parsing the workflows
+            names = [workflows.peek(index, 'name') for index in range(len(workflows))]
+        else:
+            names = [workflow['name'] for workflow in workflows]
+        self.workflowNames[:] = [str(name) for name in names]
+        for index, name in enumerate(self.workflowNames):
+            # the first workflow with a given name wins, as with a linear search
+            self.workflowIndex.setdefault(name, index)
+
+    # Changes to the plist. Subcommands make every change through these, so
+    # each one keeps the name lookup current and records its own inverse.
+    # Component dictionaries can be shared between workflows (see
+    # cloneWorkflow), so a component is never changed in place: a changed
+    # copy replaces it through replaceComponent.
+    def insertWorkflow(self, index, workflow):
+        """Inserts a workflow (dict) at index, keeping the name lookup current"""
+        workflows = self.internalPlist['workflows']
+        if index >= len(workflows):
+            # appending doesn't move any other workflow
+            workflows.append(workflow)
+            self.workflowNames.append(str(workflow['name']))
+            self.workflowIndex.setdefault(self.workflowNames[-1], len(workflows) - 1)
+            index = len(workflows) - 1
+        else:
+            if index < 0:
+                # where list.insert will actually put it
+                index = max(index + len(workflows), 0)
+            workflows.insert(index, workflow)
+            self.rebuildWorkflowIndex()
+        self.recordChange(('insertWorkflow', (index, workflow)), ('deleteWorkflow', (index,)))
+        if self.componentIndex is not None:
+            self.componentIndex.addWorkflow(workflow)
+        self.notifyListeners('workflowAdded', workflow)
+
+    def deleteWorkflow(self, index):
+        """Deletes the workflow at index, keeping the name lookup current"""
+        workflows = self.internalPlist['workflows']
+        workflow = workflows[index]
+        if index < 0:
+            index += len(workflows)
+        del workflows[index]
+        self.recordChange(('deleteWorkflow', (index,)), ('insertWorkflow', (index, workflow)))
+        if self.componentIndex is not None:
+            self.componentIndex.removeWorkflow(workflow)
+        self.notifyListeners('workflowRemoved', workflow)
+        if index == len(workflows):
+            # the last workflow was removed, nothing else moved
+            name = self.workflowNames.pop()
+            if self.workflowIndex.get(name) == index:
+                del self.workflowIndex[name]
+        else:
+            self.rebuildWorkflowIndex()
+
+    def setWorkflowValue(self, key, field, value):
+        """Sets field of the workflow at index key to value"""
+        workflow = self.internalPlist['workflows'][key]
+        previous = workflow.get(field, _MISSING)
+        self.recordChange(('setWorkflowValue', (key, field, value)), ('setWorkflowValue', (key, field, previous)))
+        if value is _MISSING:
+            del workflow[field]
+        else:
+            workflow[field] = value
+        if field == 'name':
+            self.rebuildWorkflowIndex()
+            self.notifyListeners('workflowRenamed', previous, value)
+
+    def insertComponent(self, key, index, component):
+        """Inserts component at index in the component list of the workflow at index key"""
+        components = self.internalPlist['workflows'][key]['components']
+        # where list.insert will actually put it
+        if index < 0:
+            index = max(index + len(components), 0)
+        index = min(index, len(components))
+        components.insert(index, component)
+        self.recordChange(('insertComponent', (key, index, component)), ('deleteComponent', (key, index)))
+        if self.componentIndex is not None:
+            self.componentIndex.add(self.internalPlist['workflows'][key], component)
+        self.notifyListeners('componentAdded', component)
+
+    def deleteComponent(self, key, index):
+        """Deletes the component at index from the workflow at index key"""
+        components = self.internalPlist['workflows'][key]['components']
+        component = components[index]
+        if index < 0:
+            index += len(components)
+        del components[index]
+        self.recordChange(('deleteComponent', (key, index)), ('insertComponent', (key, index, component)))
+        if self.componentIndex is not None:
+            self.componentIndex.remove(self.internalPlist['workflows'][key], component)
+        self.notifyListeners('componentRemoved', component)
+
+    def replaceComponent(self, key, index, component):
+        """Replaces the component at index in the workflow at index key with component"""
+        workflow = self.internalPlist['workflows'][key]
+        components = workflow['components']
+        if index < 0:
+            index += len(components)
+        previous = components[index]
+        components[index] = component
+        self.recordChange(('replaceComponent', (key, index, component)), ('replaceComponent', (key, index, previous)))
+        if self.componentIndex is not None:
+            self.componentIndex.remove(workflow, previous)
+            self.componentIndex.add(workflow, component)
+        self.notifyListeners('componentRemoved', previous)
+        self.notifyListeners('componentAdded', component)
+
+    def setPassword(self, passwordHash):
+        """Sets the password hash"""
+        self.recordChange(('setPassword', (passwordHash,)), ('setPassword', (self.internalPlist.get('password'),)))
+        self.internalPlist['password'] = passwordHash
+
+    def setConfigValue(self, field, value):
+        """Sets a top-level field of the config other than workflows, or removes it if value is _MISSING"""
+        self.recordChange(('setConfigValue', (field, value)), ('setConfigValue', (field, self.internalPlist.get(field, _MISSING))))
+        if value is _MISSING:
+            del self.internalPlist[field]
+        else:
+            self.internalPlist[field] = value
+
+    def recordChange(self, change, inverse):
+        """Records a change made by one of the methods above as (method, args):
+        its inverse for undo, and the change itself for the journal"""
+        self.pendingChange.append(inverse)
+        if self.appliedChanges is not None:
+            # encoded now, since later changes can modify what args refer to
+            name, args = change
+            self.appliedChanges.append([name, [journalValue(arg) for arg in args]])
+
+    def takeAppliedChanges(self):
+        """Returns the changes recorded for the journal since the last call"""
+        changes = self.appliedChanges
+        self.appliedChanges = list()
+        return changes
+
+    def notifyListeners(self, event, *args):
+        """Calls event (workflowAdded, workflowRemoved, workflowRenamed,
+        componentAdded or componentRemoved) on every listener"""
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+    def endChange(self, label):
+        """Makes the changes since the last call one undoable step"""
+        if self.pendingChange:
+            self.undoStack.append((label, self.pendingChange))
+            self.pendingChange = list()
+            del self.redoStack[:]
+
+    def applyInverse(self, operations):
+        """Applies recorded inverse operations, returns the operations that reverse them"""
+        self.pendingChange = list()
+        for name, operationArgs in reversed(operations):
+            getattr(self, name)(*operationArgs)
+        inverse = self.pendingChange
+        self.pendingChange = list()
+        return inverse
+
+    def applyComponents(self, key, components):
+        """Changes the component list of the workflow at index key to match
+        components, inserting and deleting only where they differ by content.
+        Returns the numbers of components inserted and deleted."""
+        workflow = self.internalPlist['workflows'][key]
+        if 'components' not in workflow:
+            self.setWorkflowValue(key, 'components', list())
+        current = [contentHash(component) for component in workflow['components']]
+        wanted = [contentHash(component) for component in components]
+        matcher = difflib.SequenceMatcher(None, current, wanted, autojunk=False)
+        offset = inserted = deleted = 0
+        for tag, start, end, newStart, newEnd in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            for index in range(start, end):
+                self.deleteComponent(key, start + offset)
+            for position, component in enumerate(components[newStart:newEnd]):
+                self.insertComponent(key, start + offset + position, component)
+            offset += (newEnd - newStart) - (end - start)
+            inserted += newEnd - newStart
+            deleted += end - start
+        return inserted, deleted
+
+    def mergeWorkflow(self, key, base, theirs):
+        """Three-way merges the changes from the workflow base to the workflow
+        theirs into the workflow at index key, field by field. Returns the
+        lists of fields changed and of fields both sides changed differently."""
+        ours = self.internalPlist['workflows'][key]
+        changed, conflicts = list(), list()
+        for field in sorted(set(base).union(ours).union(theirs)):
+            baseValue = base.get(field, _MISSING)
+            ourValue = ours.get(field, _MISSING)
+            theirValue = theirs.get(field, _MISSING)
+            if field == 'components':
+                merged = mergeSequences(base.get(field, []), ours.get(field, []), theirs.get(field, []))
+                if merged is None:
+                    conflicts.append(field)
+                elif not _sameValue(merged, ours.get(field, [])):
+                    self.applyComponents(key, merged)
+                    changed.append(field)
+            elif _sameValue(theirValue, baseValue) or _sameValue(ourValue, theirValue):
+                continue
+            elif _sameValue(ourValue, baseValue):
+                self.setWorkflowValue(key, field, theirValue)
+                changed.append(field)
+            else:
+                conflicts.append(field)
+        return changed, conflicts
+
+    def mergeConfig(self, base, theirs):
+        """Three-way merges the changes between the configs base and theirs,
+        root dictionaries of plists, into this one. Workflows are matched by
+        name. Returns a list of the changes made and a list of conflicts,
+        changes that were left out because both sides changed the same thing."""
+        baseWorkflows, theirWorkflows = base['workflows'], theirs['workflows']
+        ourWorkflows = self.internalPlist['workflows']
+        baseNames, baseIndex = workflowNameIndex(baseWorkflows)
+        theirNames, theirIndex = workflowNameIndex(theirWorkflows)
+        changes, conflicts = list(), list()
+        for name, basePosition in sorted(baseIndex.items(), key=lambda item: item[1]):
+            theirPosition = theirIndex.get(name)
+            key = self.workflowIndex.get(name)
+            if theirPosition is not None and sameWorkflow(baseWorkflows, basePosition, theirWorkflows, theirPosition):
+                # unchanged in theirs
+                continue
+            if key is None:
+                if theirPosition is not None:
+                    conflicts.append("'%s' was removed here but changed in the other copy" % name)
+                continue
+            if theirPosition is None:
+                if sameWorkflow(baseWorkflows, basePosition, ourWorkflows, key):
+                    self.deleteWorkflow(key)
+                    changes.append("Removed '%s'" % name)
+                else:
+                    conflicts.append("'%s' was changed here but removed in the other copy" % name)
+                continue
+            changed, conflicted = self.mergeWorkflow(key, _parsedWorkflow(baseWorkflows, basePosition),
+                                                     _parsedWorkflow(theirWorkflows, theirPosition))
+            if changed:
+                changes.append("Changed %s of '%s'" % (', '.join(changed), name))
+            if conflicted:
+                conflicts.append("'%s': %s changed differently in both copies" % (name, ', '.join(conflicted)))
+        # workflows theirs moved go after the workflow they follow there, if
+        # ours left them where they were
+        common = set(baseIndex).intersection(theirIndex, self.workflowIndex)
+        baseOrder = workflowOrder(baseNames, baseIndex, common)
+        theirOrder = workflowOrder(theirNames, theirIndex, common)
+        ourOrder = workflowOrder(self.workflowNames, self.workflowIndex, common)
+        ourMoved = set(movedNames(baseOrder, ourOrder))
+        for name in movedNames(baseOrder, theirOrder):
+            anchor = theirOrder[theirOrder.index(name) - 1] if theirOrder.index(name) > 0 else None
+            if name in ourMoved:
+                ourAnchor = ourOrder[ourOrder.index(name) - 1] if ourOrder.index(name) > 0 else None
+                if ourAnchor != anchor:
+                    conflicts.append("'%s' was moved differently in both copies" % name)
+                continue
+            key = self.workflowIndex[name]
+            workflow = self.internalPlist['workflows'][key]
+            self.deleteWorkflow(key)
+            position = self.workflowIndex[anchor] + 1 if anchor is not None else 0
+            self.insertWorkflow(position, workflow)
+            changes.append("Moved '%s' to %s" % (name, position))
+        # workflows only theirs added go after the workflow they follow there
+        previous = None
+        for theirPosition, name in enumerate(theirNames):
+            if name is None or theirIndex[name] != theirPosition:
+                continue
+            if name in baseIndex or name in self.workflowIndex:
+                if name not in baseIndex and not sameWorkflow(ourWorkflows, self.workflowIndex[name],
+                                                              theirWorkflows, theirPosition):
+                    conflicts.append("'%s' was added to both copies with different contents" % name)
+                if name in self.workflowIndex:
+                    previous = name
+                continue
+            position = self.workflowIndex[previous] + 1 if previous is not None else 0
+            self.insertWorkflow(position, _parsedWorkflow(theirWorkflows, theirPosition))
+            changes.append("Added '%s' at %s" % (name, position))
+            previous = name
+        if not _sameValue(base.get('password', _MISSING), theirs.get('password', _MISSING)):
+            if _sameValue(base.get('password', _MISSING), self.internalPlist.get('password', _MISSING)):
+                self.setPassword(theirs.get('password', ''))
+                changes.append('Changed the password')
+            elif not _sameValue(self.internalPlist.get('password', _MISSING), theirs.get('password', _MISSING)):
+                conflicts.append('the password was changed differently in both copies')
+        return changes, conflicts
+
+    def localPath(self, url):
+        """Returns the path of the file url refers to in a local mirror, or
+        None if no mirror covers it. The longest matching prefix wins."""
+        for prefix, directory in sorted(self.mirrors, key=lambda mirror: -len(mirror[0])):
+            if url.startswith(prefix):
+                relative = urllib.unquote(url[len(prefix):].split('?', 1)[0].split('#', 1)[0])
+                path = os.path.normpath(os.path.join(directory, relative.lstrip('/')))
+                if path == directory or path.startswith(directory + os.sep):
+                    return path
+        return None
+
+    def addChecksum(self, component):
+        """Sets sha256 in a new component whose url is in a local mirror"""
+        path = self.localPath(component['url'])
+        if path is None:
+            return
+        digests, hashed = checksumFiles([path], self.checksumCache)
+        if path in digests:
+            component['sha256'] = digests[path]
+        else:
+            print >> sys.stderr, 'Warning: %s is not in the mirror at %s' % (component['url'], path)
+
+    def useScriptStore(self, scriptStore):
+        """Keeps script contents in scriptStore from now on, and replaces the
+        content_ref of script components saved with references by the content"""
+        self.scriptStore = scriptStore
+        workflows = self.internalPlist['workflows']
+        for index in range(len(workflows)):
+            item = list.__getitem__(workflows, index)
+            if hasattr(item, 'xml') and '<key>content_ref</key>' not in item.xml:
+                # leave workflows without references unparsed
+                continue
+            for component in workflows[index].get('components', []):
+                if component.get('type') == 'script' and 'content_ref' in component:
+                    try:
+                        component['content'] = scriptStore.get(component['content_ref'])
+                    except IOError:
+                        print >> sys.stderr, 'Warning: script %s is not in %s' % (component['content_ref'],
+                                                                                scriptStore.directory)
+                        continue
+                    del component['content_ref']
+
+    def withScriptRefs(self, workflow):
+        """Returns workflow with the content of its script components replaced
+        by a content_ref, copying only what changes"""
+        components = workflow.get('components', [])
+        if not any(component.get('type') == 'script' and 'content' in component for component in components):
+            return workflow
+        workflow = dict(workflow)
+        workflow['components'] = list()
+        for component in components:
+            if component.get('type') == 'script' and 'content' in component:
+                digest, content = self.scriptStore.put(component['content'])
+                component = dict((key, value) for key, value in component.items() if key != 'content')
+                component['content_ref'] = digest
+            workflow['components'].append(component)
+        return workflow
+
+    def scriptRefsPlist(self):
+        """Returns the plist as saved with script references: unparsed
+        workflows without scripts are passed through as they are"""
+        workflows = self.internalPlist['workflows']
+        if hasattr(workflows, 'peek'):
+            # a LazyPlistArray, so unparsed workflows are still written verbatim
+            saved = type(workflows)()
+        else:
+            saved = list()
+        for item in list.__getitem__(workflows, slice(None)):
+            if hasattr(item, 'xml'):
+                if '<key>content</key>' not in item.xml:
+                    list.append(saved, item)
+                    continue
+                item = item.parse()
+            list.append(saved, self.withScriptRefs(item))
+        plist = dict(self.internalPlist)
+        plist['workflows'] = saved
+        return plist
+
+    def findComponents(self, criteria):
+        """Returns (workflow index, component index, component) tuples for every
+        component whose indexed fields match all of criteria, a dict of
+        field -> value. Fields are those indexed by ComponentIndex."""
+        if self.componentIndex is None:
+            self.componentIndex = ComponentIndex()
+            for workflow in self.internalPlist['workflows']:
+                self.componentIndex.addWorkflow(workflow)
+        matches = None
+        for field, value in criteria.items():
+            found = dict(((id(workflow), id(component)), (workflow, component))
+                         for workflow, component in self.componentIndex.find(field, value))
+            if matches is None:
+                matches = found
+            else:
+                matches = dict((identity, match) for identity, match in matches.items() if identity in found)
+        results = list()
+        if matches:
+            # by identity, since names can repeat; unparsed workflows can't
+            # have matched, so list's own slicing is enough
+            positions = dict((id(workflow), index) for index, workflow in
+                             enumerate(list.__getitem__(self.internalPlist['workflows'], slice(None))))
+        for workflow, component in (matches or {}).values():
+            workflowIndex = positions[id(workflow)]
+            for componentIndex, candidate in enumerate(workflow['components']):
+                if candidate is component:
+                    results.append((workflowIndex, componentIndex, component))
+        results.sort(key=lambda result: result[:2])
+        return results
+
     def findWorkflowIndexByName(self, name):
         """Return the workflow index that matches a given name"""
-        index = 0
-        for workflow in self.internalPlist.get('workflows'):
-            if workflow.get('name') == name:
-                return index
-            index += 1
+        return self.workflowIndex.get(name)
     
     def findWorkflowNameByIndex(self, index):
         """Return the workflow name that matches a given index"""
@@ -54,9 +1055,11 @@ class ImagrConfigPlist():
 
     def replaceWorkflowByName(self, newWorkflow, name):
         """Replace the workflow (dict) that matches a given name with new workflow"""
-        for workflow in self.internalPlist.get('workflows'):
-            if workflow.get('name') == name:
-                workflow = newWorkflow
+        index = self.findWorkflowIndexByName(name)
+        if index is not None:
+            self.internalPlist['workflows'][index] = newWorkflow
+            if newWorkflow.get('name') != name:
+                self.rebuildWorkflowIndex()
     
     # Workflow-related functions that are not subcommands    
     def getWorkflowComponentTypes(self):
@@ -64,28 +1067,578 @@ class ImagrConfigPlist():
         return self.workflowComponentTypes.keys()
     
     def getWorkflowNames(self):
-        """Returns a list of names of workflows in the plist"""
-        nameList = list()
-        for workflow in self.internalPlist['workflows']:
-            nameList.append(str(workflow['name']))
-        return nameList
+        """Returns the cached list of names of workflows in the plist. Don't modify it."""
+        return self.workflowNames
     
+    # Library API. These return the workflows and components they change and
+    # raise ImagrConfigError instead of printing; the subcommands wrap them.
+    # Changes are recorded for undo like any other; call endChange(label) to
+    # make the changes since the last call one undoable step.
+    def workflowKey(self, workflow):
+        """Returns the index of workflow, given as a name or an index"""
+        count = len(self.internalPlist['workflows'])
+        if isinstance(workflow, (int, long)):
+            if 0 <= workflow < count:
+                return workflow
+        else:
+            # an index given as a string wins over a name, as on the command line
+            if workflow.isdigit() and int(workflow) < count:
+                return int(workflow)
+            if workflow in self.workflowIndex:
+                return self.workflowIndex[workflow]
+        raise ImagrConfigError('No workflow found at %s' % workflow)
+
+    def getWorkflow(self, workflow):
+        """Returns the workflow with a given name or index"""
+        return self.internalPlist['workflows'][self.workflowKey(workflow)]
+
+    def addWorkflow(self, name, index=None):
+        """Adds an empty workflow called name at index, or at the end, and returns it"""
+        if name in self.workflowIndex:
+            raise ImagrConfigError('name is already in use. Workflow names must be unique.')
+        if index is None:
+            index = len(self.internalPlist['workflows'])
+        workflow = self.newWorkflow(name)
+        self.insertWorkflow(index, workflow)
+        return workflow
+
+    def newWorkflow(self, name):
+        """Returns a workflow called name with the default settings and no components"""
+        workflow = dict()
+        workflow['name'] = name
+        workflow['description'] = ''
+        workflow['restart_action'] = 'none'
+        workflow['bless_target'] = False
+        workflow['components'] = list()
+        return workflow
+
+    def removeWorkflow(self, workflow):
+        """Removes the workflow with a given name or index and returns it"""
+        key = self.workflowKey(workflow)
+        removed = self.internalPlist['workflows'][key]
+        self.deleteWorkflow(key)
+        return removed
+
+    def setRestartAction(self, workflow, action='none'):
+        """Sets the restart action of workflow to restart, shutdown or none"""
+        if action not in ('restart', 'shutdown', 'none'):
+            raise ImagrConfigError('restart action must be restart, shutdown or none, not "%s"' % action)
+        key = self.workflowKey(workflow)
+        self.setWorkflowValue(key, 'restart_action', action)
+        return self.internalPlist['workflows'][key]
+
+    def setBlessTarget(self, workflow, bless=True):
+        """Sets whether workflow blesses its target volume"""
+        key = self.workflowKey(workflow)
+        self.setWorkflowValue(key, 'bless_target', bless)
+        return self.internalPlist['workflows'][key]
+
+    def setDescription(self, workflow, description):
+        """Sets the description of workflow"""
+        key = self.workflowKey(workflow)
+        self.setWorkflowValue(key, 'description', description)
+        return self.internalPlist['workflows'][key]
+
+    def newPassword(self, password):
+        """Sets the password to the hash of password"""
+        self.setPassword(hashlib.sha512(str(password)).hexdigest())
+
+    def addComponent(self, workflow, component, index=None):
+        """Adds component to workflow at index, or at the end, and returns it"""
+        key = self.workflowKey(workflow)
+        if 'components' not in self.internalPlist['workflows'][key]:
+            self.setWorkflowValue(key, 'components', list())
+        if index is None:
+            index = len(self.internalPlist['workflows'][key]['components'])
+        self.insertComponent(key, index, component)
+        return component
+
+    def addImage(self, workflow, url, index=None):
+        """Adds an Image task with url to workflow. Only one is allowed per workflow."""
+        # Check here to make sure we only have one image component per workflow
+        for component in self.getWorkflow(workflow).get('components', []):
+            if component.get('type') == 'image':
+                raise ImagrConfigError('only one image task allowed per workflow.', 21)
+        imageComponent = self.workflowComponentTypes['image'].copy()
+        imageComponent['url'] = url
+        imageComponent['type'] = 'image'
+        self.addChecksum(imageComponent)
+        return self.addComponent(workflow, imageComponent, index)
+
+    def addPackage(self, workflow, url, firstBoot=True, index=None):
+        """Adds a Package task with url to workflow, installed at first boot or live"""
+        self.workflowKey(workflow)
+        packageComponent = self.workflowComponentTypes['package'].copy()
+        packageComponent['url'] = url
+        packageComponent['first_boot'] = firstBoot
+        packageComponent['type'] = 'package'
+        self.addChecksum(packageComponent)
+        return self.addComponent(workflow, packageComponent, index)
+
+    def addComputerName(self, workflow, useSerial=False, auto=False, index=None):
+        """Adds a ComputerName task to workflow"""
+        computerNameComponent = self.workflowComponentTypes['computername'].copy()
+        computerNameComponent['use_serial'] = useSerial
+        computerNameComponent['auto'] = auto
+        computerNameComponent['type'] = 'computer_name'
+        return self.addComponent(workflow, computerNameComponent, index)
+
+    def addScript(self, workflow, content, firstBoot=True, index=None):
+        """Adds a Script task running content to workflow"""
+        self.workflowKey(workflow)
+        if self.scriptStore is not None:
+            digest, content = self.scriptStore.put(content)
+        scriptComponent = self.workflowComponentTypes['script'].copy()
+        scriptComponent['content'] = content
+        scriptComponent['first_boot'] = firstBoot
+        scriptComponent['type'] = 'script'
+        return self.addComponent(workflow, scriptComponent, index)
+
+    def addScriptFile(self, workflow, path, firstBoot=True, index=None):
+        """Adds a Script task running the script at path to workflow"""
+        self.workflowKey(workflow)
+        content = self.readScriptFile(path)
+        scriptComponent = self.workflowComponentTypes['script'].copy()
+        scriptComponent['content'] = content
+        scriptComponent['first_boot'] = firstBoot
+        scriptComponent['type'] = 'script'
+        return self.addComponent(workflow, scriptComponent, index)
+
+    def addErase(self, workflow, name='Macintosh HD', format='Journaled HFS+', index=None):
+        """Adds an eraseVolume task to workflow"""
+        eraseComponent = self.workflowComponentTypes['eraseVolume'].copy()
+        eraseComponent['name'] = name
+        eraseComponent['format'] = format
+        eraseComponent['type'] = 'eraseVolume'
+        return self.addComponent(workflow, eraseComponent, index)
+
+    def addPartition(self, workflow, partitions, target, map='GPTFormat', index=None):
+        """Adds a Partition task to workflow. partitions is a list of
+        (name, format, size) tuples, and target the name of one of them."""
+        if map not in ('GPTFormat', 'APMFormat', 'MBRFormat'):
+            raise ImagrConfigError('map must be GPTFormat, APMFormat or MBRFormat, not "%s"' % map)
+        partitionComponent = self.workflowComponentTypes['partition'].copy()
+        partitionComponent['map'] = map
+        partitionComponent['type'] = 'partition'
+        partitionList = list()
+        targetSet = False
+        for name, formatType, size in partitions:
+            thePartition = dict()
+            thePartition['name'] = name
+            thePartition['format_type'] = formatType
+            thePartition['size'] = size
+            if name == target:
+                thePartition['target'] = True
+                targetSet = True
+            partitionList.append(thePartition)
+        if not targetSet:
+            raise ImagrConfigError('target "%s" is not a valid partition target choice.' % target)
+        partitionComponent['partitions'] = partitionList
+        return self.addComponent(workflow, partitionComponent, index)
+
+    def removeComponent(self, workflow, index):
+        """Removes the component at index from workflow and returns it"""
+        key = self.workflowKey(workflow)
+        components = self.internalPlist['workflows'][key].get('components', [])
+        if not -len(components) <= index < len(components):
+            raise ImagrConfigError('No component %s in workflow %s' % (index, workflow))
+        removed = components[index]
+        self.deleteComponent(key, index)
+        return removed
+
+    def cloneWorkflow(self, workflow, name, index=None, description=None, restartAction=None,
+                      blessTarget=None, packages=(), firstBoot=True, replacePackages=False):
+        """Adds a copy of workflow called name, at index or at the end, and
+        returns it. The copy shares the component dictionaries of workflow,
+        which is safe because components are never changed in place (see
+        replaceComponent). description, restartAction and blessTarget override
+        the settings of workflow, replacePackages leaves out its packages, and
+        the URLs in packages are added as new packages."""
+        return self.instantiateWorkflow(self.getWorkflow(workflow), name, index, description, restartAction,
+                                        blessTarget, packages, firstBoot, replacePackages)
+
+    def addWorkflowFromTemplate(self, template, name, index=None, description=None, restartAction=None,
+                                blessTarget=None, packages=(), firstBoot=True, replacePackages=False):
+        """Adds a workflow called name made from the named template, like cloneWorkflow"""
+        base = self.templates.get(template)
+        if base is None:
+            raise ImagrConfigError('No template named %s' % template)
+        return self.instantiateWorkflow(base, name, index, description, restartAction,
+                                        blessTarget, packages, firstBoot, replacePackages)
+
+    def instantiateWorkflow(self, base, name, index, description, restartAction, blessTarget,
+                            packages, firstBoot, replacePackages):
+        """Adds a workflow called name with the settings and components of the
+        workflow or template base, see cloneWorkflow"""
+        if name in self.workflowIndex:
+            raise ImagrConfigError('name is already in use. Workflow names must be unique.')
+        if restartAction not in (None, 'restart', 'shutdown', 'none'):
+            raise ImagrConfigError('restart action must be restart, shutdown or none, not "%s"' % restartAction)
+        workflow = self.newWorkflow(name)
+        for field, value in base.items():
+            if field not in ('name', 'components'):
+                workflow[field] = value
+        if description is not None:
+            workflow['description'] = description
+        if restartAction is not None:
+            workflow['restart_action'] = restartAction
+        if blessTarget is not None:
+            workflow['bless_target'] = blessTarget
+        # the components themselves are shared, only the list is new
+        workflow['components'] = [component for component in base.get('components', [])
+                                  if not (replacePackages and component.get('type') == 'package')]
+        for url in packages:
+            packageComponent = self.workflowComponentTypes['package'].copy()
+            packageComponent['url'] = url
+            packageComponent['first_boot'] = firstBoot
+            packageComponent['type'] = 'package'
+            self.addChecksum(packageComponent)
+            workflow['components'].append(packageComponent)
+        if index is None:
+            index = len(self.internalPlist['workflows'])
+        self.insertWorkflow(index, workflow)
+        return workflow
+
+    def saveTemplate(self, name, workflow):
+        """Saves the settings and components of workflow as the template name, replacing any template by that name"""
+        template = dict((field, value) for field, value in self.getWorkflow(workflow).items() if field != 'name')
+        if 'components' in template:
+            template['components'] = list(template['components'])
+        self.templates.put(name, template)
+        return template
+
+    def removeTemplate(self, name):
+        """Removes the template name and returns it"""
+        template = self.templates.get(name)
+        if template is None:
+            raise ImagrConfigError('No template named %s' % name)
+        self.templates.remove(name)
+        return template
+
+    def readScriptFile(self, path):
+        """Returns the content of the script at path, shared through the script store if there is one"""
+        try:
+            if self.scriptStore is not None:
+                # a script that hasn't changed isn't read again, and its content is shared
+                digest, content = self.scriptStore.readScript(path)
+            else:
+                with open(os.path.expanduser(path)) as fileobject:
+                    content = fileobject.read()
+        except (OSError, IOError):
+            raise ImagrConfigError("Couldn't read %s" % path)
+        return content
+
+    def manifestComponent(self, record):
+        """Returns the component a manifest record describes, built from the
+        workflowComponentTypes template for its type"""
+        componentType = record['type']
+        template = self.workflowComponentTypes.get(COMPONENT_TYPE_ALIASES.get(componentType, componentType))
+        if template is None or componentType == 'computername':
+            raise ImagrConfigError('unknown component type %r' % componentType)
+        allowed = set(template).union(['target'] if componentType == 'partition' else [])
+        if componentType in ('image', 'package'):
+            allowed.add('sha256')
+        if componentType == 'script':
+            allowed.add('script')
+        given = [field for field in MANIFEST_COMPONENT_FIELDS if field in record and field != 'type']
+        unused = [field for field in given if field not in allowed]
+        if unused:
+            raise ImagrConfigError('%s components have no %s' % (componentType, ', '.join(unused)))
+        missing = [field for field in MANIFEST_REQUIRED_FIELDS.get(componentType, ()) if field not in record]
+        if componentType == 'script' and ('content' in record) == ('script' in record):
+            missing.append('content or script (but not both)')
+        if missing:
+            raise ImagrConfigError('%s components need %s' % (componentType, ', '.join(missing)))
+        component = dict(template)
+        component['type'] = componentType
+        try:
+            for field in given:
+                if field in MANIFEST_BOOLEAN_FIELDS:
+                    component[field] = parseBoolean(record[field])
+                elif field == 'partitions':
+                    component['partitions'] = parsePartitions(record['partitions'], record.get('target'))
+                elif field not in ('target', 'script'):
+                    component[field] = record[field]
+        except ValueError, errmsg:
+            raise ImagrConfigError('%s: %s' % (field, errmsg))
+        if componentType == 'script':
+            if 'script' in record:
+                component['content'] = self.readScriptFile(record['script'])
+            elif self.scriptStore is not None:
+                digest, component['content'] = self.scriptStore.put(component['content'])
+        if 'url' in component and 'sha256' not in component:
+            self.addChecksum(component)
+        return component
+
+    def importRecord(self, record, upsert, added, replacements):
+        """Applies one manifest record, after checking all of it. A record with
+        a workflow field adds a component or settings to that workflow; one
+        without is a whole workflow, as export writes. added is the set of
+        workflow names this import added, and replacements maps the indexes
+        of existing workflows to the component lists replacing theirs.
+        Returns the name of the workflow, or None if it is an existing one
+        whose settings didn't change, and the number of components added;
+        components replacing an existing workflow's are counted by importRecords."""
+        if not isinstance(record, dict):
+            raise ImagrConfigError('record is not a dictionary')
+        if record.keys() == ['$config']:
+            self.importConfigValues(record['$config'], upsert)
+            return None, 0
+        if 'workflow' not in record:
+            return self.importWorkflow(record, upsert, added, replacements)
+        name = record['workflow']
+        if not isinstance(name, basestring) or not name:
+            raise ImagrConfigError('workflow has no name')
+        unknown = sorted(field for field in record if field != 'workflow' and
+                         field not in MANIFEST_WORKFLOW_FIELDS and field not in MANIFEST_COMPONENT_FIELDS)
+        if unknown:
+            raise ImagrConfigError('unknown fields %s' % ', '.join(unknown))
+        settings = dict((field, record[field]) for field in MANIFEST_WORKFLOW_FIELDS if field in record)
+        if 'bless_target' in settings:
+            try:
+                settings['bless_target'] = parseBoolean(settings['bless_target'])
+            except ValueError, errmsg:
+                raise ImagrConfigError('bless_target: %s' % errmsg)
+        if settings.get('restart_action', 'none') not in ('restart', 'shutdown', 'none'):
+            raise ImagrConfigError('restart_action must be restart, shutdown or none, not %r' % settings['restart_action'])
+        component = None
+        if 'type' in record:
+            component = self.manifestComponent(record)
+            problems = validateWorkflow({'name': name, 'components': [component]})
+            if problems:
+                raise ImagrConfigError('; '.join(problems).replace('component 0', 'the component'))
+        elif [field for field in MANIFEST_COMPONENT_FIELDS if field in record]:
+            raise ImagrConfigError('component fields need a type')
+        key = self.workflowIndex.get(name)
+        if key is not None and name not in added and not upsert:
+            raise ImagrConfigError("workflow '%s' already exists, use --upsert to change it" % name)
+        if key is None:
+            components = list()
+        elif name in added:
+            components = self.internalPlist['workflows'][key]['components']
+        else:
+            # the manifest's components replace an existing workflow's, once it lists any
+            components = replacements.get(key, [])
+        if component is not None and component['type'] == 'image':
+            for other in components:
+                if other.get('type') == 'image':
+                    raise ImagrConfigError("only one image task allowed per workflow, '%s' already has one" % name)
+        # everything is checked, make the changes
+        if key is None:
+            workflow = self.newWorkflow(name)
+            workflow.update(settings)
+            if component is not None:
+                workflow['components'].append(component)
+            self.insertWorkflow(len(self.internalPlist['workflows']), workflow)
+            added.add(name)
+            return name, len(workflow['components'])
+        workflow = self.internalPlist['workflows'][key]
+        changed = name in added
+        for field, value in sorted(settings.items()):
+            if workflow.get(field, _MISSING) != value:
+                self.setWorkflowValue(key, field, value)
+                changed = True
+        if component is None:
+            return name if changed else None, 0
+        if name in added:
+            self.insertComponent(key, len(components), component)
+            return name, 1
+        replacements.setdefault(key, list()).append(component)
+        return name if changed else None, 0
+
+    def importWorkflow(self, workflow, upsert, added, replacements):
+        """Applies a manifest record that is a whole workflow, see importRecord.
+        It's imported as it is, so only its structure is checked."""
+        problems = list(checkWorkflowKeys(workflow))
+        if problems:
+            raise ImagrConfigError('; '.join(problems))
+        if not all(isinstance(component, dict) for component in workflow.get('components', [])):
+            raise ImagrConfigError('components must be dictionaries')
+        if any('content_ref' in component for component in workflow.get('components', [])
+               if component.get('type') == 'script'):
+            workflow = self.withScriptContent(workflow)
+        name = workflow['name']
+        key = self.workflowIndex.get(name)
+        if key is None:
+            workflow = dict(workflow)
+            if 'components' in workflow:
+                workflow['components'] = list(workflow['components'])
+            self.insertWorkflow(len(self.internalPlist['workflows']), workflow)
+            added.add(name)
+            return name, len(workflow.get('components', []))
+        if name in added or not upsert:
+            raise ImagrConfigError("workflow '%s' already exists%s" % (name, '' if name in added else ', use --upsert to change it'))
+        current = self.internalPlist['workflows'][key]
+        changed = False
+        for field in sorted(set(current).union(workflow)):
+            if field != 'components' and not _sameValue(current.get(field, _MISSING), workflow.get(field, _MISSING)):
+                self.setWorkflowValue(key, field, workflow.get(field, _MISSING))
+                changed = True
+        if 'components' not in workflow:
+            if 'components' in current:
+                self.setWorkflowValue(key, 'components', _MISSING)
+                changed = True
+            replacements.pop(key, None)
+            return name if changed else None, 0
+        replacements[key] = list(workflow['components'])
+        return name if changed else None, 0
+
+    def withScriptContent(self, workflow):
+        """Returns workflow with the content_ref of its scripts replaced by the content from the script store"""
+        if self.scriptStore is None:
+            raise ImagrConfigError('scripts exported without their content need --script-store to import')
+        workflow = dict(workflow)
+        components = list()
+        for component in workflow['components']:
+            if 'content_ref' in component and component.get('type') == 'script':
+                component = dict(component)
+                try:
+                    component['content'] = self.scriptStore.get(component.pop('content_ref'))
+                except (OSError, IOError):
+                    raise ImagrConfigError('script %s is not in the script store' % component.get('content_ref'))
+            components.append(component)
+        workflow['components'] = components
+        return workflow
+
+    def importConfigValues(self, values, upsert):
+        """Sets the top-level fields of the config from a manifest's $config
+        record. Fields that are already set differently are only changed with upsert."""
+        if not isinstance(values, dict) or 'workflows' in values:
+            raise ImagrConfigError('$config must be a dictionary of settings other than workflows')
+        changes = list()
+        for field, value in sorted(values.items()):
+            current = self.internalPlist.get(field, _MISSING)
+            if _sameValue(current, value):
+                continue
+            # a new config's password is empty
+            if current is not _MISSING and not (field == 'password' and current == '') and not upsert:
+                raise ImagrConfigError('%s is already set differently, use --upsert to change it' % field)
+            changes.append((field, value))
+        for field, value in changes:
+            self.setConfigValue(field, value)
+
+    def importRecords(self, records, upsert=False):
+        """Imports (row, record) pairs, such as readManifest yields. Each record
+        is checked and applied on its own, and one with problems is left out.
+        Existing workflows are only changed with upsert: their settings are
+        updated, and the components listed for them replace theirs. Returns
+        a dictionary of counts and a list of the problems with rows."""
+        counts = {'rows': 0, 'added': 0, 'updated': 0, 'components': 0}
+        errors = list()
+        added = set()
+        updated = set()
+        replacements = dict()
+        try:
+            for row, record in records:
+                counts['rows'] += 1
+                try:
+                    if isinstance(record, ImagrConfigError):
+                        raise record
+                    name, components = self.importRecord(record, upsert, added, replacements)
+                except ImagrConfigError, errmsg:
+                    errors.append('row %s: %s' % (row, errmsg))
+                    continue
+                counts['components'] += components
+                if name is not None and name not in added:
+                    updated.add(name)
+        finally:
+            # even if reading the records failed partway, the workflows
+            # updated so far get their components
+            for key, components in sorted(replacements.items()):
+                inserted, deleted = self.applyComponents(key, components)
+                counts['components'] += inserted
+                if inserted or deleted:
+                    updated.add(self.workflowNames[key])
+        counts['added'] = len(added)
+        counts['updated'] = len(updated)
+        return counts, errors
+
+    def workflowSummary(self, key):
+        """Returns a line naming the workflow at index key and its component types"""
+        components = self.internalPlist['workflows'][key].get('components', [])
+        return "%s: '%s' - %s components (%s)" % (key, self.workflowNames[key], len(components),
+                                                   ', '.join(str(component.get('type')) for component in components))
+
+    def echoWorkflow(self, workflow, mode=None, change=None):
+        """Prints the workflow with a given name or index, as the output mode
+        (self.outputMode by default) says: in full, as a summary line or not
+        at all. The summary line of a workflow a subcommand changed says what
+        change, a phrase such as 'added package URL', was made."""
+        key = self.workflowKey(workflow)
+        mode = mode or self.outputMode
+        if mode == 'full':
+            print "Workflow '%s':" % self.workflowNames[key]
+            pprint.pprint(self.internalPlist['workflows'][key])
+        elif mode == 'summary':
+            if change is None:
+                print self.workflowSummary(key)
+            else:
+                print "Workflow %s '%s': %s" % (key, self.workflowNames[key], change)
+
+    def workflowLines(self, pattern=None, componentType=None, fields=None, summary=False):
+        """Yields the display-workflows output one workflow at a time, for the
+        workflows whose names match the glob pattern and that have a component
+        of componentType. fields limits each workflow to those keys."""
+        if componentType is not None:
+            keys = sorted(set(result[0] for result in self.findComponents({'type': componentType})))
+        else:
+            keys = xrange(len(self.internalPlist['workflows']))
+        for key in keys:
+            # names are matched before the workflow is parsed
+            if pattern is not None and not fnmatch.fnmatchcase(self.workflowNames[key], pattern):
+                continue
+            if summary:
+                yield self.workflowSummary(key)
+            else:
+                yield '\n{0}:\n{1}'.format(key, projectFields(self.internalPlist['workflows'][key], fields))
+
+    def componentLines(self, workflow, componentType=None, fields=None):
+        """Yields the display-components output for workflow one component at a
+        time, for the components of componentType. fields limits each component to those keys."""
+        for i, component in enumerate(self.getWorkflow(workflow).get('components', [])):
+            if componentType is None or component.get('type') == componentType:
+                yield '{0}: {1}'.format(i, projectFields(component, fields))
+
     # Workflow subcommands
+    def _display_workflows_parser(self):
+        """Builds the parser for display-workflows"""
+        p = argparse.ArgumentParser(prog='display-workflows',
+                                    description='''display-workflows --name PATTERN --type TYPE --fields FIELDS --pager
+            Displays the workflows, or those whose names match PATTERN and that have a component of TYPE.
+            FIELDS limits each workflow to the given comma-separated keys. In summary output mode,
+            each workflow is shown as one line.''')
+        p.add_argument('--name',
+                    metavar='PATTERN',
+                    help='''shell-style pattern workflow names must match, e.g. "Lab*"''')
+        p.add_argument('--type',
+                    metavar='TYPE',
+                    help='''only show workflows with a component of this type''')
+        p.add_argument('--fields',
+                    metavar='FIELDS',
+                    help='''comma-separated keys to show, e.g. name,restart_action''',
+                    type=parseFields)
+        p.add_argument('--pager',
+                    help='''show the output through $PAGER''',
+                    action='store_true')
+        return p
+
     def display_workflows(self, args):
         """Displays a pretty-print list of workflows"""
-        #args is basically ignored
-        if len(args) != 0:
-            print >> sys.stderr, 'Usage: display-workflows'
+        p = self.getParser('display_workflows')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
             return 22 # Invalid argument
-        workflows = list()
-        for workflow in self.internalPlist.get('workflows'):
-            workflows.append(workflow)
-        for i, elem in enumerate(self.internalPlist['workflows']):
-            print '\n{0}:\n{1}'.format(i, elem)
+        except SystemExit:
+            return 22
+        writeLines(self.workflowLines(arguments.name, arguments.type, arguments.fields,
+                                      self.outputMode == 'summary' and arguments.fields is None),
+                   arguments.pager)
         return 0
     
-    def add_workflow(self, args):
-        """Adds a new workflow to the list of workflows at index. Index defaults to end of workflow list"""
+    def _add_workflow_parser(self):
+        """Builds the parser for add-workflow"""
         p = argparse.ArgumentParser(prog='add-workflow', 
                                     description='''add-workflow NAME --index INDEX
             Adds a new workflow with NAME to workflow list. If INDEX is specified,
@@ -96,7 +1649,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_workflow(self, args):
+        """Adds a new workflow to the list of workflows at index. Index defaults to end of workflow list"""
+        p = self.getParser('add_workflow')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -104,35 +1662,29 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        # validate that the name isn't being reused
-        for tempworkflow in self.internalPlist.get('workflows'):
-            if tempworkflow['name'] == arguments.name:
-                print >> sys.stderr, 'Error: name is already in use. Workflow names must be unique.'
-                return 22
-        if arguments.index == False: #this means one wasn't specified
-            index = len(self.internalPlist['workflows'])
-        else:
-            index = int(arguments.index)
-        workflow = dict()
-        workflow['name'] = arguments.name
-        workflow['description'] = ''
-        workflow['restart_action'] = 'none'
-        workflow['bless_target'] = False
-        workflow['components'] = list()
-        self.internalPlist['workflows'].insert(index, workflow)
-        self.show_workflow(args)
+        try:
+            self.addWorkflow(arguments.name, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(self.findWorkflowIndexByName(arguments.name), change='added')
         return 0
     
-    def remove_workflow(self, args):
-        """Removes workflow with given name or index from list"""
+    def _remove_workflow_parser(self):
+        """Builds the parser for remove-workflow"""
         p = argparse.ArgumentParser(prog='remove-workflow', 
                                     description='''remove-workflow WORKFLOW NAME OR INDEX
             Removes workflow WORKFLOW from workflow list.''')
         p.add_argument('workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     )
+        return p
+
+    def remove_workflow(self, args):
+        """Removes workflow with given name or index from list"""
+        p = self.getParser('remove_workflow')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -141,31 +1693,33 @@ class ImagrConfigPlist():
         except SystemExit:
             return 22
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-        try:
-            del self.internalPlist['workflows'][key]
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        print "Removed workflow '%s' from list." % arguments.workflow
-        print "Remaining workflows:"
-        pprint.pprint(self.getWorkflowNames())
+            self.removeWorkflow(arguments.workflow)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        if self.outputMode == 'full':
+            print "Removed workflow '%s' from list." % arguments.workflow
+            print "Remaining workflows:"
+            pprint.pprint(self.getWorkflowNames())
+        elif self.outputMode == 'summary':
+            print "Removed workflow '%s' from list, %s remaining." % (arguments.workflow, len(self.workflowNames))
         return 0
     
-    def show_workflow(self, args):
-        """Shows a workflow with a given name or index"""
+    def _show_workflow_parser(self):
+        """Builds the parser for show-workflow"""
         p = argparse.ArgumentParser(prog='show-workflow', 
                                     description='''show-workflow WORKFLOW NAME OR INDEX
             Displays the contents of WORKFLOW.''')
         p.add_argument('workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     )
+        return p
+
+    def show_workflow(self, args):
+        """Shows a workflow with a given name or index"""
+        p = self.getParser('show_workflow')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -174,20 +1728,269 @@ class ImagrConfigPlist():
         except SystemExit:
             return 22
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-        try:
-            print "Workflow '%s':" % arguments.workflow
-            pprint.pprint(self.internalPlist['workflows'][key])
-        except (IndexError, TypeError):
+            self.echoWorkflow(arguments.workflow, 'full')
+        except ImagrConfigError, errmsg:
             # If it gets here, no workflow by that name or index was found.
-            print >> sys.stderr, 'No workflow found at %s: ' % arguments.workflow
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        return 0
+    
+    # Clone and template subcommands
+    def _clone_workflow_parser(self):
+        """Builds the parser for clone-workflow"""
+        p = argparse.ArgumentParser(prog='clone-workflow',
+                                    description='''clone-workflow NAME --from WORKFLOW | --template TEMPLATE --index INDEX --desc DESCRIPTION
+                                    --restart RESTART --bless | --no-bless --no-packages --package URL --no-firstboot
+            Adds a new workflow NAME with the settings and components of WORKFLOW, or of the saved TEMPLATE.
+            --desc, --restart and --bless or --no-bless change its settings. --no-packages leaves out the
+            packages of WORKFLOW, and each --package URL adds a package at first boot, or 'live' with --no-firstboot.
+            If INDEX is specified, workflow is added at that INDEX, otherwise added to end of list.''')
+        p.add_argument('name',
+                    metavar='NAME',
+                    help='''quoted name of new workflow''')
+        source = p.add_mutually_exclusive_group(required=True)
+        source.add_argument('--from',
+                    metavar='WORKFLOW NAME OR INDEX',
+                    dest='workflow',
+                    help='''quoted name or index number of the workflow to copy''',
+                    choices=self.workflowChoices)
+        source.add_argument('--template',
+                    metavar='TEMPLATE',
+                    help='''name of the template to use''')
+        p.add_argument('--index',
+                    metavar='INDEX',
+                    help='''where in the workflow list the workflow will go - defaults to end of list''',
+                    type=int)
+        p.add_argument('--desc',
+                    metavar='DESCRIPTION',
+                    help='''description for workflow''')
+        p.add_argument('--restart',
+                    metavar='RESTART',
+                    help='''restart action to use: restart, shutdown, or none''',
+                    choices=['restart', 'shutdown', 'none'])
+        bless = p.add_mutually_exclusive_group()
+        bless.add_argument('--bless',
+                    help='''sets bless_target value to True''',
+                    action='store_const',
+                    const=True)
+        bless.add_argument('--no-bless',
+                    help='''sets bless_target value to False''',
+                    dest='bless',
+                    action='store_const',
+                    const=False)
+        p.add_argument('--no-packages',
+                    help='''leave out the package components of WORKFLOW or TEMPLATE''',
+                    action='store_true')
+        p.add_argument('--package',
+                    metavar='URL',
+                    help='''URL of a package to add - can be repeated''',
+                    action='append',
+                    default=[])
+        p.add_argument('--no-firstboot',
+                    help='''sets first_boot value for the added packages to False''',
+                    action='store_false')
+        return p
+
+    def clone_workflow(self, args):
+        """Adds a copy of a workflow or template with some settings and packages changed"""
+        p = self.getParser('clone_workflow')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        overrides = dict(index=arguments.index, description=arguments.desc, restartAction=arguments.restart,
+                         blessTarget=arguments.bless, packages=arguments.package,
+                         firstBoot=arguments.no_firstboot, replacePackages=arguments.no_packages)
+        try:
+            if arguments.template is not None:
+                self.addWorkflowFromTemplate(arguments.template, arguments.name, **overrides)
+            else:
+                self.cloneWorkflow(arguments.workflow, arguments.name, **overrides)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        if arguments.template is not None:
+            change = 'made from template %s' % arguments.template
+        else:
+            change = 'copied from %s' % arguments.workflow
+        self.echoWorkflow(self.findWorkflowIndexByName(arguments.name), change=change)
+        return 0
+
+    def _save_template_parser(self):
+        """Builds the parser for save-template"""
+        p = argparse.ArgumentParser(prog='save-template',
+                                    description='''save-template NAME --workflow WORKFLOW
+            Saves the settings and components of WORKFLOW as the template NAME, for clone-workflow --template.
+            Templates are kept next to the plist, in a file ending in .templates, and are saved straight away.''')
+        p.add_argument('name',
+                    metavar='NAME',
+                    help='''name of the template''')
+        p.add_argument('--workflow',
+                    metavar='WORKFLOW NAME OR INDEX',
+                    help='''quoted name or index number of target workflow''',
+                    choices=self.workflowChoices,
+                    required = True)
+        return p
+
+    def save_template(self, args):
+        """Saves a workflow as a template"""
+        p = self.getParser('save_template')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
             return 22
+        try:
+            self.saveTemplate(arguments.name, arguments.workflow)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        if self.outputMode != 'quiet':
+            print "Saved template '%s'." % arguments.name
+        return 0
+
+    def _remove_template_parser(self):
+        """Builds the parser for remove-template"""
+        p = argparse.ArgumentParser(prog='remove-template',
+                                    description='''remove-template NAME
+            Removes the template NAME.''')
+        p.add_argument('name',
+                    metavar='NAME',
+                    help='''name of the template''')
+        return p
+
+    def remove_template(self, args):
+        """Removes a template"""
+        p = self.getParser('remove_template')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        try:
+            self.removeTemplate(arguments.name)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        if self.outputMode != 'quiet':
+            print "Removed template '%s'." % arguments.name
+        return 0
+
+    def display_templates(self, args):
+        """Displays the templates and their component types"""
+        if len(args) != 0:
+            print >> sys.stderr, 'Usage: display-templates'
+            return 22 # Invalid argument
+        for name in self.templates.names():
+            components = self.templates.get(name).get('components', [])
+            print "'%s' - %s components (%s)" % (name, len(components),
+                                                 ', '.join(str(component.get('type')) for component in components))
         return 0
     
+    # Output subcommands
+    def _set_output_parser(self):
+        """Builds the parser for set-output"""
+        p = argparse.ArgumentParser(prog='set-output',
+                                    description='''set-output MODE
+            Sets what is printed after each change: full prints the whole workflow, summary prints
+            one line per workflow, quiet prints nothing. Without MODE, prints the current mode.''')
+        p.add_argument('mode',
+                    metavar='MODE',
+                    help='''full, summary or quiet''',
+                    choices=OUTPUT_MODES,
+                    nargs='?')
+        return p
+
+    def set_output(self, args):
+        """Sets the output mode"""
+        p = self.getParser('set_output')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        if arguments.mode is None:
+            print self.outputMode
+        else:
+            self.outputMode = arguments.mode
+        return 0
+
+    # Undo subcommands
+    def _undo_parser(self):
+        """Builds the parser for undo"""
+        p = argparse.ArgumentParser(prog='undo',
+                                    description='''undo COUNT
+            Undoes the last COUNT changes. COUNT defaults to 1.''')
+        p.add_argument('count',
+                    metavar='COUNT',
+                    help='''number of changes to undo - defaults to 1''',
+                    type=int,
+                    nargs='?',
+                    default=1)
+        return p
+
+    def undo(self, args):
+        """Undoes the last changes"""
+        p = self.getParser('undo')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        for i in range(arguments.count):
+            if not self.undoStack:
+                print >> sys.stderr, 'Nothing left to undo.'
+                return 22
+            label, operations = self.undoStack.pop()
+            self.redoStack.append((label, self.applyInverse(operations)))
+            if self.outputMode != 'quiet':
+                print "Undid '%s'" % label
+        return 0
+
+    def _redo_parser(self):
+        """Builds the parser for redo"""
+        p = argparse.ArgumentParser(prog='redo',
+                                    description='''redo COUNT
+            Redoes the last COUNT undone changes. COUNT defaults to 1.''')
+        p.add_argument('count',
+                    metavar='COUNT',
+                    help='''number of changes to redo - defaults to 1''',
+                    type=int,
+                    nargs='?',
+                    default=1)
+        return p
+
+    def redo(self, args):
+        """Redoes the last undone changes"""
+        p = self.getParser('redo')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        for i in range(arguments.count):
+            if not self.redoStack:
+                print >> sys.stderr, 'Nothing left to redo.'
+                return 22
+            label, operations = self.redoStack.pop()
+            self.undoStack.append((label, self.applyInverse(operations)))
+            if self.outputMode != 'quiet':
+                print "Redid '%s'" % label
+        return 0
+
     # Password subcommands
     def show_password(self, args):
         """Returns the password hash"""
@@ -198,14 +2001,19 @@ class ImagrConfigPlist():
         print self.internalPlist.get('password')
         return 0
     
-    def new_password(self, args):
-        """Sets a new password"""
+    def _new_password_parser(self):
+        """Builds the parser for new-password"""
         p = argparse.ArgumentParser(prog='new-password', 
                                     description='''new-password PASSWORD
             Sets a new PASSWORD to configuration plist.''')
         p.add_argument('password',
                     metavar='PASSWORD',
                     help='''new password''')
+        return p
+
+    def new_password(self, args):
+        """Sets a new password"""
+        p = self.getParser('new_password')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -213,26 +2021,32 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        self.internalPlist['password'] = hashlib.sha512(str(arguments.password)).hexdigest()
-        self.show_password([])
+        self.newPassword(arguments.password)
+        if self.outputMode != 'quiet':
+            self.show_password([])
         return 0
     
     # RestartAction subcommands
-    def set_restart_action(self, args):
-        """Sets a restart action for the given workflow"""
+    def _set_restart_action_parser(self):
+        """Builds the parser for set-restart-action"""
         p = argparse.ArgumentParser(prog='set-restart-action', 
                                     description='''set-restart-action --workflow WORKFLOW --restart RESTART
             Sets a restart action for WORKFLOW to RESTART. If --restart is not specified, it defaults to \'none\'.''')
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--restart',
                     metavar='RESTART',
                     help='''restart action to use: restart, shutdown, or none''',
                     choices=['restart', 'shutdown', 'none'],
                     default = 'none')
+        return p
+
+    def set_restart_action(self, args):
+        """Sets a restart action for the given workflow"""
+        p = self.getParser('set_restart_action')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -241,35 +2055,33 @@ class ImagrConfigPlist():
         except SystemExit:
             return 22
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
-        try:
-            self.internalPlist['workflows'][key]['restart_action'] = arguments.restart
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.setRestartAction(key, arguments.restart)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='restart action set to %s' % arguments.restart)
         return 0
     
     # Bless subcommands
-    def set_bless_target(self, args):
-        """Sets bless to True or False for the given workflow"""
+    def _set_bless_target_parser(self):
+        """Builds the parser for set-bless-target"""
         p = argparse.ArgumentParser(prog='set-bless-target', 
                                     description='''set-bless-target --workflow WORKFLOW --no-bless
             Sets the bless_target option for WORKFLOW to False. By default, bless is true.''')
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--no-bless',
                     help='''sets bless_target value to False''',
                     action='store_false')
+        return p
+
+    def set_bless_target(self, args):
+        """Sets bless to True or False for the given workflow"""
+        p = self.getParser('set_bless_target')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -278,36 +2090,34 @@ class ImagrConfigPlist():
         except SystemExit:
             return 22
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
-        try:
-            self.internalPlist['workflows'][key]['bless_target'] = arguments.no_bless
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.setBlessTarget(key, arguments.no_bless)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='bless target set to %s' % arguments.no_bless)
         return 0
     
     # Description subcommands
-    def set_description(self, args):
-        """Sets description for the given workflow"""
+    def _set_description_parser(self):
+        """Builds the parser for set-description"""
         p = argparse.ArgumentParser(prog='set-description', 
                                     description='''set-description --workflow WORKFLOW --desc DESCRIPTION
             Sets the description for WORKFLOW to DESCRIPTION.''')
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--desc',
                     metavar='DESCRIPTION',
                     help='''description for workflow''',
                     required = True)
+        return p
+
+    def set_description(self, args):
+        """Sets description for the given workflow"""
+        p = self.getParser('set_description')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -316,32 +2126,411 @@ class ImagrConfigPlist():
         except SystemExit:
             return 22
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
-        try:
-            self.internalPlist['workflows'][key]['description'] = arguments.desc
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.setDescription(key, arguments.desc)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='description set')
         return 0
     
     # Component subcommands
-    def display_components(self, args):
-        """Displays a list of components for a given workflow"""
+    def _display_components_parser(self):
+        """Builds the parser for display-components"""
         p = argparse.ArgumentParser(prog='display-components', 
-                                    description='''display-components WORKFLOW NAME OR INDEX
-            Displays the components of WORKFLOW.''')
+                                    description='''display-components WORKFLOW NAME OR INDEX --type TYPE --fields FIELDS --pager
+            Displays the components of WORKFLOW, or those of TYPE. FIELDS limits each component to the given comma-separated keys.''')
         p.add_argument('workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     )
+        p.add_argument('--type',
+                    metavar='TYPE',
+                    help='''only show components of this type''')
+        p.add_argument('--fields',
+                    metavar='FIELDS',
+                    help='''comma-separated keys to show, e.g. type,url''',
+                    type=parseFields)
+        p.add_argument('--pager',
+                    help='''show the output through $PAGER''',
+                    action='store_true')
+        return p
+
+    def display_components(self, args):
+        """Displays a list of components for a given workflow"""
+        p = self.getParser('display_components')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        try:
+            lines = self.componentLines(arguments.workflow, arguments.type, arguments.fields)
+            # look the workflow up now, so a missing one is reported before any output
+            self.workflowKey(arguments.workflow)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        writeLines(lines, arguments.pager)
+        return 0
+    
+    def _remove_component_parser(self):
+        """Builds the parser for remove-component"""
+        p = argparse.ArgumentParser(prog='remove-component', 
+                                    description='''remove-component --workflow WORKFLOW NAME OR INDEX --component INDEX
+            Remove the component at INDEX from WORKFLOW.''')
+        p.add_argument('--workflow',
+                    metavar='WORKFLOW NAME OR INDEX',
+                    help='''quoted name or index number of target workflow''',
+                    choices=self.workflowChoices,
+                    required=True)
+        p.add_argument('--component',
+                    metavar='INDEX',
+                    help='''index of component from list''',
+                    type=int,
+                    required=True)
+        return p
+
+    def remove_component(self, args):
+        """Removes a component at index from workflow"""
+        p = self.getParser('remove_component')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        try:
+            self.removeComponent(arguments.workflow, arguments.component)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        return 0
+    
+    def _find_parser(self):
+        """Builds the parser for find"""
+        p = argparse.ArgumentParser(prog='find',
+                                    description='''find --url URL --type TYPE --first-boot TRUE/FALSE --format-type FORMAT
+            Lists the workflows and component indexes of components that match all of the given values.''')
+        p.add_argument('--url',
+                    metavar='URL',
+                    help='''URL of an image or package''')
+        p.add_argument('--type',
+                    metavar='TYPE',
+                    help='''component type, e.g. image, package, script, computer_name, eraseVolume or partition''')
+        p.add_argument('--first-boot',
+                    metavar='TRUE/FALSE',
+                    help='''first_boot value of a package or script''',
+                    choices=['true', 'false'])
+        p.add_argument('--format-type',
+                    metavar='FORMAT',
+                    help='''format_type of one of the partitions of a partition component''')
+        return p
+
+    def find(self, args):
+        """Lists components matching a URL, type, first_boot or partition format"""
+        p = self.getParser('find')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        criteria = dict()
+        if arguments.url is not None:
+            criteria['url'] = arguments.url
+        if arguments.type is not None:
+            criteria['type'] = arguments.type
+        if arguments.first_boot is not None:
+            criteria['first_boot'] = arguments.first_boot == 'true'
+        if arguments.format_type is not None:
+            criteria['format_type'] = arguments.format_type
+        if not criteria:
+            print >> sys.stderr, 'Error: give at least one of --url, --type, --first-boot or --format-type.'
+            return 22
+        results = self.findComponents(criteria)
+        if self.outputMode == 'quiet':
+            return 0
+        for workflowIndex, componentIndex, component in results:
+            print "{0}: '{1}' component {2}: {3}".format(workflowIndex, self.findWorkflowNameByIndex(workflowIndex),
+                                                       componentIndex, component.get('url', component.get('type')))
+        print '%s matching components.' % len(results)
+        return 0
+
+    def _rewrite_urls_parser(self):
+        """Builds the parser for rewrite-urls"""
+        p = argparse.ArgumentParser(prog='rewrite-urls',
+                                    description='''rewrite-urls --prefix OLD NEW | --regex PATTERN REPLACEMENT --dry-run
+            Rewrites the URLs of the components of every workflow.''')
+        group = p.add_mutually_exclusive_group(required=True)
+        group.add_argument('--prefix',
+                    metavar=('OLD', 'NEW'),
+                    help='''replace URLs starting with OLD so they start with NEW instead''',
+                    nargs=2)
+        group.add_argument('--regex',
+                    metavar=('PATTERN', 'REPLACEMENT'),
+                    help='''replace matches of the regular expression PATTERN with REPLACEMENT, which may use \\1 style group references''',
+                    nargs=2)
+        p.add_argument('--dry-run',
+                    help='''show the changes without making them''',
+                    action='store_true')
+        return p
+
+    def rewrite_urls(self, args):
+        """Rewrites component URLs in every workflow by prefix or regular expression"""
+        p = self.getParser('rewrite_urls')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        if arguments.prefix:
+            old, new = arguments.prefix
+            def rewrite(url):
+                if url.startswith(old):
+                    return new + url[len(old):]
+                return url
+        else:
+            try:
+                pattern = re.compile(arguments.regex[0])
+            except re.error, errmsg:
+                print >> sys.stderr, 'Error: bad regular expression: %s' % errmsg
+                return 22
+            def rewrite(url):
+                return pattern.sub(arguments.regex[1], url)
+        # work out every new URL before changing anything, so a bad
+        # replacement leaves the plist as it was
+        changes = list()
+        try:
+            for key, workflow in enumerate(self.internalPlist['workflows']):
+                for index, component in enumerate(workflow.get('components', [])):
+                    url = component.get('url')
+                    if not isinstance(url, basestring):
+                        continue
+                    newURL = rewrite(url)
+                    if newURL != url:
+                        changes.append((key, index, component, newURL))
+        except (re.error, IndexError), errmsg:
+            print >> sys.stderr, 'Error: bad replacement: %s' % errmsg
+            return 22
+        if arguments.dry_run:
+            if self.outputMode == 'quiet':
+                return 0
+            for key, index, component, newURL in changes:
+                print "{0}: '{1}' component {2}:".format(key, self.workflowNames[key], index)
+                print '- %s' % component['url']
+                print '+ %s' % newURL
+            print '%s components would be changed.' % len(changes)
+            return 0
+        for key, index, component, newURL in changes:
+            # components can be shared, so change a copy rather than the original
+            newComponent = component.copy()
+            newComponent['url'] = newURL
+            self.replaceComponent(key, index, newComponent)
+        if self.outputMode != 'quiet':
+            print '%s components changed.' % len(changes)
+        return 0
+
+    def _diff_parser(self):
+        """Builds the parser for diff"""
+        p = argparse.ArgumentParser(prog='diff',
+                                    description='''diff PLIST
+            Lists the subcommands that would turn this plist into PLIST, in a form --batch can run.''')
+        p.add_argument('other',
+                    metavar='PLIST',
+                    help='''path to the plist to compare with''')
+        return p
+
+    def diff(self, args):
+        """Prints the subcommands that turn this plist into another"""
+        p = self.getParser('diff')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        other = readConfig(arguments.other)
+        if other is None:
+            return 22
+        lines = diffConfigs(self.internalPlist, other)
+        for line in lines:
+            print line
+        print '# %s differences.' % len([line for line in lines if not line.startswith('#')])
+        return 0
+
+    def _merge_parser(self):
+        """Builds the parser for merge"""
+        p = argparse.ArgumentParser(prog='merge',
+                                    description='''merge BASE OTHER
+            Applies the changes made between BASE and OTHER to this plist, where BASE is the copy
+            both this plist and OTHER were edited from. Changes to a setting or component list
+            that was also changed here are reported as conflicts and left out.''')
+        p.add_argument('base',
+                    metavar='BASE',
+                    help='''path to the plist both copies started from''')
+        p.add_argument('other',
+                    metavar='OTHER',
+                    help='''path to the other edited copy''')
+        return p
+
+    def merge(self, args):
+        """Three-way merges the changes from another copy of the plist"""
+        p = self.getParser('merge')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        base = readConfig(arguments.base)
+        other = readConfig(arguments.other)
+        if base is None or other is None:
+            return 22
+        changes, conflicts = self.mergeConfig(base, other)
+        for change in changes:
+            print change
+        for conflict in conflicts:
+            print >> sys.stderr, 'Conflict: %s' % conflict
+        print '%s changes merged, %s conflicts.' % (len(changes), len(conflicts))
+        if conflicts:
+            return 1
+        return 0
+
+    def _import_manifest_parser(self):
+        """Builds the parser for import-manifest"""
+        p = argparse.ArgumentParser(prog='import-manifest',
+                                    description='''import-manifest PATH --format FORMAT --upsert
+            Adds the workflows and components listed in the manifest at PATH, a CSV, JSON lines, JSON or YAML file.
+            Each record names a workflow and can set its settings and add one component. Records with problems are
+            reported and left out. Existing workflows are only changed with --upsert, and then the components listed
+            for them replace theirs.''')
+        p.add_argument('path',
+                    metavar='PATH',
+                    help='''path to the manifest''')
+        p.add_argument('--format',
+                    metavar='FORMAT',
+                    help='''csv, jsonl, json or yaml - defaults to the one the file extension says''',
+                    choices=['csv', 'jsonl', 'json', 'yaml'])
+        p.add_argument('--upsert',
+                    help='''update workflows that already exist instead of reporting them''',
+                    action='store_true')
+        return p
+
+    def import_manifest(self, args):
+        """Imports workflows and components from a manifest"""
+        p = self.getParser('import_manifest')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        try:
+            counts, errors = self.importRecords(readManifest(arguments.path, arguments.format), arguments.upsert)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        for error in errors:
+            print >> sys.stderr, 'Error: %s' % error
+        if self.outputMode != 'quiet':
+            print 'Read %(rows)s rows: added %(added)s workflows, updated %(updated)s, added %(components)s components.' % counts
+        if errors:
+            print >> sys.stderr, '%s rows had problems and were left out.' % len(errors)
+            return 1
+        return 0
+
+    def _export_parser(self):
+        """Builds the parser for export"""
+        p = argparse.ArgumentParser(prog='export',
+                                    description='''export PATH --format FORMAT --fields FIELDS --no-script-content --jobs N
+            Writes the config to PATH (- for standard output) as JSON lines, one workflow per line, or as a JSON
+            document that import-manifest can read back into the same plist.''')
+        p.add_argument('path',
+                    metavar='PATH',
+                    help='''where to write the export, or - for standard output''')
+        p.add_argument('--format',
+                    metavar='FORMAT',
+                    help='''json or jsonl - defaults to json for a .json PATH and jsonl otherwise''',
+                    choices=['json', 'jsonl'])
+        p.add_argument('--fields',
+                    metavar='FIELDS',
+                    help='''comma-separated workflow keys to export, e.g. name,components''',
+                    type=parseFields)
+        p.add_argument('--no-script-content',
+                    help='''export scripts as a content_ref, the SHA-256 of their content, instead of the content''',
+                    action='store_true')
+        p.add_argument('--jobs',
+                    metavar='N',
+                    help='''number of processes to convert large configs with - defaults to one per core''',
+                    type=int)
+        return p
+
+    def export(self, args):
+        """Exports the config to JSON or JSON lines"""
+        p = self.getParser('export')
+        try:
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
+            return 22
+        format = arguments.format
+        if format is None:
+            format = 'json' if arguments.path.lower().endswith('.json') else 'jsonl'
+        lines = exportLines(self.internalPlist, format, arguments.fields,
+                            not arguments.no_script_content, arguments.jobs)
+        if arguments.path == '-':
+            writeLines(lines)
+            return 0
+        path = os.path.expanduser(arguments.path)
+        # written next to the destination and renamed into place, as plists are saved
+        temporaryPath = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(temporaryPath, 'w') as exportFile:
+                for line in lines:
+                    exportFile.write(line + '\n')
+            os.rename(temporaryPath, path)
+        except (OSError, IOError), errmsg:
+            print >> sys.stderr, "Error: Couldn't write %s: %s" % (arguments.path, errmsg.strerror)
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            return 22
+        if self.outputMode != 'quiet':
+            print 'Exported %s workflows to %s.' % (len(self.internalPlist['workflows']), arguments.path)
+        return 0
+
+    def _update_checksums_parser(self):
+        """Builds the parser for update-checksums"""
+        p = argparse.ArgumentParser(prog='update-checksums',
+                                    description='''update-checksums --mirror URL_PREFIX=DIRECTORY --jobs N
+            Sets the sha256 of every component whose URL is in a local mirror of the repo.''')
+        p.add_argument('--mirror',
+                    metavar='URL_PREFIX=DIRECTORY',
+                    help='''URLs starting with URL_PREFIX are files under DIRECTORY - adds to the --mirror options given at startup''',
+                    type=parseMirror,
+                    action='append',
+                    default=[])
+        p.add_argument('--jobs',
+                    metavar='N',
+                    help='''number of files to hash at once - defaults to one per core''',
+                    type=int)
+        return p
+
+    def update_checksums(self, args):
+        """Sets sha256 for components whose URLs map to files in a local mirror"""
+        p = self.getParser('update_checksums')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -349,35 +2538,65 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-        try:
-            for i, elem in enumerate(self.internalPlist['workflows'][key]['components']):
-                print '{0}: {1}'.format(i, elem)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
+        for mirror in arguments.mirror:
+            if mirror not in self.mirrors:
+                self.mirrors.append(mirror)
+        if not self.mirrors:
+            print >> sys.stderr, 'Error: no mirrors given. Use --mirror URL_PREFIX=DIRECTORY.'
             return 22
+        found = list()
+        for key, workflow in enumerate(self.internalPlist['workflows']):
+            for index, component in enumerate(workflow.get('components', [])):
+                if isinstance(component.get('url'), basestring):
+                    path = self.localPath(component['url'])
+                    if path is not None:
+                        found.append((key, index, component, path))
+        digests, hashed = checksumFiles([path for key, index, component, path in found],
+                                        self.checksumCache, arguments.jobs)
+        updated = 0
+        for key, index, component, path in found:
+            digest = digests.get(path)
+            if digest is None or component.get('sha256') == digest:
+                continue
+            # components can be shared, so change a copy rather than the original
+            newComponent = component.copy()
+            newComponent['sha256'] = digest
+            self.replaceComponent(key, index, newComponent)
+            updated += 1
+        missing = len(set(path for key, index, component, path in found).difference(digests))
+        if self.outputMode != 'quiet':
+            print '%s components in mirrors, %s files hashed, %s files missing, %s components updated.' % (
+                len(found), hashed, missing, updated)
         return 0
-    
-    def remove_component(self, args):
-        """Removes a component at index from workflow"""
-        p = argparse.ArgumentParser(prog='remove-component', 
-                                    description='''remove-component --workflow WORKFLOW NAME OR INDEX --component INDEX
-            Remove the component at INDEX from WORKFLOW.''')
-        p.add_argument('--workflow',
-                    metavar='WORKFLOW NAME OR INDEX',
-                    help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
-                    required=True)
-        p.add_argument('--component',
-                    metavar='INDEX',
-                    help='''index of component from list''',
+
+    def _check_urls_parser(self):
+        """Builds the parser for check-urls"""
+        p = argparse.ArgumentParser(prog='check-urls',
+                                    description='''check-urls --jobs N --timeout SECONDS --ttl SECONDS --refresh
+            Checks that the URL of every component can be downloaded and lists the ones that can't.''')
+        p.add_argument('--jobs',
+                    metavar='N',
+                    help='''number of requests to make at once - defaults to 16''',
                     type=int,
-                    required=True)
+                    default=16)
+        p.add_argument('--timeout',
+                    metavar='SECONDS',
+                    help='''how long to wait for a server - defaults to 10 seconds''',
+                    type=float,
+                    default=10.0)
+        p.add_argument('--ttl',
+                    metavar='SECONDS',
+                    help='''how long results are reused for before a URL is checked again - defaults to 3600 seconds''',
+                    type=float,
+                    default=3600.0)
+        p.add_argument('--refresh',
+                    help='''check every URL again, ignoring earlier results''',
+                    action='store_true')
+        return p
+
+    def check_urls(self, args):
+        """Checks every component URL concurrently and lists broken ones"""
+        p = self.getParser('check_urls')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -385,21 +2604,77 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
+        if arguments.jobs < 1:
+            print >> sys.stderr, 'Error: --jobs must be at least 1.'
+            return 22
+        # URL -> list of (workflow index, component index) using it
+        uses = dict()
+        for key, workflow in enumerate(self.internalPlist['workflows']):
+            for index, component in enumerate(workflow.get('components', [])):
+                if isinstance(component.get('url'), basestring):
+                    uses.setdefault(component['url'], list()).append((key, index))
+        cache = URLCheckCache(self.plistPath, arguments.ttl)
+        results = dict()
+        toCheck = list()
+        for url in uses:
+            cached = None if arguments.refresh else cache.lookup(url)
+            if cached is None:
+                toCheck.append(url)
+            else:
+                results[url] = cached
+        if toCheck:
+            connections = HTTPConnectionPool(arguments.timeout)
+            workers = ThreadPool(min(arguments.jobs, len(toCheck)))
+            try:
+                for url, result in workers.imap_unordered(lambda url: (url, checkURL(url, connections)), toCheck):
+                    results[url] = result
+                    cache.store(url, *result)
+            finally:
+                workers.close()
+                workers.join()
+                connections.close()
+            cache.save()
+        broken = sorted(url for url, (status, error) in results.items() if error is not None)
+        if self.outputMode != 'quiet':
+            for url in broken:
+                print '%s: %s' % (url, results[url][1])
+                for key, index in uses[url]:
+                    print "\t{0}: '{1}' component {2}".format(key, self.workflowNames[key], index)
+            print '%s URLs, %s checked, %s broken.' % (len(uses), len(toCheck), len(broken))
+        if broken:
+            return 1
+        return 0
+
+    def _validate_parser(self):
+        """Builds the parser for validate"""
+        p = argparse.ArgumentParser(prog='validate',
+                                    description='''validate --jobs N
+            Checks every workflow in the plist and lists the problems found.''')
+        p.add_argument('--jobs',
+                    metavar='N',
+                    help='''number of processes to check a large plist with - defaults to one per core''',
+                    type=int)
+        return p
+
+    def validate(self, args):
+        """Checks the whole plist for problems"""
+        p = self.getParser('validate')
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-        try:
-            del self.internalPlist['workflows'][key]['components'][arguments.component]
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
+            arguments = p.parse_args(args)
+        except argparse.ArgumentError, errmsg:
+            print >> sys.stderr, str(errmsg)
+            return 22 # Invalid argument
+        except SystemExit:
             return 22
+        problems = validateConfig(self.internalPlist, arguments.jobs)
+        printValidationProblems(problems)
+        print '%s problems found.' % len(problems)
+        if problems:
+            return 1
         return 0
-    
-    def add_image_component(self, args):
-        """Adds an Image task at index with URL for a workflow. If no index is specified, defaults to end"""
+
+    def _add_image_component_parser(self):
+        """Builds the parser for add-image-component"""
         p = argparse.ArgumentParser(prog='add-image-component', 
                                     description='''add-image-component --workflow WORKFLOW --url URL --index INDEX
             Adds an Image task to the component list of the WORKFLOW from URL. If INDEX is specified,
@@ -407,7 +2682,7 @@ class ImagrConfigPlist():
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--url',
                     metavar='URL',
@@ -416,7 +2691,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_image_component(self, args):
+        """Adds an Image task at index with URL for a workflow. If no index is specified, defaults to end"""
+        p = self.getParser('add_image_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -424,36 +2704,17 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        imageComponent = self.workflowComponentTypes['image'].copy()
-        imageComponent['url'] = arguments.url
-        imageComponent['type'] = 'image'
         try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
-        try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
-            else:
-                index = int(arguments.index)
-            # Check here to make sure we only have one image component per workflow
-            for component in self.internalPlist['workflows'][key]['components']:
-                if component.get('type') == 'image':
-                    print >> sys.stderr, 'Error: only one image task allowed per workflow.'
-                    return 21
-            self.internalPlist['workflows'][key]['components'].insert(index, imageComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.addImage(key, arguments.url, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added image %s' % arguments.url)
         return 0
     
-    def add_package_component(self, args):
-        """Adds a Package task at index with URL, first_boot for workflow"""
+    def _add_package_component_parser(self):
+        """Builds the parser for add-package-component"""
         p = argparse.ArgumentParser(prog='add-package-component',
                                     description='''add-package-component --workflow WORKFLOW --url URL --no-firstboot --index INDEX
             Adds a Package task to the component list of the WORKFLOW from URL at first boot. If --no-firstboot is specified, the package is installed 'live' instead.
@@ -461,7 +2722,7 @@ class ImagrConfigPlist():
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--url',
                     metavar='URL',
@@ -473,7 +2734,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_package_component(self, args):
+        """Adds a Package task at index with URL, first_boot for workflow"""
+        p = self.getParser('add_package_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -481,32 +2747,17 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        packageComponent = self.workflowComponentTypes['package'].copy()
-        packageComponent['url'] = arguments.url
-        packageComponent['first_boot'] = arguments.no_firstboot
-        packageComponent['type'] = 'package'
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
         try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
-            else:
-                index = int(arguments.index)
-            self.internalPlist['workflows'][key]['components'].insert(index, packageComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.addPackage(key, arguments.url, arguments.no_firstboot, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added package %s' % arguments.url)
         return 0
     
-    def add_computername_component(self, args):
-        """Adds a ComputerName task at index with use_serial and auto for workflow"""
+    def _add_computername_component_parser(self):
+        """Builds the parser for add-computername-component"""
         p = argparse.ArgumentParser(prog='add-computername-component',
                                     description='''add-computername-component --workflow WORKFLOW --use-serial --auto --index INDEX
             Adds a ComputerName task to the component list of the WORKFLOW. If --user-serial is specified, the computer's serial number is chosen as default.
@@ -515,7 +2766,7 @@ class ImagrConfigPlist():
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--use-serial',
                     help='''use the computer's serial number as the default name''',
@@ -526,7 +2777,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_computername_component(self, args):
+        """Adds a ComputerName task at index with use_serial and auto for workflow"""
+        p = self.getParser('add_computername_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -534,53 +2790,47 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        computerNameComponent = self.workflowComponentTypes['computername'].copy()
-        computerNameComponent['use_serial'] = arguments.use_serial
-        computerNameComponent['auto'] = arguments.auto
-        computerNameComponent['type'] = 'computer_name'
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
         try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
-            else:
-                index = int(arguments.index)
-            self.internalPlist['workflows'][key]['components'].insert(index, computerNameComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.addComputerName(key, arguments.use_serial, arguments.auto, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added computer name component')
         return 0
     
-    def add_script_component(self, args):
-        """Adds a Script component at index with content for workflow"""
+    def _add_script_component_parser(self):
+        """Builds the parser for add-script-component"""
         p = argparse.ArgumentParser(prog='add-script-component',
-                                    description='''add-script-component --workflow WORKFLOW --content CONTENT --no-firstboot --index INDEX
+                                    description='''add-script-component --workflow WORKFLOW --content CONTENT | --inline-content SCRIPT --no-firstboot --index INDEX
             Adds a Script task to the component list of the WORKFLOW at first boot. CONTENT must be a path to a file.
+            SCRIPT is the script itself, with backslash escapes such as \\n for newlines.
             If --no-firstboot is specified, the package is installed 'live' instead of at first boot.
             If INDEX is specified, task is added at that INDEX, otherwise added to end of list.''')
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
-        p.add_argument('--content',
+        content = p.add_mutually_exclusive_group(required=True)
+        content.add_argument('--content',
                     metavar='CONTENT',
-                    help='''path to a file containing a script''',
-                    required = True)
+                    help='''path to a file containing a script''')
+        content.add_argument('--inline-content',
+                    metavar='SCRIPT',
+                    help='''the script itself, with newlines written as \\n''')
         p.add_argument('--no-firstboot',
                     help='''sets first_boot value for package to False''',
                     action='store_false')
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_script_component(self, args):
+        """Adds a Script component at index with content for workflow"""
+        p = self.getParser('add_script_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -588,38 +2838,30 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
+        if arguments.inline_content is not None:
+            try:
+                data = arguments.inline_content.decode('string_escape')
+            except ValueError, errmsg:
+                print >> sys.stderr, 'Error: bad escape in script: %s' % errmsg
+                return 22
+            try:
+                data.decode('ascii')
+            except UnicodeError:
+                data = data.decode('utf-8', 'replace')
         try:
-            fileobject = open(os.path.expanduser(arguments.content), mode='r', buffering=1)
-            data = fileobject.read()
-            fileobject.close()
-        except (OSError, IOError):
-            print >> sys.stderr, "Error: Couldn't read %s" % arguments.content
-            return 22 #Invalid argument
-        scriptComponent['content'] = data
-        scriptComponent['first_boot'] = arguments.no_firstboot
-        scriptComponent['type'] = 'script'
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
-        try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
+            key = self.workflowKey(arguments.workflow)
+            if arguments.inline_content is not None:
+                self.addScript(key, data, arguments.no_firstboot, arguments.index)
             else:
-                index = int(arguments.index)
-            self.internalPlist['workflows'][key]['components'].insert(index, scriptComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+                self.addScriptFile(key, arguments.content, arguments.no_firstboot, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added script component')
         return 0
 
-    def add_erase_component(self, args):
-        """Adds an eraseVolume component at index with content for workflow"""
+    def _add_erase_component_parser(self):
+        """Builds the parser for add-erase-component"""
         p = argparse.ArgumentParser(prog='add-erase-component',
                                     description='''add-erase-component --workflow WORKFLOW --name NAME --format FORMAT --index INDEX
             Adds an eraseVolume task to the component list of the WORKFLOW. 
@@ -629,7 +2871,7 @@ class ImagrConfigPlist():
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--name',
                     metavar='NAME',
@@ -642,7 +2884,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_erase_component(self, args):
+        """Adds an eraseVolume component at index with content for workflow"""
+        p = self.getParser('add_erase_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -650,32 +2897,17 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        eraseComponent = self.workflowComponentTypes['eraseVolume'].copy()
-        eraseComponent['name'] = arguments.name
-        eraseComponent['format'] = arguments.format
-        eraseComponent['type'] = 'eraseVolume'
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
         try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
-            else:
-                index = int(arguments.index)
-            self.internalPlist['workflows'][key]['components'].insert(index, eraseComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.addErase(key, arguments.name, arguments.format, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added erase component')
         return 0
 
-    def add_partition_component(self, args):
-        """Adds a Partition component at index with content for workflow"""
+    def _add_partition_component_parser(self):
+        """Builds the parser for add-partition-component"""
         p = argparse.ArgumentParser(prog='add-erase-component',
                                     description='''add-partition-component --workflow WORKFLOW --map MAP --names NAMES --formats FORMATS --sizes SIZES --target NAME --index INDEX
             Adds a Partition task to the component list of the WORKFLOW. 
@@ -685,7 +2917,7 @@ class ImagrConfigPlist():
         p.add_argument('--workflow',
                     metavar='WORKFLOW NAME OR INDEX',
                     help='''quoted name or index number of target workflow''',
-                    choices=self.getWorkflowNames() + [str(s) for s in range(len(self.internalPlist['workflows']))],
+                    choices=self.workflowChoices,
                     required = True)
         p.add_argument('--map',
                     metavar='MAP',
@@ -714,7 +2946,12 @@ class ImagrConfigPlist():
         p.add_argument('--index',
                     metavar='INDEX',
                     help='''where in the component list the task will go - defaults to end of list''',
-                    default = False)
+                    type=int)
+        return p
+
+    def add_partition_component(self, args):
+        """Adds a Partition component at index with content for workflow"""
+        p = self.getParser('add_partition_component')
         try:
             arguments = p.parse_args(args)
         except argparse.ArgumentError, errmsg:
@@ -722,85 +2959,952 @@ class ImagrConfigPlist():
             return 22 # Invalid argument
         except SystemExit:
             return 22
-        partitionComponent = self.workflowComponentTypes['partition'].copy()
-        partitionComponent['map'] = arguments.map
-        partitionComponent['type'] = 'partition'
-        partitionList = list()
-        thePartition = dict()
-        targetSet = False
-        for i in range(0,len(arguments.names)):
-            thePartition = dict()
-            thePartition['name'] = arguments.names[i]
-            thePartition['format_type'] = arguments.formats[i]
-            thePartition['size'] = arguments.sizes[i]
-            if arguments.names[i] == arguments.target:
-                thePartition['target'] = True
-                targetSet = True
-            partitionList.append(thePartition)
-        if not targetSet:
-            print >> sys.stderr, 'Error: target "%s" is not a valid partition target choice.' % arguments.target
+        if not len(arguments.names) == len(arguments.formats) == len(arguments.sizes):
+            print >> sys.stderr, 'Error: --names, --formats and --sizes must list the same number of volumes.'
             return 22
-        partitionComponent['partitions'] = partitionList
-        try:
-            key = int(arguments.workflow)
-            # If an index is provided, it can be cast to an int
-            name = self.findWorkflowNameByIndex(key)
-        except ValueError:
-            # A name was provided that can't be cast to an int
-            key = self.findWorkflowIndexByName(arguments.workflow)
-            name = [ arguments.workflow ]
         try:
-            if arguments.index == False: #this means one wasn't specified
-                index = len(self.internalPlist['workflows'][key]['components'])
-            else:
-                index = int(arguments.index)
-            self.internalPlist['workflows'][key]['components'].insert(index, partitionComponent)
-        except (IndexError, TypeError):
-            print >> sys.stderr, 'Error: No workflow found at %s' % arguments.workflow
-            return 22
-        self.show_workflow(name)
+            key = self.workflowKey(arguments.workflow)
+            self.addPartition(key, zip(arguments.names, arguments.formats, arguments.sizes),
+                              arguments.target, arguments.map, arguments.index)
+        except ImagrConfigError, errmsg:
+            print >> sys.stderr, 'Error: %s' % errmsg
+            return errmsg.errno
+        self.echoWorkflow(key, change='added partition component')
         return 0
 
 
-# Generic helper functions for autocomplete, stolen from Munki manifestutil
+# Whole-config validation
+
+# component types are stored in the plist under these names instead of
+# their workflowComponentTypes key
+COMPONENT_TYPE_ALIASES = { 'computer_name' : 'computername' }
+
+# keys Imagr needs in each component type; it has defaults for the rest of
+# the workflowComponentTypes template, such as an eraseVolume's name and format
+REQUIRED_COMPONENT_KEYS = { 'image' : frozenset(['url']),
+                            'package' : frozenset(['url']),
+                            'computername' : frozenset(),
+                            'script' : frozenset(['content']),
+                            'eraseVolume' : frozenset(),
+                            'partition' : frozenset(['partitions']) }
+for alias, componentType in COMPONENT_TYPE_ALIASES.items():
+    REQUIRED_COMPONENT_KEYS[alias] = REQUIRED_COMPONENT_KEYS[componentType]
+
+# diskutil sizes: a number with an optional unit or a percentage (R, the remainder, is handled separately)
+PARTITION_SIZE = re.compile(r'^(\d+(?:\.\d+)?)\s*(%|[BSKMGTPE])?$', re.IGNORECASE)
+
+# configs with fewer workflows than this are validated in this process
+PARALLEL_VALIDATION_THRESHOLD = 2000
 
-def tab_completer(text, state):
-    """Called by the readline lib to calculate possible completions"""
-    array_to_match = None
-    if readline.get_begidx() == 0:
-        # since we are at the start of the line
-        # we are matching commands
-        array_to_match = 'cmds'
-        match_list = CMD_ARG_DICT.get('cmds', {}).keys()
+def checkWorkflowKeys(workflow):
+    '''Yields problems with a workflow's name and component list'''
+    if not isinstance(workflow.get('name'), basestring) or not workflow.get('name'):
+        yield 'workflow has no name'
+    if not isinstance(workflow.get('components', []), list):
+        yield 'components is not a list'
+
+def checkImageCount(workflow):
+    '''Yields a problem if a workflow has more than one image component'''
+    images = [str(index) for index, component in enumerate(workflow.get('components', []))
+              if isinstance(component, dict) and component.get('type') == 'image']
+    if len(images) > 1:
+        yield 'only one image component is allowed, found %s (components %s)' % (len(images), ', '.join(images))
+
+def checkComponentTypes(workflow):
+    '''Yields problems with unknown component types and missing keys'''
+    for index, component in enumerate(workflow.get('components', [])):
+        if not isinstance(component, dict):
+            yield 'component %s is not a dictionary' % index
+            continue
+        requiredKeys = REQUIRED_COMPONENT_KEYS.get(component.get('type'))
+        if requiredKeys is None:
+            yield 'component %s has unknown type %r' % (index, component.get('type'))
+            continue
+        missing = sorted(requiredKeys.difference(component))
+        if component['type'] == 'script' and 'content_ref' in component and 'content' in missing:
+            # saved with --script-refs
+            missing.remove('content')
+        if missing:
+            yield 'component %s (%s) is missing %s' % (index, component['type'], ', '.join(missing))
+
+def checkPartitions(workflow):
+    '''Yields problems with the targets and sizes of partition components'''
+    for index, component in enumerate(workflow.get('components', [])):
+        if not isinstance(component, dict) or component.get('type') != 'partition':
+            continue
+        partitions = component.get('partitions')
+        if not isinstance(partitions, list):
+            continue
+        targets = [partition for partition in partitions
+                   if isinstance(partition, dict) and partition.get('target')]
+        if len(targets) != 1:
+            yield 'component %s (partition) has %s target partitions, expected 1' % (index, len(targets))
+        percentage = 0.0
+        allPercentages = True
+        remainders = 0
+        for partition in partitions:
+            size = str(partition.get('size', '')).strip() if isinstance(partition, dict) else ''
+            if size.upper() == 'R':
+                remainders += 1
+                allPercentages = False
+                continue
+            match = PARTITION_SIZE.match(size)
+            if match is None:
+                yield 'component %s (partition) has unrecognized size %r' % (index, size)
+                allPercentages = False
+            elif match.group(2) == '%':
+                percentage += float(match.group(1))
+            else:
+                allPercentages = False
+        if remainders > 1:
+            yield 'component %s (partition) uses the remainder (R) %s times' % (index, remainders)
+        if percentage > 100:
+            yield 'component %s (partition) sizes add up to %g%%, more than 100%%' % (index, percentage)
+        elif allPercentages and partitions and percentage != 100:
+            yield 'component %s (partition) sizes add up to %g%%, not 100%%' % (index, percentage)
+
+# rules run against each workflow on its own
+WORKFLOW_RULES = [checkWorkflowKeys, checkImageCount, checkComponentTypes, checkPartitions]
+
+def validateWorkflow(workflow):
+    '''Returns a list of problems with a single workflow'''
+    if not isinstance(workflow, dict):
+        return ['workflow is not a dictionary']
+    problems = list()
+    for rule in WORKFLOW_RULES:
+        problems.extend(rule(workflow))
+    return problems
+
+def _validateWorkflows(items):
+    '''Validates (index, workflow) pairs, returns (index, name, problem) tuples.
+    Runs in pool workers, so workflows may still be unparsed RawPlistValues.'''
+    results = list()
+    for index, workflow in items:
+        if hasattr(workflow, 'parse'):
+            workflow = workflow.parse()
+        name = workflow.get('name') if isinstance(workflow, dict) else None
+        for problem in validateWorkflow(workflow):
+            results.append((index, name, problem))
+    return results
+
+def validateConfig(config, processes=None):
+    """Checks a whole config (the root dictionary of a plist) and returns a
+    list of (workflow index, workflow name, problem) tuples, sorted by
+    workflow. Problems with the config as a whole have an index of None.
+    Large configs are checked across a pool of processes worker processes,
+    one per core by default; processes=1 checks them in this process."""
+    if not isinstance(config.get('workflows'), list):
+        return [(None, None, 'workflows is missing or not a list')]
+    workflows = config['workflows']
+    problems = list()
+    if hasattr(workflows, 'peek'):
+        # read names without parsing the workflows in this process
+        names = [workflows.peek(index, 'name') for index in range(len(workflows))]
     else:
-        # we are matching args
-        cmd_line = readline.get_line_buffer()[0:readline.get_begidx()]
-        cmd = shlex.split(cmd_line)[-1]
-        array_to_match = CMD_ARG_DICT.get('cmds', {}).get(cmd)
-        if array_to_match:
-            match_list = CMD_ARG_DICT[array_to_match]
+        names = [workflow.get('name') if isinstance(workflow, dict) else None for workflow in workflows]
+    seen = dict()
+    for index, name in enumerate(names):
+        if name is not None and name in seen:
+            problems.append((index, name, 'name is already used by workflow %s' % seen[name]))
         else:
-            array_to_match = CMD_ARG_DICT.get('options', {}).get(cmd)
-            if array_to_match:
-                match_list = CMD_ARG_DICT[array_to_match]
-            else:
-                array_to_match = 'options'
-                match_list = CMD_ARG_DICT.get('options',{}).keys()
+            seen.setdefault(name, index)
+
+    # list's own slicing leaves unparsed workflows for the workers to parse
+    items = list(enumerate(list.__getitem__(workflows, slice(None))))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1 and len(items) >= PARALLEL_VALIDATION_THRESHOLD:
+        chunkSize = max(1, len(items) // (processes * 4))
+        chunks = [items[start:start + chunkSize] for start in range(0, len(items), chunkSize)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for results in pool.map(_validateWorkflows, chunks):
+                problems.extend(results)
+        finally:
+            pool.terminate()
+    else:
+        problems.extend(_validateWorkflows(items))
+    problems.sort(key=lambda problem: -1 if problem[0] is None else problem[0])
+    return problems
+
+def _validateFile(path, processes=1):
+    '''Reads and validates one plist, returns (path, problems). Runs in pool workers.'''
+    try:
+        config = plistlib.readPlistLazily(path, 'workflows')
+    except Exception, errmsg:
+        return path, [(None, None, 'could not read plist: %s' % errmsg)]
+    if not isinstance(config, dict):
+        return path, [(None, None, 'the root of the plist is not a dictionary')]
+    return path, validateConfig(config, processes)
+
+def validateFiles(paths, processes=None):
+    """Validates each plist in paths, where a directory stands for the .plist
+    files in it. Returns a list of (path, problems) pairs, problems being as
+    returned by validateConfig. Several files are spread across a pool of
+    processes worker processes, one per core by default; a single file is
+    split across the pool by workflow instead."""
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith('.plist')))
+        else:
+            files.append(path)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(files) == 1:
+        return [_validateFile(files[0], processes)]
+    if processes > 1 and files:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(_validateFile, files, 1)
+        finally:
+            pool.terminate()
+    return [_validateFile(path) for path in files]
+
+def printValidationProblems(problems, prefix=''):
+    '''Prints validateConfig problems, one per line'''
+    for index, name, problem in problems:
+        if index is None:
+            print '%s%s' % (prefix, problem)
+        elif name is None:
+            print '%s%s: %s' % (prefix, index, problem)
+        else:
+            print "%s%s: '%s': %s" % (prefix, index, name, problem)
+
+
+# JSON export
+
+# JSON has no data or date types, so these are written as a dictionary with
+# one of these tags as its only key; $dict marks a real dictionary that
+# would otherwise look like one, and $missing is a key that isn't set, in
+# the change journal
+JSON_TAGS = ('$data', '$date', '$dict', '$missing')
+JSON_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def jsonValue(value):
+    """Returns a plist value as a value json.dumps can write, with data and
+    dates as tagged dictionaries. plistValue turns it back."""
+    if isinstance(value, dict):
+        result = dict((key, jsonValue(item)) for key, item in value.iteritems())
+        if len(value) == 1 and value.keys()[0] in JSON_TAGS:
+            return {'$dict': result}
+        return result
+    if isinstance(value, list):
+        return [jsonValue(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.strftime(JSON_DATE_FORMAT)}
+    if isinstance(value, Data):
+        return {'$data': binascii.b2a_base64(value.data).strip()}
+    return value
+
+def withoutScriptContent(workflow):
+    """Returns workflow with the content of its scripts replaced by a
+    content_ref, the SHA-256 a script store keeps the content under"""
+    components = list()
+    for component in workflow.get('components', []):
+        if isinstance(component, dict) and component.get('type') == 'script' and 'content' in component:
+            component = dict(component)
+            content = component.pop('content')
+            data = content.encode('utf-8') if isinstance(content, unicode) else content
+            component['content_ref'] = hashlib.sha256(data).hexdigest()
+        components.append(component)
+    workflow = dict(workflow)
+    workflow['components'] = components
+    return workflow
+
+def exportWorkflow(workflow, fields=None, scriptContent=True):
+    """Returns a workflow as one line of JSON. fields limits it to those keys,
+    and without scriptContent its scripts are replaced by references."""
+    if hasattr(workflow, 'parse'):
+        workflow = workflow.parse()
+    if not scriptContent and isinstance(workflow.get('components'), list):
+        workflow = withoutScriptContent(workflow)
+    return json.dumps(jsonValue(projectFields(workflow, fields)), sort_keys=True)
+
+def _exportWorkflows(job):
+    """Exports a chunk of workflows, returns their lines. Runs in pool workers,
+    so workflows may still be unparsed RawPlistValues."""
+    workflows, fields, scriptContent = job
+    return [exportWorkflow(workflow, fields, scriptContent) for workflow in workflows]
+
+def exportLines(config, format='jsonl', fields=None, scriptContent=True, processes=1):
+    """Yields a config (the root dictionary of a plist) as lines of JSON, one
+    workflow at a time. In jsonl format, each line is a workflow, after a
+    {"$config": ...} line with the config's other keys unless fields limits
+    the export; json format wraps the workflows in those keys. Either way,
+    import-manifest can read them back into the same plist. Large configs
+    are converted across a pool of processes worker processes, one per core
+    with None."""
+    workflows = config['workflows']
+    if format == 'json':
+        settings = ''.join('%s: %s, ' % (json.dumps(key), json.dumps(jsonValue(config[key]), sort_keys=True))
+                           for key in sorted(config) if key != 'workflows')
+        yield '{%s"workflows": [' % settings
+    elif fields is None:
+        settings = dict((key, value) for key, value in config.items() if key != 'workflows')
+        yield json.dumps({'$config': jsonValue(settings)}, sort_keys=True)
+    # list's own slicing leaves unparsed workflows for the workers to parse
+    items = list.__getitem__(workflows, slice(None))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1 and len(items) >= PARALLEL_VALIDATION_THRESHOLD:
+        chunkSize = max(1, min(500, len(items) // (processes * 4)))
+        jobs = ((items[start:start + chunkSize], fields, scriptContent) for start in range(0, len(items), chunkSize))
+        pool = multiprocessing.Pool(processes)
+        try:
+            # imap keeps the order, and hands each chunk over as soon as it's done
+            chunks = pool.imap(_exportWorkflows, jobs)
+            lines = (line for chunk in chunks for line in chunk)
+            for index, line in enumerate(lines):
+                yield line + ',' if format == 'json' and index < len(items) - 1 else line
+        finally:
+            pool.terminate()
+    else:
+        for index, item in enumerate(items):
+            line = exportWorkflow(item, fields, scriptContent)
+            yield line + ',' if format == 'json' and index < len(items) - 1 else line
+    if format == 'json':
+        yield ']}'
+
+
+# Manifest import
+
+# manifest fields that set workflow settings, and those that describe a
+# component; a record's workflow name is in its workflow field
+MANIFEST_WORKFLOW_FIELDS = ('description', 'restart_action', 'bless_target')
+MANIFEST_COMPONENT_FIELDS = ('type', 'url', 'sha256', 'first_boot', 'content', 'script', 'use_serial', 'auto',
+                             'name', 'format', 'map', 'partitions', 'target')
+MANIFEST_BOOLEAN_FIELDS = ('bless_target', 'first_boot', 'use_serial', 'auto')
+# component fields that have to be given, because their template value is only a placeholder
+MANIFEST_REQUIRED_FIELDS = { 'image' : ('url',), 'package' : ('url',), 'partition' : ('partitions',) }
+
+# file extensions of the manifest formats
+MANIFEST_FORMATS = { '.csv' : 'csv', '.jsonl' : 'jsonl', '.ndjson' : 'jsonl', '.json' : 'json',
+                     '.yaml' : 'yaml', '.yml' : 'yaml' }
+
+def parseBoolean(value):
+    '''Returns value as a bool, accepting true/false, yes/no and 1/0 strings'''
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', '1'):
+        return True
+    if text in ('false', 'no', '0'):
+        return False
+    raise ValueError('%r is not true or false' % value)
+
+def parsePartitions(value, target):
+    '''Returns the partition list for a manifest's partitions field: either a
+    list of partition dictionaries, or "NAME:FORMAT:SIZE" entries separated by
+    semicolons. The partition named target is made the target.'''
+    if isinstance(value, list):
+        partitions = [dict(partition) for partition in value if isinstance(partition, dict)]
+        if len(partitions) != len(value):
+            raise ValueError('partitions must be dictionaries')
+    else:
+        partitions = list()
+        for entry in str(value).split(';'):
+            fields = entry.strip().split(':')
+            if len(fields) != 3:
+                raise ValueError('partition %r is not NAME:FORMAT:SIZE' % entry.strip())
+            partitions.append({'name': fields[0], 'format_type': fields[1], 'size': fields[2]})
+    if target is not None:
+        for partition in partitions:
+            partition.pop('target', None)
+            if partition.get('name') == target:
+                partition['target'] = True
+    return partitions
+
+def plistValue(value):
+    """Returns a value read from a JSON or YAML manifest as the plist value it
+    stands for: tagged dictionaries (see jsonValue) become data and dates, and
+    ASCII strings become str, as plists are read"""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            tag, item = value.items()[0]
+            if tag == '$data':
+                return Data(binascii.a2b_base64(item))
+            if tag == '$date':
+                return datetime.datetime.strptime(item, JSON_DATE_FORMAT)
+            if tag == '$dict':
+                # a dictionary that only looks like a tag
+                value = item
+        return dict((plistValue(key), plistValue(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [plistValue(item) for item in value]
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    return value
+
+def readManifest(path, format=None):
+    """Yields (row, record) pairs from the manifest at path, one at a time, where
+    row is the line (or, for JSON and YAML files, the record) number. format is
+    csv, jsonl, json or yaml, and defaults to the one the file extension says.
+    A record that can't be read is yielded as an ImagrConfigError instead."""
+    if format is None:
+        format = MANIFEST_FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ImagrConfigError("can't tell the format of %s from its extension, use --format" % path)
+    try:
+        manifest = open(os.path.expanduser(path), 'rb')
+    except (OSError, IOError), errmsg:
+        raise ImagrConfigError("Couldn't read %s: %s" % (path, errmsg.strerror))
+    with manifest:
+        if format == 'csv':
+            reader = csv.DictReader(manifest)
+            try:
+                fieldnames = reader.fieldnames or []
+            except csv.Error, errmsg:
+                raise ImagrConfigError('%s is not valid CSV: %s' % (path, errmsg))
+            fields = set(('workflow',) + MANIFEST_WORKFLOW_FIELDS + MANIFEST_COMPONENT_FIELDS)
+            unknown = [field for field in fieldnames if field not in fields]
+            if unknown or 'workflow' not in fieldnames:
+                raise ImagrConfigError('%s needs a workflow column, and can\'t have the columns: %s' %
+                                       (path, ', '.join(unknown) or 'none'))
+            while True:
+                try:
+                    row = next(reader)
+                    # empty cells are left out, so the templates' defaults apply
+                    record = dict((field, plistValue(value.decode('utf-8')))
+                                  for field, value in row.items() if field is not None and value)
+                except StopIteration:
+                    break
+                except csv.Error, errmsg:
+                    record = ImagrConfigError('not valid CSV: %s' % errmsg)
+                except UnicodeDecodeError, errmsg:
+                    record = ImagrConfigError('not valid UTF-8: %s' % errmsg)
+                # the DictReader's own line_num isn't updated when a row fails
+                yield reader.reader.line_num, record
+        elif format == 'jsonl':
+            for number, line in enumerate(manifest, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = plistValue(json.loads(line))
+                except (ValueError, TypeError, binascii.Error), errmsg:
+                    record = ImagrConfigError('not valid JSON: %s' % errmsg)
+                yield number, record
+        elif format == 'json':
+            # a JSON array, or a whole config, is read at once
+            try:
+                data = plistValue(json.load(manifest))
+            except (ValueError, TypeError, binascii.Error), errmsg:
+                raise ImagrConfigError('%s is not valid JSON: %s' % (path, errmsg))
+            if isinstance(data, dict) and isinstance(data.get('workflows'), list):
+                # a whole config, as export writes it: its other keys come first
+                workflows = data.pop('workflows')
+                data = [{'$config': data}] + workflows
+            if not isinstance(data, list):
+                raise ImagrConfigError('%s is not a list of records' % path)
+            for number, record in enumerate(data, 1):
+                yield number, record
+        elif format == 'yaml':
+            if yaml is None:
+                raise ImagrConfigError('YAML manifests need the PyYAML module')
+            number = 0
+            try:
+                for document in yaml.safe_load_all(manifest):
+                    for record in (document if isinstance(document, list) else [document]):
+                        number += 1
+                        yield number, plistValue(record)
+            except yaml.YAMLError, errmsg:
+                raise ImagrConfigError('%s is not valid YAML: %s' % (path, errmsg))
+        else:
+            raise ImagrConfigError('unknown manifest format %s' % format)
+
+
+# Diff and merge
+
+def _canonical(value):
+    '''Returns a string that's the same for plist values with the same content'''
+    if isinstance(value, dict):
+        return '{%s}' % ','.join('%s:%s' % (_canonical(key), _canonical(value[key])) for key in sorted(value))
+    if isinstance(value, list):
+        return '[%s]' % ','.join(_canonical(item) for item in value)
+    if isinstance(value, unicode):
+        # str and unicode values with the same text are the same
+        value = value.encode('utf-8')
+    return repr(value)
+
+def contentHash(value):
+    '''Returns a hash of a plist value that's equal for values with equal content'''
+    return hashlib.sha1(_canonical(value)).hexdigest()
+
+def _sameValue(first, second):
+    if first is _MISSING or second is _MISSING:
+        return first is second
+    return contentHash(first) == contentHash(second)
+
+def _parsedWorkflow(workflows, index):
+    '''Returns workflows[index], parsing it without keeping the result if it's unparsed'''
+    item = list.__getitem__(workflows, index)
+    if hasattr(item, 'parse'):
+        return item.parse()
+    return item
+
+def sameWorkflow(workflows, index, otherWorkflows, otherIndex):
+    '''Returns True if two workflows have the same content'''
+    item = list.__getitem__(workflows, index)
+    otherItem = list.__getitem__(otherWorkflows, otherIndex)
+    if hasattr(item, 'xml') and hasattr(otherItem, 'xml') and item.xml == otherItem.xml:
+        # identical XML, so neither needs parsing
+        return True
+    return contentHash(_parsedWorkflow(workflows, index)) == contentHash(_parsedWorkflow(otherWorkflows, otherIndex))
 
-    matches = [item for item in match_list
-                   if item.upper().startswith(text.upper())]
+def workflowNameIndex(workflows):
+    '''Returns the list of workflow names and a name -> index map, where the
+    first of several workflows with the same name wins'''
+    if hasattr(workflows, 'peek'):
+        names = [workflows.peek(index, 'name') for index in range(len(workflows))]
+    else:
+        names = [workflow.get('name') for workflow in workflows]
+    index = dict()
+    for position, name in enumerate(names):
+        if name is not None:
+            index.setdefault(name, position)
+    return names, index
+
+def workflowOrder(names, index, keep):
+    '''Returns the names in keep in the order of names, each once, as
+    workflowNameIndex returns them'''
+    return [name for position, name in enumerate(names)
+            if name is not None and index[name] == position and name in keep]
+
+def movedNames(before, after):
+    '''Returns the names in after, a reordering of before, that were moved:
+    those outside the longest runs the two orders have in common'''
+    matcher = difflib.SequenceMatcher(None, before, after, autojunk=False)
+    kept = set()
+    for start, newStart, size in matcher.get_matching_blocks():
+        kept.update(after[newStart:newStart + size])
+    return [name for name in after if name not in kept]
+
+def mergeSequences(base, ours, theirs):
+    """Three-way merges lists of plist values, matching items by content.
+    Returns the merged list, or None if ours and theirs changed the same
+    part of base in different ways."""
+    baseKeys = [contentHash(item) for item in base]
+    def changes(items):
+        keys = [contentHash(item) for item in items]
+        matcher = difflib.SequenceMatcher(None, baseKeys, keys, autojunk=False)
+        return [(start, end, keys[newStart:newEnd], items[newStart:newEnd])
+                for tag, start, end, newStart, newEnd in matcher.get_opcodes() if tag != 'equal']
+    ourChanges = changes(ours)
+    theirChanges = changes(theirs)
+    combined = list(ourChanges)
+    for theirChange in theirChanges:
+        start, end, keys = theirChange[:3]
+        duplicate = False
+        for ourStart, ourEnd, ourKeys, ourItems in ourChanges:
+            if (start, end, keys) == (ourStart, ourEnd, ourKeys):
+                # both made the same change
+                duplicate = True
+                break
+            overlaps = max(start, ourStart) < min(end, ourEnd)
+            if overlaps or (start == end and ourStart <= start <= ourEnd) or \
+                           (ourStart == ourEnd and start <= ourStart <= end):
+                return None
+        if not duplicate:
+            combined.append(theirChange)
+    combined.sort(key=lambda change: (change[0], change[1]))
+    merged = list()
+    position = 0
+    for start, end, keys, items in combined:
+        merged.extend(base[position:start])
+        merged.extend(items)
+        position = end
+    merged.extend(base[position:])
+    return merged
+
+def readConfig(path):
+    '''Reads another config for diff or merge, returns None if it can't be read'''
     try:
-        return matches[state]
-    except IndexError:
+        config = plistlib.readPlistLazily(os.path.expanduser(path), 'workflows')
+    except Exception, errmsg:
+        print >> sys.stderr, 'Error: could not read plist %s because: %s' % (path, errmsg)
+        return None
+    if not isinstance(config, dict) or not isinstance(config.get('workflows'), list):
+        print >> sys.stderr, 'Error: %s is not an Imagr config' % path
+        return None
+    return config
+
+def formatCommand(args):
+    '''Returns args as a line that runBatch will split back into args'''
+    return ' '.join(pipes.quote(arg.encode('utf-8') if isinstance(arg, unicode) else str(arg)) for arg in args)
+
+def componentArgs(component):
+    """Returns the add-*-component subcommand and arguments, without --workflow
+    and --index, that create component, or None if no subcommand can."""
+    if not isinstance(component, dict):
         return None
+    keys = set(component)
+    componentType = component.get('type')
+    def strings(*names):
+        return all(isinstance(component.get(name), basestring) for name in names)
+    def bools(*names):
+        return all(isinstance(component.get(name), bool) for name in names)
+    if componentType == 'image' and keys == set(['type', 'url']) and strings('url'):
+        return ['add-image-component', '--url', component['url']]
+    if componentType == 'package' and keys == set(['type', 'url', 'first_boot']) and strings('url') and bools('first_boot'):
+        args = ['add-package-component', '--url', component['url']]
+        if not component['first_boot']:
+            args.append('--no-firstboot')
+        return args
+    if componentType == 'computer_name' and keys == set(['type', 'use_serial', 'auto']) and bools('use_serial', 'auto'):
+        args = ['add-computername-component']
+        if component['use_serial']:
+            args.append('--use-serial')
+        if component['auto']:
+            args.append('--auto')
+        return args
+    if componentType == 'script' and keys == set(['type', 'content', 'first_boot']) and strings('content') and bools('first_boot'):
+        content = component['content']
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        args = ['add-script-component', '--inline-content', content.encode('string_escape')]
+        if not component['first_boot']:
+            args.append('--no-firstboot')
+        return args
+    if componentType == 'eraseVolume' and keys == set(['type', 'name', 'format']) and strings('name', 'format'):
+        return ['add-erase-component', '--name', component['name'], '--format', component['format']]
+    if componentType == 'partition' and keys == set(['type', 'map', 'partitions']) and strings('map'):
+        partitions = component['partitions']
+        if not isinstance(partitions, list) or not partitions:
+            return None
+        names, formats, sizes, targets = list(), list(), list(), list()
+        for partition in partitions:
+            if not isinstance(partition, dict) or not all(isinstance(partition.get(key), basestring)
+                                                          for key in ('name', 'format_type', 'size')):
+                return None
+            extra = set(partition).difference(['name', 'format_type', 'size'])
+            if extra == set(['target']) and partition['target'] is True:
+                targets.append(partition['name'])
+            elif extra:
+                return None
+            names.append(partition['name'])
+            formats.append(partition['format_type'])
+            sizes.append(partition['size'])
+        # add-partition-component marks every partition with the target's name
+        if len(targets) != 1 or names.count(targets[0]) != 1:
+            return None
+        return ['add-partition-component', '--map', component['map'], '--names'] + names + \
+               ['--formats'] + formats + ['--sizes'] + sizes + ['--target', targets[0]]
+    return None
+
+# workflow settings and the subcommands that set them
+WORKFLOW_SETTINGS = [
+    ('description', lambda workflow, value: ['set-description', '--workflow', workflow, '--desc', value]),
+    ('restart_action', lambda workflow, value: ['set-restart-action', '--workflow', workflow, '--restart', value]),
+    ('bless_target', lambda workflow, value: ['set-bless-target', '--workflow', workflow] + ([] if value else ['--no-bless'])),
+    ]
+
+# what add-workflow sets up
+NEW_WORKFLOW = { 'description' : '', 'restart_action' : 'none', 'bless_target' : False, 'components' : [] }
+
+def _workflowArg(name, index):
+    '''Returns how to refer to a workflow: its name, unless that would be read as an index'''
+    if str(name).isdigit():
+        return str(index)
+    return name
+
+def _diffComponents(workflow, oldComponents, newComponents):
+    '''Returns the lines that turn oldComponents into newComponents'''
+    lines = list()
+    oldKeys = [contentHash(component) for component in oldComponents]
+    newKeys = [contentHash(component) for component in newComponents]
+    matcher = difflib.SequenceMatcher(None, oldKeys, newKeys, autojunk=False)
+    offset = 0
+    for tag, start, end, newStart, newEnd in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        for index in range(start, end):
+            lines.append(formatCommand(['remove-component', '--workflow', workflow, '--component', str(start + offset)]))
+        for position, component in enumerate(newComponents[newStart:newEnd]):
+            args = componentArgs(component)
+            if args is None:
+                lines.append('# no subcommand can add component %s: %r' % (newStart + position, component))
+                continue
+            lines.append(formatCommand(args + ['--workflow', workflow, '--index', str(start + offset + position)]))
+        offset += (newEnd - newStart) - (end - start)
+    return lines
+
+def _diffWorkflow(workflow, oldWorkflow, newWorkflow):
+    '''Returns the lines that turn oldWorkflow into newWorkflow'''
+    lines = list()
+    for field, command in WORKFLOW_SETTINGS:
+        value = newWorkflow.get(field, _MISSING)
+        if not _sameValue(oldWorkflow.get(field, _MISSING), value):
+            if value is _MISSING:
+                lines.append('# no subcommand can remove %s' % field)
+            elif not isinstance(value, (basestring, bool)):
+                lines.append('# no subcommand can set %s to %r' % (field, value))
+            else:
+                lines.append(formatCommand(command(workflow, value)))
+    for field in sorted(set(oldWorkflow).union(newWorkflow).difference(
+                        [setting[0] for setting in WORKFLOW_SETTINGS] + ['name', 'components'])):
+        value = newWorkflow.get(field, _MISSING)
+        if value is _MISSING:
+            lines.append('# no subcommand can remove %s' % field)
+        elif not _sameValue(oldWorkflow.get(field, _MISSING), value):
+            lines.append('# no subcommand can set %s to %r' % (field, value))
+    lines.extend(_diffComponents(workflow, oldWorkflow.get('components', []), newWorkflow.get('components', [])))
+    return lines
+
+def longestIncreasingSubsequence(values):
+    '''Returns the longest strictly increasing subsequence of values'''
+    tails = list()      # tails[length - 1] is the position of the smallest tail of a run that long
+    tailValues = list()
+    previous = [None] * len(values)
+    for position, value in enumerate(values):
+        length = bisect.bisect_left(tailValues, value)
+        if length:
+            previous[position] = tails[length - 1]
+        if length == len(tails):
+            tails.append(position)
+            tailValues.append(value)
+        else:
+            tails[length] = position
+            tailValues[length] = value
+    result = list()
+    position = tails[-1] if tails else None
+    while position is not None:
+        result.append(values[position])
+        position = previous[position]
+    result.reverse()
+    return result
+
+def diffConfigs(old, new):
+    """Returns a list of batch lines - subcommands, and comments for changes
+    no subcommand can make - that turn the config old into the config new.
+    Both are root dictionaries of plists. Workflows are matched by name and
+    components by content, and workflows with identical contents are
+    skipped without being compared further."""
+    oldWorkflows, newWorkflows = old['workflows'], new['workflows']
+    oldNames, oldIndex = workflowNameIndex(oldWorkflows)
+    newNames, newIndex = workflowNameIndex(newWorkflows)
+    lines = list()
+    if not _sameValue(old.get('password', _MISSING), new.get('password', _MISSING)):
+        lines.append('# the password hash differs; use new-password to set it')
+
+    # workflows kept in place are the longest run of common workflows that's
+    # in the same order in both; the others are moved by removing and re-adding them
+    common = [oldIndex[name] for position, name in enumerate(newNames)
+              if newIndex.get(name) == position and name in oldIndex]
+    kept = set(oldNames[position] for position in longestIncreasingSubsequence(common))
+
+    for position in reversed(range(len(oldNames))):
+        name = oldNames[position]
+        if name is None or oldIndex[name] != position:
+            lines.append('# skipped workflow %s, which has no name or a name used before' % position)
+        elif name not in kept:
+            lines.append(formatCommand(['remove-workflow', _workflowArg(name, position)]))
+
+    for position, name in enumerate(newNames):
+        if name is None or newIndex[name] != position:
+            lines.append('# skipped new workflow %s, which has no name or a name used before' % position)
+            continue
+        workflow = _workflowArg(name, position)
+        if name in kept:
+            if not sameWorkflow(oldWorkflows, oldIndex[name], newWorkflows, position):
+                lines.extend(_diffWorkflow(workflow, _parsedWorkflow(oldWorkflows, oldIndex[name]),
+                                           _parsedWorkflow(newWorkflows, position)))
+            continue
+        lines.append(formatCommand(['add-workflow', name, '--index', str(position)]))
+        lines.extend(_diffWorkflow(workflow, dict(NEW_WORKFLOW, name=name), _parsedWorkflow(newWorkflows, position)))
+    return lines
+
+
+# Tab completion
+
+class CompletionIndex(object):
+    """A sorted, case-insensitive index of strings for prefix lookups with
+    bisect. Strings are counted, so one added twice has to be removed twice."""
+    def __init__(self, values=()):
+        self.counts = dict()
+        for value in values:
+            self.counts[value] = self.counts.get(value, 0) + 1
+        self.keys = sorted((value.upper(), value) for value in self.counts)
+
+    def add(self, value):
+        if value in self.counts:
+            self.counts[value] += 1
+        else:
+            self.counts[value] = 1
+            bisect.insort(self.keys, (value.upper(), value))
+
+    def remove(self, value):
+        count = self.counts.get(value, 0)
+        if count > 1:
+            self.counts[value] = count - 1
+        elif count == 1:
+            del self.counts[value]
+            key = (value.upper(), value)
+            position = bisect.bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                del self.keys[position]
+
+    def matches(self, prefix):
+        '''Returns the strings starting with prefix, ignoring case, in order'''
+        prefix = prefix.upper()
+        results = list()
+        position = bisect.bisect_left(self.keys, (prefix,))
+        while position < len(self.keys) and self.keys[position][0].startswith(prefix):
+            results.append(self.keys[position][1])
+            position += 1
+        return results
+
+class Completer(object):
+    """readline completer for subcommands, their flags, workflow names,
+    component indexes and URLs. Matches are worked out once for each token
+    being completed, and the indexes are kept current by listening to
+    changes to the plist."""
+    def __init__(self, configPlist, cmds):
+        self.configPlist = configPlist
+        self.cmds = cmds
+        self.commands = CompletionIndex(cmds)
+        self.names = CompletionIndex(configPlist.getWorkflowNames())
+        # every URL in the plist; built the first time a URL is completed,
+        # since that parses every workflow
+        self.urls = None
+        self.flags = dict()
+        self.lastKey = None
+        self.lastMatches = []
+
+    # listener methods, called by ImagrConfigPlist when the plist changes
+    def workflowAdded(self, workflow):
+        self.names.add(str(workflow['name']))
+        for component in workflow.get('components', []):
+            self.componentAdded(component)
+
+    def workflowRemoved(self, workflow):
+        self.names.remove(str(workflow['name']))
+        for component in workflow.get('components', []):
+            self.componentRemoved(component)
+
+    def workflowRenamed(self, oldName, newName):
+        if oldName is not _MISSING:
+            self.names.remove(str(oldName))
+        if newName is not _MISSING:
+            self.names.add(str(newName))
 
-def setUpTabCompleter():
+    def componentAdded(self, component):
+        if self.urls is not None and isinstance(component.get('url'), basestring):
+            self.urls.add(component['url'])
+
+    def componentRemoved(self, component):
+        if self.urls is not None and isinstance(component.get('url'), basestring):
+            self.urls.remove(component['url'])
+
+    def getURLs(self):
+        if self.urls is None:
+            self.urls = CompletionIndex(component['url'] for workflow in self.configPlist.internalPlist['workflows']
+                                        for component in workflow.get('components', [])
+                                        if isinstance(component.get('url'), basestring))
+        return self.urls
+
+    def getFlags(self, subcommand):
+        '''Returns an index of the option flags of subcommand'''
+        if subcommand not in self.flags:
+            try:
+                parser = self.configPlist.getParser(subcommand.replace('-', '_'))
+            except AttributeError:
+                # exit, help, stats and the like have no parser
+                parser = None
+            self.flags[subcommand] = CompletionIndex(parser._option_string_actions if parser else [])
+        return self.flags[subcommand]
+
+    def componentIndexes(self, words):
+        '''Returns the component indexes of the workflow given with --workflow in words'''
+        try:
+            workflow = words[words.index('--workflow') + 1]
+        except (ValueError, IndexError):
+            return []
+        if workflow in self.configPlist.workflowIndex:
+            key = self.configPlist.workflowIndex[workflow]
+        elif workflow.isdigit() and int(workflow) < len(self.configPlist.workflowNames):
+            key = int(workflow)
+        else:
+            return []
+        return [str(index) for index in range(len(self.configPlist.internalPlist['workflows'][key].get('components', [])))]
+
+    def candidates(self, words, text):
+        '''Returns the completions for text, given the words before it on the line'''
+        if not words:
+            return self.commands.matches(text)
+        subcommand = words[0]
+        if text.startswith('-'):
+            return self.getFlags(subcommand).matches(text)
+        previous = words[-1] if len(words) > 1 else None
+        if previous in ('--workflow', '--from'):
+            return self.workflowMatches(text)
+        if previous == '--url':
+            return self.getURLs().matches(text)
+        if previous == '--template' or (self.cmds.get(subcommand) == 'templates' and len(words) == 1):
+            return [pipes.quote(name) for name in self.configPlist.templates.names() if name.startswith(text.lstrip('\'"'))]
+        if previous == '--name' and subcommand == 'display-workflows':
+            return self.workflowMatches(text)
+        if previous == '--type':
+            # component types as they're stored in the plist
+            storedNames = dict((template, stored) for stored, template in COMPONENT_TYPE_ALIASES.items())
+            types = sorted(storedNames.get(name, name) for name in ImagrConfigPlist.workflowComponentTypes)
+            return [name for name in types if name.startswith(text)]
+        if subcommand == 'set-output' and len(words) == 1:
+            return [mode for mode in OUTPUT_MODES if mode.startswith(text)]
+        if previous in ('--component', '--index') and subcommand.endswith('component'):
+            return [index for index in self.componentIndexes(words) if index.startswith(text)]
+        if previous is not None and previous.startswith('-'):
+            # the value of some other option
+            return []
+        if self.cmds.get(subcommand) in ('workflows', 'components') and len(words) == 1:
+            return self.workflowMatches(text)
+        return []
+
+    def workflowMatches(self, text):
+        '''Returns workflow names starting with text, quoted if they need it'''
+        quote = text[:1] if text[:1] in ('"', "'") else ''
+        results = list()
+        for name in self.names.matches(text[len(quote):]):
+            if quote == "'":
+                results.append("'%s'" % name.replace("'", "'\"'\"'"))
+            elif quote == '"':
+                results.append('"%s"' % name.replace('\\', '\\\\').replace('"', '\\"'))
+            else:
+                results.append(pipes.quote(name))
+        return results
+
+    def complete(self, text, state):
+        """Called by the readline lib to calculate possible completions"""
+        line = readline.get_line_buffer()[:readline.get_begidx()]
+        key = (line, text)
+        if state == 0 or key != self.lastKey:
+            try:
+                words = shlex.split(line)
+            except ValueError:
+                # an unclosed quote
+                words = None
+            self.lastKey = key
+            self.lastMatches = self.candidates(words, text) if words is not None else []
+        try:
+            return self.lastMatches[state]
+        except IndexError:
+            return None
+
+def setUpTabCompleter(configPlist, cmds):
     """Starts our tab-completer when running interactively"""
-    readline.set_completer(tab_completer)
+    completer = Completer(configPlist, cmds)
+    configPlist.listeners.append(completer)
+    # quoted names can contain the usual delimiters
+    readline.set_completer_delims(' \t\n')
+    readline.set_completer(completer.complete)
     if sys.platform == 'darwin':
         readline.parse_and_bind ("bind ^I rl_complete")
     else:
         readline.parse_and_bind("tab: complete")
+    return completer
 
 def help(args):
     '''Prints available subcommands'''
@@ -811,6 +3915,13 @@ def help(args):
         print '\t%s' % item
     return 0
 
+def stats(args):
+    '''Prints call counts and latencies of the subcommands run so far, or of the given ones'''
+    names = [subcommandName(name) for name in args[1:]] or None
+    for line in STATS.report(names):
+        print line
+    return 0
+
 def handleSubcommand(args, plist):
     '''Does all our subcommands'''
     # strip leading hyphens and
@@ -828,17 +3939,359 @@ def handleSubcommand(args, plist):
     if subcommand == 'help':
         return help(args)
 
+    if subcommand == 'stats':
+        return stats(args)
+
     try:
         # find function to call by looking in the ImagrConfigPlist name table
         # for a function with a name matching the subcommand
         subcommand_function = getattr(plist, subcommand)
-        return subcommand_function(args[1:])
+        try:
+            return STATS.call(subcommandName(args[0]), subcommand_function, args[1:])
+        finally:
+            # whatever the subcommand changed is undone as one step
+            plist.endChange(' '.join(pipes.quote(arg) for arg in args))
     except (TypeError, KeyError, AttributeError), errmsg:
 #        print >> sys.stderr, 'Unknown subcommand: %s: %s' % (subcommand, errmsg)
         print >> sys.stderr, 'Unknown subcommand: %s' % subcommand
         help(args)
         return 2
 
+def runBatch(lines, plist, keepGoing=False, handler=handleSubcommand):
+    '''Runs each subcommand line against plist without saving.
+    Returns a list of (line number, command, exit status) tuples.'''
+    results = list()
+    for lineNumber, line in enumerate(lines, 1):
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError, errmsg:
+            print >> sys.stderr, 'Line %s: %s' % (lineNumber, errmsg)
+            results.append((lineNumber, line.strip(), 22))
+            if keepGoing:
+                continue
+            break
+        if not args:
+            # blank line or comment
+            continue
+        if args[0].lstrip('-').replace('-', '_') == 'exit':
+            # the caller saves once everything has run
+            break
+        try:
+            status = handler(args, plist)
+        except Exception, errmsg:
+            print >> sys.stderr, 'Line %s: %s' % (lineNumber, errmsg)
+            status = 1
+        results.append((lineNumber, line.strip(), status))
+        if status != 0 and not keepGoing:
+            break
+    return results
+
+def printBatchReport(results):
+    '''Prints the exit status of each batch command to stderr'''
+    for lineNumber, command, status in results:
+        print >> sys.stderr, '%s: [%s] %s' % (lineNumber, status, command)
+    failed = [result for result in results if result[2] != 0]
+    print >> sys.stderr, '%s commands run, %s failed.' % (len(results), len(failed))
+
+
+# Server mode
+
+def journalValue(value):
+    '''Returns an argument of a change as a value json.dumps can write'''
+    if value is _MISSING:
+        return {'$missing': True}
+    return jsonValue(value)
+
+def changeArgument(value):
+    '''Returns an argument of a journaled change as the value journalValue was given'''
+    if value == {'$missing': True}:
+        return _MISSING
+    return plistValue(value)
+
+class ChangeJournal(object):
+    '''Write-ahead log of the changes made since the plist was last saved.
+    The changes each subcommand made are appended as one JSON line, so
+    edits that haven't been saved yet can be replayed after a crash. The
+    changes are those ImagrConfigPlist.recordChange saw, such as
+    insertWorkflow with the whole workflow, not the command line, so
+    replaying them doesn't depend on the files the command read.'''
+    def __init__(self, plistPath):
+        self.path = plistPath + '.journal'
+        self.journalFile = None
+
+    def records(self):
+        '''Returns the records left in the journal'''
+        if not os.path.exists(self.path):
+            return []
+        records = list()
+        with open(self.path) as journalFile:
+            for line in journalFile:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a partly written last line, from a crash mid-append
+                    break
+        return records
+
+    def append(self, args, configPlist):
+        '''Records the changes subcommand args made to configPlist'''
+        # only the subcommand, so new-password's password isn't kept around
+        record = {'subcommand': args[0], 'changes': configPlist.takeAppliedChanges()}
+        if self.journalFile is None:
+            self.journalFile = open(self.path, 'a')
+        self.journalFile.write(json.dumps(record) + '\n')
+        # flushed to the OS, so it survives this process crashing
+        self.journalFile.flush()
+
+    def clear(self):
+        '''Removes the journal once its changes are saved in the plist'''
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+        try:
+            os.remove(self.path)
+        except OSError, errmsg:
+            if errmsg.errno != errno.ENOENT:
+                raise
+
+    def replay(self, configPlist):
+        '''Applies the journal's records to configPlist, returns how many there were'''
+        records = self.records()
+        for record in records:
+            try:
+                for name, args in record['changes']:
+                    getattr(configPlist, name)(*[changeArgument(arg) for arg in args])
+            except Exception, errmsg:
+                print >> sys.stderr, 'Warning: could not replay %s: %s' % (record['subcommand'], errmsg)
+            configPlist.endChange(str(record['subcommand']))
+        return len(records)
+
+class DebouncedSaver(object):
+    '''Saves a plist from a background thread once changes stop for delay seconds,
+    or maxDelay seconds after the first unsaved change if they don't stop.'''
+    def __init__(self, configPlist, lock, delay, maxDelay=None, journal=None):
+        self.configPlist = configPlist
+        # ChangeJournal that is cleared after each save
+        self.journal = journal
+        if journal is not None:
+            # the plist records its changes for the journal from now on
+            configPlist.appliedChanges = list()
+        # held while the plist is changed or saved
+        self.lock = lock
+        self.delay = delay
+        self.maxDelay = maxDelay or delay * 10
+        self.condition = threading.Condition()
+        self.firstChange = None
+        self.lastChange = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def changed(self, args):
+        '''Notes that subcommand args changed the plist. Call with the lock held.'''
+        if self.journal is not None:
+            self.journal.append(args, self.configPlist)
+        with self.condition:
+            self.lastChange = time.time()
+            if self.firstChange is None:
+                self.firstChange = self.lastChange
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.firstChange is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                due = min(self.lastChange + self.delay, self.firstChange + self.maxDelay)
+                if time.time() < due:
+                    self.condition.wait(due - time.time())
+                    continue
+            self.flush()
+
+    def flush(self, always=False):
+        '''Saves the plist now if it has unsaved changes, or even if it hasn't with always'''
+        with self.lock:
+            with self.condition:
+                if self.firstChange is None and not always:
+                    return
+                self.firstChange = self.lastChange = None
+            try:
+                self.configPlist.synchronize()
+                if self.journal is not None:
+                    self.journal.clear()
+            except Exception, errmsg:
+                print >> sys.stderr, 'Error: could not save %s: %s' % (self.configPlist.plistPath, errmsg)
+
+    def stop(self):
+        '''Stops the background thread and saves the plist. It is saved even
+        without changes, as exiting always has: a new plist, a conversion to
+        --binary or script contents restored by --script-store have to be
+        written too.'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush(always=True)
+
+class ConfigRequestHandler(SocketServer.StreamRequestHandler):
+    '''Runs one subcommand per request line and answers with one JSON line.
+    A request is either a command line, as typed at the prompt, or a JSON
+    array of arguments. The reply is {"status": N, "output": "...", "errors": "..."}.
+    Each client has its own output mode, which starts as the server's.'''
+    def handle(self):
+        outputMode = self.server.configPlist.outputMode
+        for line in iter(self.rfile.readline, ''):
+            try:
+                if line.lstrip().startswith('['):
+                    args = [str(arg) for arg in json.loads(line)]
+                else:
+                    args = shlex.split(line, comments=True)
+            except ValueError, errmsg:
+                self.reply(22, '', '%s\n' % errmsg)
+                continue
+            if not args:
+                continue
+            subcommand = subcommandName(args[0])
+            if subcommand == 'exit':
+                # end this client's session, the server keeps running
+                self.server.saver.flush()
+                self.reply(0, '', '')
+                return
+            if subcommand == 'shutdown':
+                self.reply(0, '', '')
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            status, output, errors, outputMode = self.server.run(args, outputMode)
+            self.reply(status, output, errors)
+
+    def reply(self, status, output, errors):
+        self.wfile.write(json.dumps({'status': status, 'output': output, 'errors': errors}) + '\n')
+        self.wfile.flush()
+
+class ConfigServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Keeps one ImagrConfigPlist loaded and runs subcommands for clients on a Unix socket'''
+    daemon_threads = True
+
+    def __init__(self, socketPath, configPlist, flushDelay, journal=None):
+        self.configPlist = configPlist
+        # one subcommand at a time, since they all print to sys.stdout
+        self.lock = threading.RLock()
+        self.saver = DebouncedSaver(configPlist, self.lock, flushDelay, journal=journal)
+        SocketServer.UnixStreamServer.__init__(self, socketPath, ConfigRequestHandler)
+
+    def run(self, args, outputMode):
+        '''Runs a subcommand in a client's output mode, returning (status,
+        output, errors, the client's output mode after set-output)'''
+        with self.lock:
+            output, errors = StringIO(), StringIO()
+            savedOutput, savedErrors = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = output, errors
+            # the plist's own mode is the server's, for new clients
+            savedMode = self.configPlist.outputMode
+            self.configPlist.outputMode = outputMode
+            try:
+                status = handleSubcommand(args, self.configPlist)
+            except Exception, errmsg:
+                print >> sys.stderr, 'Error: %s' % errmsg
+                status = 1
+            finally:
+                sys.stdout, sys.stderr = savedOutput, savedErrors
+                outputMode = self.configPlist.outputMode
+                self.configPlist.outputMode = savedMode
+            if self.configPlist.appliedChanges:
+                # even if it failed, as a partial undo does
+                self.saver.changed(args)
+        return status, output.getvalue(), errors.getvalue(), outputMode
+
+def serve(configPlist, socketPath, flushDelay, journal=None):
+    '''Serves configPlist on socketPath until a client sends shutdown or we're interrupted'''
+    try:
+        os.remove(socketPath)
+    except OSError, errmsg:
+        if errmsg.errno != errno.ENOENT:
+            raise
+    server = ConfigServer(socketPath, configPlist, flushDelay, journal)
+    print >> sys.stderr, 'Serving %s on %s' % (configPlist.plistPath, socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.saver.stop()
+        os.remove(socketPath)
+
+class RemoteConfig(object):
+    '''Sends subcommands to a config server'''
+    def __init__(self, socketPath):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socketPath)
+        self.replies = self.connection.makefile('r')
+
+    def run(self, args):
+        '''Runs a subcommand on the server, prints its output and returns its status'''
+        self.connection.sendall(json.dumps(args) + '\n')
+        reply = self.replies.readline()
+        if not reply:
+            print >> sys.stderr, 'Error: the server closed the connection'
+            return 1
+        reply = json.loads(reply)
+        sys.stdout.write(reply['output'])
+        sys.stderr.write(reply['errors'])
+        return reply['status']
+
+    def close(self):
+        self.connection.close()
+
+def remoteSubcommand(args, remote):
+    '''runBatch handler that runs args on a RemoteConfig'''
+    return remote.run(args)
+
+
+def printStats():
+    '''Prints the timing report to stderr'''
+    for line in STATS.report():
+        print >> sys.stderr, line
+
+def readBatch(path):
+    '''Returns the lines of a batch script, from stdin if path is -'''
+    try:
+        if path == '-':
+            return sys.stdin.readlines()
+        with open(os.path.expanduser(path)) as batchFile:
+            return batchFile.readlines()
+    except (OSError, IOError), errmsg:
+        print >> sys.stderr, "Error: Couldn't read %s: %s" % (path, errmsg)
+        sys.exit(22)
+
+def runRemoteBatch(plistArgs):
+    '''Runs the --batch script (stdin by default) on the --connect server, returns the exit status'''
+    try:
+        remote = RemoteConfig(plistArgs.connect)
+    except socket.error, errmsg:
+        print >> sys.stderr, "Error: Couldn't connect to %s: %s" % (plistArgs.connect, errmsg)
+        return 2
+    try:
+        results = runBatch(readBatch(plistArgs.batch or '-'), remote, plistArgs.keep_going, remoteSubcommand)
+    finally:
+        remote.close()
+    printBatchReport(results)
+    failed = [result for result in results if result[2] != 0]
+    if failed:
+        return failed[0][2]
+    return 0
+
+def runValidation(paths, processes):
+    '''Validates the plists at paths, returns 1 if any have problems'''
+    status = 0
+    for path, problems in validateFiles(paths, processes):
+        printValidationProblems(problems, '%s: ' % path)
+        if problems:
+            status = 1
+    return status
 
 # global variable
 CMD_ARG_DICT = {}
@@ -846,8 +4299,55 @@ CMD_ARG_DICT = {}
 def main():
     global CMD_ARG_DICT
     parser = argparse.ArgumentParser()
-    parser.add_argument("plist", help="Path to a plist to edit. Will create if it doesn't exist.")
+    parser.add_argument("plist", nargs='?', help="Path to a plist to edit. Will create if it doesn't exist.")
+    parser.add_argument("--batch", metavar="SCRIPT",
+                        help="Run the subcommands in SCRIPT (- for stdin) and save once at the end, instead of entering interactive mode.")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="In batch mode, keep running after a subcommand fails. By default the batch stops and nothing is saved.")
+    parser.add_argument("--binary", action="store_true",
+                        help="Save the plist in binary format instead of XML.")
+    parser.add_argument("--stats", action="store_true",
+                        default=bool(os.environ.get('IMAGR_CONFIG_STATS')),
+                        help="Print subcommand, load and save timings to stderr when finished. Also set by IMAGR_CONFIG_STATS.")
+    parser.add_argument("--profile", metavar="SUBCOMMAND",
+                        default=os.environ.get('IMAGR_CONFIG_PROFILE'),
+                        help="Run SUBCOMMAND under cProfile and dump the profile to --profile-output. Also set by IMAGR_CONFIG_PROFILE.")
+    parser.add_argument("--profile-output", metavar="PATH", default=STATS.profilePath,
+                        help="Where --profile writes its pstats file - defaults to %s" % STATS.profilePath)
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="Keep the plist loaded and run subcommands sent to the Unix domain socket SOCKET.")
+    parser.add_argument("--flush-delay", metavar="SECONDS", type=float, default=2.0,
+                        help="Interactively or with --serve, save this long after the last change - defaults to 2 seconds")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="Don't autosave or keep a journal of unsaved changes. Changes are then only saved on exit.")
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help="Send the --batch subcommands to the server on SOCKET instead of editing a plist directly.")
+    parser.add_argument("--mirror", metavar="URL_PREFIX=DIRECTORY", type=parseMirror, action='append', default=[],
+                        help="URLs starting with URL_PREFIX are files under DIRECTORY, a local mirror of the repo. Package and image components added for them get a sha256 checksum. Can be repeated.")
+    parser.add_argument("--script-store", metavar="DIRECTORY",
+                        help="Keep each distinct script once in DIRECTORY, and share it between the components that use it.")
+    parser.add_argument("--script-refs", action="store_true",
+                        help="With --script-store, save script components with a content_ref into the store instead of their content.")
+    parser.add_argument("--validate", metavar="PATH", nargs='+',
+                        help="Check the plists at PATH, or the .plist files in each directory PATH, and list their problems.")
+    parser.add_argument("--output-mode", metavar="MODE", choices=OUTPUT_MODES,
+                        help="What to print after each change: full (the whole workflow, the default), summary (one line, the default with --batch) or quiet (nothing).")
+    parser.add_argument("--quiet", "-q", dest="output_mode", action="store_const", const='quiet',
+                        help="Same as --output-mode quiet.")
+    parser.add_argument("--jobs", metavar="N", type=int,
+                        help="Number of processes --validate uses - defaults to one per core.")
     plistArgs = parser.parse_args()
+    if plistArgs.connect:
+        sys.exit(runRemoteBatch(plistArgs))
+    if plistArgs.validate:
+        sys.exit(runValidation(plistArgs.validate + ([plistArgs.plist] if plistArgs.plist else []), plistArgs.jobs))
+    if not plistArgs.plist:
+        parser.error('a plist path is required')
+    if plistArgs.profile:
+        STATS.profileCommand = subcommandName(plistArgs.profile)
+    STATS.profilePath = plistArgs.profile_output
+    if plistArgs.stats:
+        atexit.register(printStats)
     
     if os.path.exists(plistArgs.plist):
         try:
@@ -858,13 +4358,38 @@ def main():
     else:
         # file does not exist, we'll save it on exit
         configPlist = ImagrConfigPlist(plistArgs.plist)
-    
+    configPlist.binary = plistArgs.binary
+    if plistArgs.output_mode is not None:
+        configPlist.outputMode = plistArgs.output_mode
+    elif plistArgs.batch:
+        configPlist.outputMode = BATCH_OUTPUT_MODE
+    configPlist.mirrors.extend(plistArgs.mirror)
+    if plistArgs.script_store:
+        configPlist.useScriptStore(ScriptStore(plistArgs.script_store))
+        configPlist.scriptRefs = plistArgs.script_refs
+    elif plistArgs.script_refs:
+        parser.error('--script-refs needs --script-store')
+
+    journal = ChangeJournal(plistArgs.plist)
+    if journal.records():
+        # a previous session ended before saving its changes
+        count = journal.replay(configPlist)
+        configPlist.synchronize()
+        journal.clear()
+        print >> sys.stderr, 'Recovered %s unsaved changes from %s' % (count, journal.path)
+    if plistArgs.no_journal:
+        journal = None
+
     # List of commands mapped to data types that they'll autocomplete with
     cmds = {
         'new-password':         'workflows',     # new-password <password>
         'show-password':        'workflows',     # show-password
         'add-workflow':         'workflows',    # add-workflow <name>
-        'display-workflows':    'workflows',    # display-workflows
+        'clone-workflow':       'default',      # clone-workflow <name> --from <workflow> | --template <template>
+        'save-template':        'default',      # save-template <name> --workflow <workflow>
+        'remove-template':      'templates',    # remove-template <template>
+        'display-templates':    'default',      # display-templates
+        'display-workflows':    'default',      # display-workflows --name <pattern> --type <type> --fields <fields>
         'show-workflow':        'workflows',    # show-workflow <workflow>
         'remove-workflow':      'workflows',    # remove-workflow <workflow>
         'set-restart-action':   'workflows',    # set-restart-action <workflow> <restart> 
@@ -876,18 +4401,50 @@ def main():
         'add-script-component':  'workflows',    # add-image-component <workflow> <index> <content> <first_boot t/f>
         'add-erase-component':  'workflows',
         'add-partition-component':  'workflows',
+        'find':                 'default',      # find --url <url> --type <type> ...
+        'rewrite-urls':         'default',      # rewrite-urls --prefix <old> <new> --dry-run
+        'validate':             'default',      # validate --jobs <n>
+        'diff':                 'default',      # diff <plist>
+        'merge':                'default',      # merge <base> <other>
+        'import-manifest':      'default',      # import-manifest <path> --upsert
+        'export':               'default',      # export <path> --format json|jsonl --fields <fields>
+        'update-checksums':     'default',      # update-checksums --mirror <prefix>=<dir>
+        'check-urls':           'default',      # check-urls --jobs <n> --ttl <seconds>
         'remove-component':     'components',   # remove-component <index> <workflow>
         'display-components':   'components',   # display-components <workflow>
+        'set-output':           'default',      # set-output full|summary|quiet
+        'undo':                 'default',
+        'redo':                 'default',
+        'stats':                'default',
         'exit':                 'default',
         'help':                 'default',
         } 
     CMD_ARG_DICT['cmds'] = cmds
 
-    CMD_ARG_DICT['default'] = []
-    CMD_ARG_DICT['workflows'] = configPlist.getWorkflowNames()
-    CMD_ARG_DICT['components'] = configPlist.getWorkflowComponentTypes()
+    if plistArgs.serve:
+        serve(configPlist, plistArgs.serve, plistArgs.flush_delay, journal)
+        sys.exit(0)
 
-    setUpTabCompleter()
+    if plistArgs.batch:
+        lines = readBatch(plistArgs.batch)
+        results = runBatch(lines, configPlist, plistArgs.keep_going)
+        printBatchReport(results)
+        failed = [result for result in results if result[2] != 0]
+        if failed and not plistArgs.keep_going:
+            print >> sys.stderr, 'Batch stopped at line %s, plist was not saved.' % failed[0][0]
+            sys.exit(failed[0][2])
+        configPlist.synchronize()
+        if failed:
+            sys.exit(1)
+        sys.exit(0)
+
+    if journal is not None:
+        # changes are journaled as they're made and saved in the background
+        saver = DebouncedSaver(configPlist, threading.RLock(), plistArgs.flush_delay, journal=journal)
+    else:
+        saver = None
+
+    setUpTabCompleter(configPlist, cmds)
     print 'Entering interactive mode... (type "help" for commands)'
     while 1:
         try:
@@ -895,10 +4452,24 @@ def main():
         except (KeyboardInterrupt, EOFError):
             # React to Control-C and Control-D
             print # so we finish off the raw_input line
+            if saver is not None:
+                saver.stop()
             sys.exit(0)
         args = shlex.split(cmd)
         #print "Args: %s" % args
-        handleSubcommand(args, configPlist)
+        if not args:
+            continue
+        if saver is None:
+            handleSubcommand(args, configPlist)
+            continue
+        if args[0].lstrip('-').replace('-', '_') == 'exit':
+            saver.stop()
+            sys.exit(0)
+        with saver.lock:
+            handleSubcommand(args, configPlist)
+            if configPlist.appliedChanges:
+                # even if it failed, as a partial undo does
+                saver.changed(args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+"""Tests for config_creator.py. Run with: python -m unittest test_config_creator"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import config_creator
+
+
+def workflow(name, description=''):
+    return {'name': name, 'description': description, 'restart_action': 'none',
+            'bless_target': False, 'components': []}
+
+def config(*names):
+    return {'password': '', 'workflows': [workflow(name) for name in names]}
+
+
+class MergeTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def merged(self, base, ours, theirs):
+        """Returns the workflow names, changes and conflicts of merging theirs into ours"""
+        plist = config_creator.ImagrConfigPlist(os.path.join(self.directory, 'ours.plist'))
+        for name in ours:
+            plist.addWorkflow(name)
+        plist.endChange('set up')
+        changes, conflicts = plist.mergeConfig(config(*base), config(*theirs))
+        return plist.getWorkflowNames(), changes, conflicts
+
+    def test_moves_in_theirs_are_applied(self):
+        names, changes, conflicts = self.merged('ABC', 'ABC', 'CAB')
+        self.assertEqual(names, ['C', 'A', 'B'])
+        self.assertEqual(changes, ["Moved 'C' to 0"])
+        self.assertEqual(conflicts, [])
+
+    def test_moves_in_ours_are_kept(self):
+        names, changes, conflicts = self.merged('ABC', 'CAB', 'ABC')
+        self.assertEqual(names, ['C', 'A', 'B'])
+        self.assertEqual(changes, [])
+
+    def test_same_move_in_both_is_not_a_conflict(self):
+        names, changes, conflicts = self.merged('ABC', 'CAB', 'CAB')
+        self.assertEqual(names, ['C', 'A', 'B'])
+        self.assertEqual(conflicts, [])
+
+    def test_different_moves_of_one_workflow_conflict(self):
+        names, changes, conflicts = self.merged('ABC', 'ACB', 'CAB')
+        self.assertEqual(names, ['A', 'C', 'B'])
+        self.assertEqual(conflicts, ["'C' was moved differently in both copies"])
+
+    def test_moves_and_additions(self):
+        names, changes, conflicts = self.merged('ABC', 'ABCE', 'CADB')
+        self.assertEqual(names, ['C', 'A', 'D', 'B', 'E'])
+        self.assertEqual(conflicts, [])
+
+
+class ImportTests(unittest.TestCase):
+    records = [(1, {'workflow': 'Lab', 'description': 'Lab', 'type': 'image', 'url': 'http://a/lab.dmg'}),
+               (2, {'workflow': 'Lab', 'type': 'package', 'url': 'http://a/munki.pkg'}),
+               (3, {'workflow': 'Other', 'type': 'image', 'url': 'http://a/other.dmg'})]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.plist = config_creator.ImagrConfigPlist(os.path.join(self.directory, 'config.plist'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_import_counts(self):
+        counts, errors = self.plist.importRecords(self.records)
+        self.assertEqual(errors, [])
+        self.assertEqual((counts['added'], counts['updated'], counts['components']), (2, 0, 3))
+
+    def test_reimport_changes_nothing(self):
+        self.plist.importRecords(self.records)
+        self.plist.endChange('import')
+        counts, errors = self.plist.importRecords(self.records, upsert=True)
+        self.assertEqual((counts['added'], counts['updated'], counts['components']), (0, 0, 0))
+        self.assertEqual(self.plist.pendingChange, [])
+
+    def test_upsert_counts_changed_workflows(self):
+        self.plist.importRecords(self.records)
+        changed = [(1, {'workflow': 'Lab', 'type': 'image', 'url': 'http://a/lab.dmg'}),
+                   (2, {'workflow': 'Other', 'description': 'new'})]
+        counts, errors = self.plist.importRecords(changed, upsert=True)
+        self.assertEqual((counts['added'], counts['updated'], counts['components']), (0, 2, 0))
+        self.assertEqual(len(self.plist.getWorkflow('Lab')['components']), 1)
+
+
+class ValidationTests(unittest.TestCase):
+    def test_bundled_config_is_valid(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testing_imagr_config.plist')
+        [(checked, problems)] = config_creator.validateFiles([path], processes=1)
+        self.assertEqual(problems, [])
+
+    def test_missing_required_keys(self):
+        problems = config_creator.validateWorkflow({'name': 'Lab', 'components': [{'type': 'image'},
+                                                                                 {'type': 'eraseVolume'}]})
+        self.assertEqual(problems, ['component 0 (image) is missing url'])
+
+
+if __name__ == '__main__':
+    unittest.main()